@@ -0,0 +1,267 @@
+'''
+Model registry module.
+
+Keeps the trained models of the API within a memory budget. Models are keyed by the content of
+the search (its sorted document guids, their rank, title and summary, and the training
+parameters), and every search_guid is an alias of such a key, so that searches for the same
+documents share one model.
+
+Every trained model is saved to MODELS_DIR/<key>/ as the precomputed response (result.json) next
+to the BigARTM model dump (artm/) written by the worker, and the aliases are appended to
+MODELS_DIR/aliases.log. The least recently used models are dropped from memory and loaded again
+from their result.json on the next request, also after a restart; the dump is never read.
+'''
+
+import hashlib
+import json
+import os
+import sys
+import threading
+
+from collections import OrderedDict
+
+from extractor.loader import print_now
+from knowledge_extractor.utils import NLTK, PREPROCESSING
+
+from .scheduler import DONE, TrainingJob
+
+MODELS_DIR = os.environ.get(
+    'MODELS_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models')
+)
+MODEL_MEMORY_BUDGET = int(os.environ.get('MODEL_MEMORY_BUDGET', str(512 * 1024 * 1024)))
+
+RESULT_FILE_NAME = 'result.json'
+ARTM_DIR_NAME = 'artm'
+ALIASES_FILE_NAME = 'aliases.log'
+
+# the fields of a request document that are served with the topic map; summaries are trained on as well
+METADATA_FIELDS = ('rank', 'title', 'summary')
+
+def get_metadata_digest(documents):
+    '''
+    Returns a hash of the rank, title and summary of every document guid, in guid order. The first
+    document with a guid wins, as in the topic profile.
+    '''
+    metadata = {}
+    for doc in documents:
+        metadata.setdefault(doc['docGuid'], [doc.get(field) for field in METADATA_FIELDS])
+
+    content = json.dumps(sorted(metadata.items()))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def get_model_key(documents, num_of_topics=10, analyze_full_doc=True, preprocessing=PREPROCESSING):
+    '''
+    Returns the key of the model trained on the documents: a hash of their sorted guids, of their
+    rank, title and summary, which the saved response holds, and of the training parameters,
+    independent of the search that asks for it and of the order of its documents.
+    '''
+    content = {
+        'doc_guids': sorted(set(doc['docGuid'] for doc in documents)),
+        'metadata': get_metadata_digest(documents),
+        'num_of_topics': num_of_topics,
+        'analyze_full_doc': analyze_full_doc
+    }
+    if preprocessing != NLTK:
+        # left out for the default mode, so that models saved before the modes existed keep their key
+        content['preprocessing'] = preprocessing
+    content = json.dumps(content, sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def get_model_dir(key, directory=MODELS_DIR):
+    return os.path.join(directory, key)
+
+class ModelRegistry(object):
+    '''
+    search_guid -> TrainingJob mapping through the model keys. Jobs that are queued, running or
+    failed always stay in memory; trained jobs count against the memory budget with what they hold.
+    With serialise, which sets the response of a job, a trained job holds its response and only
+    the training status of its result; otherwise it holds its result, counted as its saved size.
+    '''
+    def __init__(self, directory=MODELS_DIR, memory_budget=MODEL_MEMORY_BUDGET, serialise=None):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.serialise = serialise
+        self.evictions = 0
+        self.reloads = 0
+        self.requests = 0
+        self.hits = 0
+        self._aliases = {}
+        self._jobs = OrderedDict()
+        self._sizes = {}
+        self._saved = set()
+        self._lock = threading.RLock()
+
+    def __contains__(self, search_guid):
+        with self._lock:
+            key = self._aliases.get(search_guid)
+            return key is not None and (key in self._jobs or key in self._saved)
+
+    def __getitem__(self, search_guid):
+        with self._lock:
+            job = self._find(self._aliases.get(search_guid))
+            if job is None:
+                raise KeyError(search_guid)
+            return job
+
+    def attach(self, search_guid, key, create):
+        '''
+        Makes search_guid an alias of the model with the key. When there is no such model, or its
+        training failed, create() is called to start a new job. Returns (job, whether it was created).
+        '''
+        with self._lock:
+            self.requests += 1
+            job = self._find(key)
+            created = job is None or job.is_failed()
+            if created:
+                job = create()
+                self._jobs[key] = job
+                self._sizes.pop(key, None)
+            else:
+                self.hits += 1
+
+            if self._aliases.get(search_guid) != key:
+                self._aliases[search_guid] = key
+                self._save_alias(search_guid, key)
+
+            return job, created
+
+    def on_done(self, job):
+        '''
+        Saves a trained job and releases its request payload, which the trained model no longer needs.
+        '''
+        if job.state != DONE:
+            return
+
+        job.documents = None
+        # the full text model has replaced the preliminary one
+        job.preliminary = None
+        try:
+            size = self._release_result(job, self._save_result(job))
+        except:
+            print_now('Model {} could not be saved: {}'.format(job.key, sys.exc_info()[1]))
+            return
+
+        with self._lock:
+            self._saved.add(job.key)
+            if self._jobs.get(job.key) is job:
+                self._sizes[job.key] = size
+            self._evict()
+
+        print_now('Model registry {}'.format(self.stats()))
+
+    def load(self):
+        '''
+        Indexes the models saved by earlier runs and their aliases; results are read on first use.
+        '''
+        if not os.path.isdir(self.directory):
+            return 0
+
+        saved = set(key for key in os.listdir(self.directory)
+                    if os.path.isfile(os.path.join(self.directory, key, RESULT_FILE_NAME)))
+
+        aliases = {}
+        aliases_file_name = os.path.join(self.directory, ALIASES_FILE_NAME)
+        if os.path.isfile(aliases_file_name):
+            with open(aliases_file_name, encoding='utf-8') as aliases_file:
+                for line in aliases_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a record cut short by a crash
+                        continue
+                    aliases[record['search_guid']] = record['key']
+
+        with self._lock:
+            self._saved |= saved
+            for search_guid, key in aliases.items():
+                self._aliases.setdefault(search_guid, key)
+
+        return len(saved)
+
+    def memory_size(self):
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_memory': len(self._jobs),
+                'saved': len(self._saved),
+                'aliases': len(self._aliases),
+                'memory_size': sum(self._sizes.values()),
+                'evictions': self.evictions,
+                'reloads': self.reloads,
+                'dedup_requests': self.requests,
+                'dedup_hits': self.hits,
+                'dedup_hit_rate': round(self.hits / self.requests, 4) if self.requests else 0.0
+            }
+
+    def _find(self, key):
+        if key is None:
+            return None
+
+        if key not in self._jobs:
+            if key not in self._saved:
+                return None
+            self._jobs[key] = self._load_job(key)
+            self.reloads += 1
+            # the job is returned, so it stays even when it alone is over the budget
+            self._evict(keep=key)
+
+        self._jobs.move_to_end(key)
+        return self._jobs[key]
+
+    def _evict(self, keep=None):
+        total = sum(self._sizes.values())
+        for key in list(self._jobs):
+            if total <= self.memory_budget:
+                break
+            if key not in self._sizes or key == keep:
+                continue
+            total -= self._sizes.pop(key)
+            del self._jobs[key]
+            self.evictions += 1
+
+    def _release_result(self, job, size):
+        '''
+        Replaces the result of a trained job with its serialised response, keeping the training
+        status only. Returns the size of what the job holds then.
+        '''
+        if self.serialise is None:
+            return size
+
+        self.serialise(job)
+        job.result = {'status': job.result.get('status')}
+        return len(job.response[0]) + len(json.dumps(job.result))
+
+    def _save_alias(self, search_guid, key):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ALIASES_FILE_NAME), 'a', encoding='utf-8') as aliases_file:
+            aliases_file.write(json.dumps({'search_guid': search_guid, 'key': key}) + '\n')
+
+    def _save_result(self, job):
+        model_dir = get_model_dir(job.key, self.directory)
+        os.makedirs(model_dir, exist_ok=True)
+
+        file_name = os.path.join(model_dir, RESULT_FILE_NAME)
+        part_file_name = '{}.part'.format(file_name)
+        data = json.dumps({'key': job.key, 'search_guid': job.search_guid, 'result': job.result}).encode('utf-8')
+        with open(part_file_name, 'wb') as result_file:
+            result_file.write(data)
+        os.replace(part_file_name, file_name)
+
+        return len(data)
+
+    def _load_job(self, key):
+        file_name = os.path.join(get_model_dir(key, self.directory), RESULT_FILE_NAME)
+        with open(file_name, 'rb') as result_file:
+            data = result_file.read()
+
+        saved = json.loads(data.decode('utf-8'))
+        job = TrainingJob(saved['search_guid'], None, key=key)
+        job.result = saved['result']
+        job.state = DONE
+        self._sizes[key] = self._release_result(job, len(data))
+
+        return job
@@ -0,0 +1,369 @@
+'''
+Training scheduler module.
+
+Trains topic models in worker processes, at most TRAINING_WORKERS at a time. Searches waiting for
+a worker are kept in a bounded priority queue (first come, first served within a priority), and a
+search is rejected when the queue is full.
+'''
+
+import collections
+import heapq
+import itertools
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from extractor.loader import print_now
+from extractor.metrics import STAGE_SECONDS, get_metrics
+
+TRAINING_WORKERS = int(os.environ.get('TRAINING_WORKERS', '2'))
+TRAINING_QUEUE_SIZE = int(os.environ.get('TRAINING_QUEUE_SIZE', '20'))
+# seconds one training is expected to take until the first trainings have finished
+TRAINING_ESTIMATE = float(os.environ.get('TRAINING_ESTIMATE', '120'))
+# priorities a request may ask for, lower first; by default a request can only give way to others
+MIN_PRIORITY = int(os.environ.get('TRAINING_MIN_PRIORITY', '0'))
+MAX_PRIORITY = int(os.environ.get('TRAINING_MAX_PRIORITY', '9'))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+class QueueFullError(Exception):
+    pass
+
+def get_priority(value, minimum=MIN_PRIORITY, maximum=MAX_PRIORITY):
+    '''
+    Returns the priority a request asked for as an integer between minimum and maximum; raises
+    ValueError if it is not an integer.
+    '''
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        raise ValueError('priority must be an integer, not {!r}'.format(value))
+    try:
+        priority = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('priority must be an integer, not {!r}'.format(value))
+
+    return min(max(priority, minimum), maximum)
+
+class TrainingJob(object):
+    '''
+    Training of one search as seen from the API process. Once trained it answers the calls the API
+    makes to a trained TopicModel with what the worker process computed.
+    '''
+    def __init__(self, search_guid, documents, priority=0, key=None, profile=None, parent=None):
+        self.search_guid = search_guid
+        self.key = key
+        # a preliminary job stands in for its parent, the full text training, until that is done
+        self.parent = parent
+        self.preliminary = None
+        # None leaves profiling to the PROFILE setting of the worker
+        self.profile = profile
+        self.documents = documents
+        self.priority = priority
+        self.state = QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        # (JSON bytes, ETag) of the API response, serialised on first use
+        self.response = None
+        self.error = None
+        # stage -> {'done': ..., 'total': ...} as reported by the worker
+        self.progress = {}
+        # incremented on every change of the state or the progress
+        self.version = 0
+
+    def is_ready(self):
+        return self.state == DONE
+
+    def is_failed(self):
+        return self.state == FAILED
+
+    def is_preliminary(self):
+        return self.parent is not None
+
+    def get_topic_profile(self):
+        return self.result['documents']
+
+    def get_top_words(self):
+        return self.result['topics']
+
+    def get_status(self):
+        return self.result['status']
+
+# progress of the trainings goes from the worker processes to the API process through this queue
+_progress_queue = None
+
+def _init_worker(progress_queue, workers=1):
+    from knowledge_extractor.utils import set_text_prepare_share
+
+    global _progress_queue
+    _progress_queue = progress_queue
+    # the workers of the scheduler prepare text at the same time, each with its share of the processors
+    set_text_prepare_share(workers)
+
+def train_search(search_guid, documents, key=None, loader_concurrency=1, loader_rate_limit=None, in_memory=True,
+                 models_dir=None, profile=None, analyze_full_doc=True):
+    '''
+    Runs in a worker process: loads the documents of the search, trains its model and returns
+    the topic profile, the top words and the training status, plus the metrics recorded by the
+    worker for the API process. With models_dir the BigARTM model is dumped to the folder of the
+    model key. Without analyze_full_doc the model is trained on the summaries of the request and
+    nothing is loaded. The training is profiled when profile is set, or by default when PROFILE is.
+    '''
+    from extractor.profiling import profiled
+
+    with profiled('train_{}'.format(key or search_guid), profile):
+        result = _train_search(search_guid, documents, key, loader_concurrency, loader_rate_limit, in_memory,
+                               models_dir, analyze_full_doc)
+
+    result['metrics'] = get_metrics().drain()
+    return result
+
+def _train_search(search_guid, documents, key, loader_concurrency, loader_rate_limit, in_memory, models_dir,
+                  analyze_full_doc):
+    from api.registry import ARTM_DIR_NAME, get_model_dir
+    from extractor.loader import DocumentRawLoader
+    from knowledge_extractor.cache import get_prepared_cache
+    from knowledge_extractor.models import TopicModel
+    from knowledge_extractor.utils import get_lemma_cache
+
+    def progress(stage, done, total):
+        if _progress_queue is not None:
+            _progress_queue.put((key or search_guid, stage, done, total))
+
+    start = datetime.now()
+    if analyze_full_doc:
+        DocumentRawLoader(
+            doc_guids=[doc['docGuid'] for doc in documents],
+            concurrency=loader_concurrency,
+            rate_limit=loader_rate_limit,
+            progress=progress
+        ).load()
+    loaded = datetime.now()
+
+    model = TopicModel(search_guid, documents, analyze_full_doc=analyze_full_doc, in_memory=in_memory,
+                       progress=progress)
+    model.train()
+    result = {
+        'documents': model.get_topic_profile(),
+        'topics': model.get_top_words(),
+        'status': model.get_status()
+    }
+    if models_dir and key and analyze_full_doc:
+        model.dump(os.path.join(get_model_dir(key, models_dir), ARTM_DIR_NAME))
+
+    print_now('Model {}: loading took {}, training took {}, lemma cache {}, prepared text cache {}'.format(
+        search_guid, loaded - start, datetime.now() - loaded, get_lemma_cache().stats(),
+        get_prepared_cache().stats()))
+
+    return result
+
+class TrainingScheduler(object):
+    '''
+    Hands queued jobs to the worker pool as workers become free. The options are passed on to
+    the target of every job, and on_done is called with every finished job. The queue and training
+    times are recorded as the <name>queue and <name>train stages.
+    '''
+    def __init__(self, workers=TRAINING_WORKERS, max_queue=TRAINING_QUEUE_SIZE, estimate=TRAINING_ESTIMATE,
+                 options=None, target=train_search, executor=None, on_done=None, name=''):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.estimate = estimate
+        self.options = options or {}
+        self.target = target
+        self.on_done = on_done
+        self._executor = executor
+        self._queue = []
+        self._running = []
+        self._counter = itertools.count()
+        self._durations = collections.deque(maxlen=20)
+        # RLock: a job that completes at once runs its callback inside submit
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._progress_queue = None
+        self._listener = None
+
+    def submit(self, job):
+        with self._lock:
+            if len(self._queue) >= self.max_queue:
+                raise QueueFullError('Training queue is full ({} searches)'.format(self.max_queue))
+
+            # converted before the push: a priority that does not compare would break the heap for good
+            priority = int(job.priority)
+            job.state = QUEUED
+            heapq.heappush(self._queue, (priority, next(self._counter), job))
+            self._dispatch()
+
+    def get_position(self, job):
+        '''
+        Returns the number of queued jobs that start before the job, or None if it is not queued.
+        '''
+        with self._lock:
+            queued = [item[2] for item in sorted(self._queue)]
+            return queued.index(job) if job in queued else None
+
+    def get_estimated_start(self, job):
+        '''
+        Returns the time the job is expected to start: every worker takes the next queued job once
+        its current job has run for the average training time.
+        '''
+        with self._lock:
+            if job.started is not None:
+                return job.started
+
+            position = self.get_position(job)
+            if position is None:
+                return None
+
+            now = time.time()
+            duration = self.get_average_duration()
+            free = [max(now, running.started + duration) for running in self._running]
+            free += [now] * (self.workers - len(free))
+            heapq.heapify(free)
+
+            for _ in range(position):
+                heapq.heappush(free, heapq.heappop(free) + duration)
+
+            return free[0]
+
+    def get_queue_length(self):
+        with self._lock:
+            return len(self._queue)
+
+    def get_running_count(self):
+        with self._lock:
+            return len(self._running)
+
+    def get_average_duration(self):
+        with self._lock:
+            if not self._durations:
+                return self.estimate
+            return sum(self._durations) / len(self._durations)
+
+    def describe(self, job):
+        estimated_start = self.get_estimated_start(job)
+        return {
+            'queue_position': self.get_position(job),
+            'queue_length': len(self._queue),
+            'estimated_start': datetime.fromtimestamp(estimated_start).isoformat() if estimated_start else None
+        }
+
+    def report_progress(self, key, stage, done, total):
+        with self._lock:
+            for job in self._running:
+                if (job.key or job.search_guid) == key:
+                    job.progress[stage] = {'done': done, 'total': total}
+                    self._notify(job)
+
+    def notify(self, job):
+        '''
+        Wakes up whoever waits for a change of the job.
+        '''
+        with self._lock:
+            self._notify(job)
+
+    def wait(self, job, version, timeout):
+        '''
+        Waits up to timeout seconds for the state or the progress of the job to change after version
+        and returns the current version.
+        '''
+        with self._changed:
+            self._changed.wait_for(lambda: job.version != version, timeout)
+            return job.version
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._queue = []
+            executor, self._executor = self._executor, None
+            progress_queue, self._progress_queue = self._progress_queue, None
+
+        if executor is not None:
+            executor.shutdown(wait=wait)
+        if progress_queue is not None:
+            # the listener reports progress under the lock, so it is stopped outside of it
+            progress_queue.put(None)
+            self._listener.join(1.0)
+
+    def _notify(self, job):
+        job.version += 1
+        self._changed.notify_all()
+
+    def _listen(self, progress_queue):
+        while True:
+            try:
+                message = progress_queue.get()
+            except (EOFError, OSError):
+                # the queue is closed when the process exits
+                break
+            if message is None:
+                break
+            self.report_progress(*message)
+
+    def _dispatch(self):
+        while self._queue and len(self._running) < self.workers:
+            _, _, job = heapq.heappop(self._queue)
+            job.state = RUNNING
+            job.started = time.time()
+            self._running.append(job)
+            self._notify(job)
+
+            options = dict(self.options, key=job.key)
+            if job.profile is not None:
+                options['profile'] = job.profile
+
+            try:
+                future = self._get_executor().submit(self.target, job.search_guid, job.documents, **options)
+            except BrokenProcessPool:
+                # a worker died: the pool cannot take new work, so the job goes to a new one
+                self._executor = None
+                future = self._get_executor().submit(self.target, job.search_guid, job.documents, **options)
+
+            future.add_done_callback(lambda future, job=job: self._on_done(job, future))
+
+    def _on_done(self, job, future):
+        with self._lock:
+            self._running.remove(job)
+            job.finished = time.time()
+            metrics = get_metrics()
+            metrics.histogram(STAGE_SECONDS, stage='{}queue'.format(self.name)).observe(job.started - job.submitted)
+            metrics.histogram(STAGE_SECONDS, stage='{}train'.format(self.name)).observe(job.finished - job.started)
+            try:
+                result = future.result()
+                metrics.merge(result.pop('metrics', []))
+                job.result = result
+                job.state = DONE
+                self._durations.append(job.finished - job.started)
+                metrics.counter('{}training_jobs_total'.format(self.name), outcome='done').inc()
+            except:
+                job.error = str(sys.exc_info()[1])
+                job.state = FAILED
+                metrics.counter('{}training_jobs_total'.format(self.name), outcome='failed').inc()
+                print_now('Training of {} failed: {}'.format(job.search_guid, job.error))
+
+            self._notify(job)
+            self._dispatch()
+
+        if self.on_done is not None:
+            self.on_done(job)
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawned workers do not inherit the threads and locks of the API server
+            context = multiprocessing.get_context('spawn')
+            if self._progress_queue is None:
+                self._progress_queue = context.Queue()
+                self._listener = threading.Thread(target=self._listen, args=(self._progress_queue,), daemon=True)
+                self._listener.start()
+
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                                 initializer=_init_worker, initargs=(self._progress_queue, self.workers))
+        return self._executor
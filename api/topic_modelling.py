@@ -1,36 +1,146 @@
 import argparse
-import falcon
+import hashlib
+import json
 import os
 import sys
-import time
 import threading
+import time
 
-from falcon_cors import CORS
-from waitress import serve
-
-from knowledge_extractor.models import TopicModel
-from extractor.loader import DocumentRawLoader
+from extractor.loader import print_now
+from extractor.metrics import get_metrics
+from extractor.profiling import PROFILE_HEADER, enable_profiling, profiled
+from knowledge_extractor.utils import ensure_preprocessing_resources
+from knowledge_extractor.workspace import remove_stale_workspaces
 
 from . import __version__
+from .registry import ModelRegistry, get_model_key
+from .scheduler import QueueFullError, TrainingJob, TrainingScheduler, get_priority
 
 MODEL_NOT_TRAINED = 'MODEL_NOT_TRAINED'
 MODEL_TRAINING = 'MODEL_TRAINING'
 MODEL_TRAINED = 'MODEL_TRAINED'
 
 waitTime = int(os.environ.get('WAIT_TIME', '2'))
+loaderConcurrency = int(os.environ.get('LOADER_CONCURRENCY', '8'))
+loaderRateLimit = float(os.environ.get('LOADER_RATE_LIMIT', '0')) or None
+trainInMemory = os.environ.get('TRAIN_IN_MEMORY', '1') != '0'
+longPollTimeout = float(os.environ.get('LONG_POLL_TIMEOUT', '30'))
+eventsKeepAlive = float(os.environ.get('EVENTS_KEEP_ALIVE', '15'))
+# long polls and event streams hold a thread each while they wait
+apiThreads = int(os.environ.get('API_THREADS', '32'))
+# PROGRESSIVE=1 (or "progressive": true in a request) serves a model trained on the summaries of
+# the request while the full text model trains
+progressiveResults = os.environ.get('PROGRESSIVE', '0') != '0'
+preliminaryWorkers = int(os.environ.get('PRELIMINARY_WORKERS', '1'))
+preliminaryEstimate = float(os.environ.get('PRELIMINARY_ESTIMATE', '10'))
+# MODEL_DUMP=0 skips the archival BigARTM dump next to every saved model
+dumpModels = os.environ.get('MODEL_DUMP', '1') != '0'
+
+def serialise_model(model):
+    '''
+    Serialises the response of a trained model once: the topic profile and the top words do not
+    change after training. Only the search_guid differs between the searches sharing the model;
+    the ranks, titles and summaries in the response are part of the model key.
+    A preliminary model is served as still training.
+    '''
+    if model.response is None:
+        result = {
+            'state': MODEL_TRAINING if model.is_preliminary() else MODEL_TRAINED,
+            'preliminary': model.is_preliminary(),
+            'documents': model.get_topic_profile(),
+            'topics': model.get_top_words()
+        }
+        payload = json.dumps(result).encode('utf-8')
+        model.response = (payload, hashlib.sha1(payload).hexdigest())
+
+    return model.response
+
+# search_guid -> TrainingJob, shared by the searches for the same documents; trained models keep
+# their serialised response instead of their result
+models = ModelRegistry(serialise=serialise_model)
+scheduler = TrainingScheduler(options={
+    'loader_concurrency': loaderConcurrency,
+    'loader_rate_limit': loaderRateLimit,
+    'in_memory': trainInMemory,
+    'models_dir': models.directory if dumpModels else None
+}, on_done=models.on_done)
+
+def on_preliminary_done(preliminary):
+    preliminary.documents = None
+    # long polls and event streams wait for changes of the full text training
+    scheduler.notify(preliminary.parent)
+
+# summary models train in their own workers, so that they never wait for full text trainings
+preliminary_scheduler = TrainingScheduler(workers=preliminaryWorkers, estimate=preliminaryEstimate, options={
+    'in_memory': trainInMemory,
+    'analyze_full_doc': False
+}, on_done=on_preliminary_done, name='preliminary_')
+_preliminary_lock = threading.Lock()
+
+metrics = get_metrics()
+metrics.gauge('training_jobs', scheduler.get_queue_length, state='queued')
+metrics.gauge('training_jobs', scheduler.get_running_count, state='running')
+metrics.gauge('preliminary_training_jobs', preliminary_scheduler.get_queue_length, state='queued')
+metrics.gauge('preliminary_training_jobs', preliminary_scheduler.get_running_count, state='running')
+metrics.gauge('registry_models', lambda: models.stats()['in_memory'], location='memory')
+metrics.gauge('registry_models', lambda: models.stats()['saved'], location='disk')
+metrics.gauge('registry_memory_bytes', models.memory_size)
+metrics.gauge('registry_dedup_hit_rate', lambda: models.stats()['dedup_hit_rate'])
+
+def get_model_response(search_guid, model):
+    '''
+    Returns the response of the model for the search and its ETag.
+    '''
+    payload, digest = serialise_model(model)
+    prefix = '{{"search_guid": {}, '.format(json.dumps(search_guid)).encode('utf-8')
+    etag = '"{}"'.format(hashlib.sha1('{}\0{}'.format(digest, search_guid).encode('utf-8')).hexdigest())
 
-models = {}
+    return prefix + payload[1:], etag
+
+def is_not_modified(request, etag):
+    if_none_match = request.get_header('If-None-Match')
+    if not if_none_match:
+        return False
+
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or 'W/{}'.format(etag) in tags
+
+def start_preliminary(job):
+    '''
+    Trains a model on the summaries of the documents of the job, unless one is trained already.
+    '''
+    with _preliminary_lock:
+        if job.preliminary is not None or job.documents is None:
+            return
+        job.preliminary = TrainingJob(job.search_guid, job.documents, priority=job.priority, key=job.key,
+                                      profile=job.profile, parent=job)
+
+    try:
+        preliminary_scheduler.submit(job.preliminary)
+    except QueueFullError:
+        # the full text model comes anyway
+        job.preliminary = None
+
+def get_preliminary(job):
+    preliminary = job.preliminary
+    return preliminary if preliminary is not None and preliminary.is_ready() else None
 
 def get_model_state(search_guid, topic_models):
     state = MODEL_NOT_TRAINED
 
-    if search_guid in topic_models:
+    if search_guid in topic_models and not topic_models[search_guid].is_failed():
         state = MODEL_TRAINED if topic_models[search_guid].is_ready() else MODEL_TRAINING
 
     return state
 
 class TopicModelApi(object):
     def on_post(self, request, response):
+        # X-Profile: 1 profiles this request and the training it starts, X-Profile: 0 neither
+        profile = request.get_header(PROFILE_HEADER)
+        with profiled('request_{}'.format(request.media.get('search_guid')), profile):
+            self._on_post(request, response, profile)
+
+    def _on_post(self, request, response, profile):
         search_guid = request.media.get('search_guid')
         state = get_model_state(search_guid, models)
 
@@ -40,41 +150,159 @@ class TopicModelApi(object):
         }
 
         if state == MODEL_NOT_TRAINED:
+            try:
+                priority = get_priority(request.media.get('priority', 0))
+            except ValueError:
+                response.status = '400 Bad Request'
+                result['error'] = str(sys.exc_info()[1])
+                response.media = result
+                return
+
             documents = request.media.get('documents')
-            model = TopicModel(search_guid, documents, analyze_full_doc=True)
-            models[search_guid] = model
-            def train_model():
-                doc_guids = [doc['docGuid'] for doc in documents]
-                DocumentRawLoader(doc_guids=doc_guids).load()
-                model.train()
-
-            threading.Thread(target=train_model).start()
-            result['num_doc_guids'] = len(documents)
-        elif state == MODEL_TRAINED:
-            model = models[search_guid]
-            
-            result['documents'] = model.get_topic_profile()
-            result['topics'] = model.get_top_words()
+            key = get_model_key(documents)
+            def create_job():
+                job = TrainingJob(search_guid, documents, priority=priority, key=key, profile=profile)
+                scheduler.submit(job)
+                return job
+
+            try:
+                job, _ = models.attach(search_guid, key, create_job)
+            except QueueFullError:
+                response.status = '503 Service Unavailable'
+                response.set_header('Retry-After', str(int(scheduler.get_average_duration())))
+                result['error'] = str(sys.exc_info()[1])
+                response.media = result
+                return
+
+            if job.is_ready():
+                # the documents of this search have been trained for another search already
+                state = MODEL_TRAINED
+            else:
+                state = MODEL_TRAINING
+                if request.media.get('progressive', progressiveResults):
+                    start_preliminary(job)
+                result['num_doc_guids'] = len(documents)
+                result.update(scheduler.describe(job))
+
+        if state == MODEL_TRAINED:
+            self._send_model(request, response, search_guid, models[search_guid])
+            return
+
+        # the full text model replaces the preliminary one as soon as the job is done
+        preliminary = get_preliminary(models[search_guid]) if state == MODEL_TRAINING else None
+        if preliminary is not None:
+            self._send_model(request, response, search_guid, preliminary)
+            return
 
         response.media = result
 
+    def _send_model(self, request, response, search_guid, model):
+        body, etag = get_model_response(search_guid, model)
+
+        response.set_header('ETag', etag)
+        if is_not_modified(request, etag):
+            response.status = '304 Not Modified'
+        else:
+            response.content_type = 'application/json'
+            response.data = body
+
+def get_wait(value, maximum=None):
+    '''
+    Returns the seconds a status request asked to wait, at most maximum (longPollTimeout by default);
+    raises ValueError if it is not a number of seconds.
+    '''
+    maximum = longPollTimeout if maximum is None else maximum
+    if isinstance(value, bool):
+        raise ValueError('wait must be a number of seconds, not {!r}'.format(value))
+    try:
+        wait = float(value or 0)
+    except (TypeError, ValueError):
+        raise ValueError('wait must be a number of seconds, not {!r}'.format(value))
+    # NaN fails both comparisons
+    if not 0 <= wait < float('inf'):
+        raise ValueError('wait must be a number of seconds, not {!r}'.format(value))
+
+    return min(wait, maximum)
+
+def get_status(search_guid, wait=0, version=None):
+    '''
+    Returns the status of the model of a search. With wait, a model in training is waited for up to
+    wait seconds (at most longPollTimeout) until it changes after version, or after the current
+    version when no version is given.
+    '''
+    state = get_model_state(search_guid, models)
+    if wait and state == MODEL_TRAINING:
+        job = models[search_guid]
+        scheduler.wait(job, job.version if version is None else version, min(wait, longPollTimeout))
+        state = get_model_state(search_guid, models)
+
+    result = {
+        'search_guid': search_guid,
+        'state': state
+    }
+
+    if state == MODEL_TRAINED:
+        result['training'] = models[search_guid].get_status()
+    elif state == MODEL_TRAINING:
+        job = models[search_guid]
+        result['version'] = job.version
+        result['preliminary'] = get_preliminary(job) is not None
+        result['progress'] = dict(job.progress)
+        result.update(scheduler.describe(job))
+    elif search_guid in models:
+        result['error'] = models[search_guid].error
+
+    return result
+
+def get_status_events(search_guid):
+    '''
+    Yields a server-sent "status" event for every change of the model of a search until it is trained
+    or failed, with a keep-alive comment after eventsKeepAlive seconds without changes.
+    '''
+    result = get_status(search_guid)
+    while True:
+        yield 'event: status\ndata: {}\n\n'.format(json.dumps(result)).encode('utf-8')
+        if result['state'] != MODEL_TRAINING:
+            return
+
+        version = result['version']
+        while scheduler.wait(models[search_guid], version, eventsKeepAlive) == version:
+            yield b': keep-alive\n\n'
+        result = get_status(search_guid)
+
 class TopicModelStatusApi(object):
     def on_post(self, request, response):
+        import falcon
+
         search_guid = request.media.get('search_guid')
-        state = get_model_state(search_guid, models)
+        try:
+            wait = get_wait(request.media.get('wait'))
+        except ValueError:
+            raise falcon.HTTPBadRequest(title='Invalid wait', description=str(sys.exc_info()[1]))
 
-        result = {
-            'search_guid': search_guid,
-            'state': state
-        }
+        response.media = get_status(search_guid, wait, request.media.get('version'))
 
-        response.media = result
+class TopicModelEventsApi(object):
+    def on_get(self, request, response):
+        search_guid = request.get_param('search_guid')
+
+        response.content_type = 'text/event-stream'
+        response.set_header('Cache-Control', 'no-cache')
+        response.stream = get_status_events(search_guid)
+
+class MetricsApi(object):
+    def on_get(self, request, response):
+        response.content_type = 'text/plain; version=0.0.4'
+        response.data = metrics.render().encode('utf-8')
 
 def get_parser():
     parser = argparse.ArgumentParser(description='load documents and extract text')
 
     parser.add_argument('-p', '--port', help='Port to listen requests', type=str)
 
+    parser.add_argument('--profile', help='write cProfile and tracemalloc dumps of every request and training '
+                        'to PROFILE_DIR', action='store_true')
+
     parser.add_argument('-v', '--version', help='displays the current version of topic modelling API',
                         action='store_true')
 
@@ -93,8 +321,22 @@ def command_line_runner():
         parser.print_help()
         return
 
+    if args['profile']:
+        # before the first training, so that the worker processes inherit it
+        enable_profiling()
+
     port = args['port']
 
+    # fail at startup rather than on the first training
+    ensure_preprocessing_resources()
+
+    print_now('{} saved models found in {}'.format(models.load(), models.directory))
+    print_now('{} stale training workspaces removed'.format(remove_stale_workspaces()))
+
+    import falcon
+    from falcon_cors import CORS
+    from waitress import serve
+
     cors = CORS(allow_origins_list=[
                 'https://1.next.demo.westlaw.com',
                 'https://1.next.qed.westlaw.com',
@@ -106,8 +348,15 @@ def command_line_runner():
     api = falcon.API(middleware=[cors.middleware])
     api.add_route('/topic_model', TopicModelApi())
     api.add_route('/topic_model_status', TopicModelStatusApi())
+    api.add_route('/topic_model_events', TopicModelEventsApi())
+    api.add_route('/metrics', MetricsApi())
 
-    serve(api, listen='*:{}'.format(port))
+    try:
+        # send_bytes=1 sends every server-sent event at once, waitress 1.1 buffers 18000 bytes otherwise
+        serve(api, listen='*:{}'.format(port), threads=apiThreads, send_bytes=1)
+    finally:
+        scheduler.shutdown(wait=False)
+        preliminary_scheduler.shutdown(wait=False)
 
 if __name__ == '__main__':
     command_line_runner()
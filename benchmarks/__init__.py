@@ -0,0 +1,3 @@
+'''
+Benchmarks for document_extractor. Run a benchmark with python -m benchmarks.<name>.
+'''
@@ -0,0 +1,98 @@
+'''
+Synthetic corpus module.
+
+Generates Westlaw-style document XML with paratext/starpage.anchor structure, either one document
+or a whole corpus of documents identified by guids.
+'''
+
+import random
+import zlib
+
+# paragraphs per document
+SIZES = {'small': 20, 'medium': 200, 'large': 2000}
+
+# each topic skews the vocabulary of a document, so that topic models have something to find
+TOPICS = (
+    ('contract', 'breach', 'damages', 'lease', 'tenant', 'landlord', 'payment', 'warranty'),
+    ('crime', 'sentence', 'conviction', 'jury', 'prosecutor', 'indictment', 'guilty', 'prison'),
+    ('insurance', 'policy', 'coverage', 'insurer', 'premium', 'claim', 'exclusion', 'loss'),
+    ('employer', 'employee', 'wage', 'discrimination', 'termination', 'union', 'overtime', 'injury'),
+    ('patent', 'infringement', 'trademark', 'copyright', 'license', 'invention', 'royalty', 'claim'),
+)
+
+WORDS = ('court', 'plaintiff', 'defendant', 'appeal', 'judgment', 'motion', 'evidence', 'trial',
+         'jury', 'statute', 'contract', 'breach', 'damages', 'claim', 'liability', 'negligence',
+         'testimony', 'witness', 'counsel', 'order', 'district', 'circuit', 'ruling', 'section',
+         'property', 'insurance', 'employer', 'employee', 'injury', 'sentence', 'conviction',
+         'the', 'of', 'and', 'to', 'in', 'that', 'was', 'for', 'on', 'with', 'by', 'not')
+
+def make_sentence(rnd, num_words, topic=()):
+    words = [rnd.choice(topic) if topic and rnd.random() < 0.3 else rnd.choice(WORDS) for _ in range(num_words)]
+    words[0] = words[0].capitalize()
+    if rnd.random() < 0.1:
+        words.insert(rnd.randrange(len(words)), '“{}”'.format(rnd.choice(WORDS)))
+    if rnd.random() < 0.05:
+        words.insert(rnd.randrange(len(words)), 'A &amp; B')
+    if rnd.random() < 0.02:
+        words.insert(rnd.randrange(len(words)), '\ue484')
+    return ' '.join(words) + '.'
+
+def make_paratext(rnd, page, num_sentences, words_per_sentence, topic=()):
+    parts = ['<paratext>']
+    if rnd.random() < 0.3:
+        parts.append('<starpage.anchor>{}</starpage.anchor>'.format(page))
+    for idx in range(num_sentences):
+        if idx > 0:
+            parts.append('<eos/><bos/>')
+        sentence = make_sentence(rnd, words_per_sentence, topic)
+        if rnd.random() < 0.1:
+            sentence = '<emphasis>{}</emphasis>'.format(sentence)
+        parts.append('\n{}\n'.format(sentence))
+    parts.append('</paratext>')
+    return ''.join(parts)
+
+def make_document_xml(num_paragraphs=100, num_sentences=4, words_per_sentence=20, seed=0, topic=()):
+    rnd = random.Random(seed)
+    parts = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<Document><n-docbody><opinion.block><opinion.block.body><opinion.lead><opinion.body>']
+    for idx in range(num_paragraphs):
+        if idx % 10 == 0:
+            if idx > 0:
+                parts.append('</section.body></section>')
+            parts.append('<section id="{}"><head>Head {}</head><section.body>'.format(idx // 10, idx // 10))
+        parts.append('<para><bop/><bos/>')
+        parts.append(make_paratext(rnd, idx // 5 + 1, num_sentences, words_per_sentence, topic))
+        parts.append('</para>')
+    if num_paragraphs > 0:
+        parts.append('</section.body></section>')
+    parts.append('</opinion.body></opinion.lead></opinion.block.body></opinion.block></n-docbody></Document>')
+    return '\n'.join(parts)
+
+def make_guid(index):
+    return 'I{:032x}'.format(index)
+
+def get_size(size):
+    '''
+    Returns the number of paragraphs for a size name of SIZES or a number.
+    '''
+    return SIZES[size] if size in SIZES else int(size)
+
+def get_corpus_topic(guid):
+    '''
+    Returns the index in TOPICS of the topic the document with the guid is generated from.
+    '''
+    return zlib.crc32(guid.encode('utf-8')) % len(TOPICS)
+
+def make_corpus_xml(guid, num_paragraphs=SIZES['medium']):
+    '''
+    Returns the XML of the document with the guid; the same guid always gives the same document.
+    '''
+    seed = zlib.crc32(guid.encode('utf-8'))
+    return make_document_xml(num_paragraphs=num_paragraphs, seed=seed, topic=TOPICS[get_corpus_topic(guid)])
+
+def make_documents(num_documents):
+    '''
+    Returns the documents of a search over the corpus, as the API receives them.
+    '''
+    return [{'docGuid': make_guid(idx), 'title': 'Document {}'.format(idx), 'summary': '', 'rank': idx}
+            for idx in range(num_documents)]
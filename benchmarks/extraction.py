@@ -0,0 +1,71 @@
+'''
+Paragraph extraction micro-benchmark: paragraphs per second for the legacy tostring-plus-regex
+loop and for the tree walking engine on every available XML backend.
+'''
+
+import argparse
+import re
+import time
+
+import xml.etree.ElementTree as ET
+
+from benchmarks.corpus import make_document_xml
+from extractor.paragraphs import BACKENDS, get_backend, get_paragraph_text
+
+re_clean = re.compile('<.*?>')
+
+def legacy_paragraph_text(node):
+    paragraph = []
+    for child in node:
+        res = ET.tostring(child, encoding='unicode')
+        res = re.sub(re_clean, ' ', res)
+        res = res.replace('“', '').replace('”', '') \
+                .replace('\ue484', '')
+
+        for line in res.split('\n'):
+            line = line.strip()
+            if len(line) > 0 and line.isdigit() == False:
+                paragraph.append(line)
+
+    return ' '.join(paragraph).strip()
+
+def measure(nodes, func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for node in nodes:
+            func(node)
+    elapsed = time.perf_counter() - start
+    return len(nodes) * repeat / elapsed
+
+def run(num_paragraphs=2000, repeat=5):
+    xml = make_document_xml(num_paragraphs=num_paragraphs).encode('utf-8')
+
+    etree_nodes = ET.fromstring(xml).findall('.//paratext')
+    expected = [legacy_paragraph_text(n) for n in etree_nodes]
+
+    results = {'legacy (etree tostring)': measure(etree_nodes, legacy_paragraph_text, repeat)}
+    for name in BACKENDS:
+        try:
+            backend = get_backend(name)
+        except ValueError:
+            continue
+
+        nodes = backend.fromstring(xml).findall('.//paratext')
+        if [get_paragraph_text(n) for n in nodes] != expected:
+            raise AssertionError('{} backend output differs from the legacy extraction'.format(name))
+
+        results['walk ({})'.format(name)] = measure(nodes, get_paragraph_text, repeat)
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='paragraph extraction micro-benchmark')
+    parser.add_argument('-n', '--paragraphs', help='number of paragraphs in the document', type=int, default=2000)
+    parser.add_argument('-r', '--repeat', help='number of passes over the document', type=int, default=5)
+    args = parser.parse_args()
+
+    for name, rate in run(args.paragraphs, args.repeat).items():
+        print('{:<28} {:>12,.0f} paragraphs/s'.format(name, rate))
+
+if __name__ == '__main__':
+    main()
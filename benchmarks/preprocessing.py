@@ -0,0 +1,162 @@
+'''
+Preprocessing benchmark: speed of the fast text preparation mode against the NLTK mode, and how
+far the topic models trained on their output drift apart on the fixed synthetic corpus.
+
+- tokens/s of text_prepare_batch in each mode, with a cold lemma cache
+- lemma agreement: share of the NLTK mode tokens the fast mode produces as well, per document
+- top words: mean Jaccard similarity of the top words of the topics of both models, after
+  matching every topic to its most similar counterpart
+- assignments: share of documents whose main topic is the matched topic in both models
+- adjusted Rand index of the main topics against the topics the corpus was generated from
+
+Both modes need the NLTK resources, the fast mode the lemma table of knowledge_extractor.lemmas.
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from collections import Counter
+
+from benchmarks.corpus import SIZES, get_corpus_topic, get_size, make_documents
+from benchmarks.suite import cold_lemma_cache, get_meta, get_texts
+from knowledge_extractor.utils import FAST, NLTK
+
+MODES = (NLTK, FAST)
+
+def get_agreement(reference, other):
+    '''
+    Returns the share of the tokens of reference that other has as well, counted per document.
+    '''
+    matched = total = 0
+    for reference_text, other_text in zip(reference, other):
+        reference_counts = Counter(reference_text.split())
+        other_counts = Counter(other_text.split())
+        matched += sum(min(count, other_counts[token]) for token, count in reference_counts.items())
+        total += sum(reference_counts.values())
+    return matched / total if total else 1.0
+
+def match_topics(top_words, other_top_words):
+    '''
+    Returns [(topic, other topic, Jaccard similarity of their top words)], pairing the topics so
+    that the total similarity is the largest.
+    '''
+    import numpy as np
+
+    from scipy.optimize import linear_sum_assignment
+
+    topics, other_topics = sorted(top_words), sorted(other_top_words)
+    similarity = np.zeros((len(topics), len(other_topics)))
+    for i, topic in enumerate(topics):
+        for j, other_topic in enumerate(other_topics):
+            words, other_words = set(top_words[topic]), set(other_top_words[other_topic])
+            union = words | other_words
+            similarity[i, j] = len(words & other_words) / len(union) if union else 1.0
+
+    rows, columns = linear_sum_assignment(-similarity)
+    return [(topics[i], other_topics[j], similarity[i, j]) for i, j in zip(rows, columns)]
+
+def measure_preparation(texts, mode, processes, temp_dir):
+    from knowledge_extractor.utils import text_prepare_batch
+
+    with cold_lemma_cache(temp_dir):
+        start = time.perf_counter()
+        prepared = text_prepare_batch(texts, processes=processes, mode=mode)
+        seconds = time.perf_counter() - start
+
+    return seconds, prepared
+
+def train(mode, num_documents, num_topics, processes, temp_dir):
+    from extractor.store import PackStore
+    from knowledge_extractor.cache import PreparedTextCache
+    from knowledge_extractor.models import TopicModel
+
+    store = PackStore(os.path.join(temp_dir, 'documents'))
+    model = TopicModel('benchmark_{}'.format(mode), make_documents(num_documents), num_of_topics=num_topics,
+                       store=store, processes=processes, preprocessing=mode,
+                       prepared_cache=PreparedTextCache(os.path.join(temp_dir, 'prepared_{}.sqlite'.format(mode))))
+    with contextlib.redirect_stdout(io.StringIO()), cold_lemma_cache(temp_dir):
+        model.train()
+    subjects = {doc['doc_guid']: doc['sbj'] for doc in model.get_topic_profile()}
+
+    return model, subjects
+
+def run(num_documents=200, num_paragraphs=SIZES['small'], num_topics=6, top_words=15, processes=1):
+    from extractor.store import PackStore
+    from knowledge_extractor.utils import ensure_preprocessing_resources
+    from sklearn.metrics import adjusted_rand_score
+
+    for mode in MODES:
+        ensure_preprocessing_resources(mode)
+
+    temp_dir = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        corpus = get_texts(num_documents, num_paragraphs)
+        store = PackStore(os.path.join(temp_dir, 'documents'))
+        for guid, lines in corpus.items():
+            store.write(guid, lines)
+        store.close()
+
+        texts = list(corpus.values())
+        tokens = sum(len(line.split()) for lines in texts for line in lines)
+        results = {'meta': get_meta(), 'documents': num_documents, 'tokens': tokens, 'modes': {}}
+
+        prepared = {}
+        for mode in MODES:
+            seconds, prepared[mode] = measure_preparation(texts, mode, processes, temp_dir)
+            results['modes'][mode] = {'seconds': seconds, 'tokens_per_second': tokens / seconds}
+        results['speedup'] = results['modes'][NLTK]['seconds'] / results['modes'][FAST]['seconds']
+        results['lemma_agreement'] = get_agreement(prepared[NLTK], prepared[FAST])
+
+        models, subjects = {}, {}
+        for mode in MODES:
+            models[mode], subjects[mode] = train(mode, num_documents, num_topics, processes, temp_dir)
+            generated = [get_corpus_topic(guid) for guid in corpus]
+            results['modes'][mode].update({
+                'train_seconds': models[mode].get_status()['seconds'],
+                'perplexity': models[mode].get_status()['phases'][-1]['perplexity'],
+                'adjusted_rand_index': adjusted_rand_score(generated, [subjects[mode][guid] for guid in corpus])
+            })
+
+        matches = match_topics(models[NLTK].get_top_words(count=top_words),
+                               models[FAST].get_top_words(count=top_words))
+        matched = {topic: other_topic for topic, other_topic, _ in matches}
+        results['top_words_similarity'] = sum(similarity for _, _, similarity in matches) / len(matches)
+        results['assignment_agreement'] = sum(
+            matched.get(subjects[NLTK][guid]) == subjects[FAST][guid] for guid in corpus) / len(corpus)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='fast against NLTK preprocessing benchmark')
+    parser.add_argument('-n', '--documents', help='number of documents', type=int, default=200)
+    parser.add_argument('-s', '--size', help='paragraphs per document: {} or a number'.format(', '.join(SIZES)),
+                        default='small')
+    parser.add_argument('-t', '--topics', help='number of topics', type=int, default=6)
+    parser.add_argument('-p', '--processes', help='text preparation processes', type=int, default=1)
+    parser.add_argument('-o', '--output', help='write the results to this JSON file', type=str)
+    args = parser.parse_args()
+
+    results = run(args.documents, get_size(args.size), args.topics, processes=args.processes)
+    for mode, result in results['modes'].items():
+        print('{:<6} {:>12,.0f} tokens/s  train {:>7.2f}s  perplexity {:>10.2f}  ARI {:.3f}'.format(
+            mode, result['tokens_per_second'], result['train_seconds'], result['perplexity'],
+            result['adjusted_rand_index']))
+    print('speedup              {:.1f}x'.format(results['speedup']))
+    print('lemma agreement      {:.3f}'.format(results['lemma_agreement']))
+    print('top words similarity {:.3f}'.format(results['top_words_similarity']))
+    print('assignment agreement {:.3f}'.format(results['assignment_agreement']))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+'''
+Local stand-in for the document service: serves the synthetic corpus of benchmarks.corpus at the
+same path as the real service, with tunable latency and error rate. Point the loader at it with
+
+    python -m benchmarks.server -p 8089 -l 0.05 -e 0.01
+    DOCUMENT_URL=http://127.0.0.1:8089/document/v1/rawxml/{} python -m extractor.loader -f guids.txt
+'''
+
+import argparse
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.corpus import SIZES, get_size, make_corpus_xml, make_guid
+
+PATH_PREFIX = '/document/v1/rawxml/'
+
+class DocumentServer(object):
+    '''
+    Serves every guid as a generated document of num_paragraphs paragraphs. Each response is
+    delayed by latency seconds plus up to jitter seconds, and error_rate of the requests fail
+    with 503. Use it as a context manager to run it on a background thread.
+    '''
+    def __init__(self, port=0, num_paragraphs=SIZES['medium'], latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.num_paragraphs = num_paragraphs
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._documents = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+        server = self
+        class Handler(DocumentRequestHandler):
+            document_server = server
+
+        self._http_server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._http_server.daemon_threads = True
+
+    @property
+    def port(self):
+        return self._http_server.server_address[1]
+
+    @property
+    def url(self):
+        # the loader URL template
+        return 'http://127.0.0.1:{}{}{{}}'.format(self.port, PATH_PREFIX)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._http_server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._http_server.shutdown()
+        self._http_server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def serve_forever(self):
+        try:
+            self._http_server.serve_forever()
+        finally:
+            self._http_server.server_close()
+
+    def respond(self, guid):
+        '''
+        Returns (status, body) for a request of the guid.
+        '''
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.random() * self.jitter
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            return 503, b'Service Unavailable'
+
+        return 200, self.get_document(guid)
+
+    def get_document(self, guid):
+        with self._lock:
+            document = self._documents.get(guid)
+        if document is None:
+            document = make_corpus_xml(guid, self.num_paragraphs).encode('utf-8')
+            with self._lock:
+                self._documents[guid] = document
+        return document
+
+class DocumentRequestHandler(BaseHTTPRequestHandler):
+    document_server = None
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if not path.startswith(PATH_PREFIX) or len(path) == len(PATH_PREFIX):
+            status, body = 404, b'Not Found'
+        else:
+            status, body = self.document_server.respond(path[len(PATH_PREFIX):])
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml' if status == 200 else 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description='local stand-in for the document service')
+    parser.add_argument('-p', '--port', help='port to listen on', type=int, default=8089)
+    parser.add_argument('-s', '--size', help='paragraphs per document: {} or a number'.format(
+        ', '.join(SIZES)), default='medium')
+    parser.add_argument('-l', '--latency', help='seconds to wait before every response', type=float, default=0.0)
+    parser.add_argument('-j', '--jitter', help='up to this many seconds added to the latency', type=float,
+                        default=0.0)
+    parser.add_argument('-e', '--error-rate', help='share of requests that fail with 503', type=float, default=0.0)
+    parser.add_argument('-g', '--guids', help='write a file with this many corpus guids for the loader', type=int,
+                        default=0)
+    args = parser.parse_args()
+
+    server = DocumentServer(args.port, get_size(args.size), args.latency, args.jitter, args.error_rate)
+    if args.guids:
+        with open('guids.txt', 'w') as guids_file:
+            guids_file.write('\n'.join(make_guid(idx) for idx in range(args.guids)) + '\n')
+        print('{} guids written to guids.txt'.format(args.guids))
+
+    print('DOCUMENT_URL={}'.format(server.url))
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
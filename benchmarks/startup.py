@@ -0,0 +1,71 @@
+'''
+Startup benchmark: wall time of "--version" for every entry point, plus the list of heavy modules
+that got imported on the way. Exits with an error when an entry point is over the budget.
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ENTRY_POINTS = ('extractor.loader', 'api.topic_modelling', 'knowledge_extractor.models')
+
+HEAVY_MODULES = ('artm', 'falcon', 'falcon_cors', 'nltk', 'numpy', 'pandas', 'scipy', 'sklearn', 'waitress')
+
+STARTUP_BUDGET = float(os.environ.get('STARTUP_BUDGET', '1.0'))
+
+PROBE = '''
+import json, runpy, sys
+sys.argv = [{module!r}, '--version']
+try:
+    runpy.run_module({module!r}, run_name='__main__')
+except SystemExit:
+    pass
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps(heavy))
+'''
+
+def get_root_dir():
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run_entry_point(module):
+    '''
+    Runs "python -m <module> --version" in a fresh interpreter and returns (seconds, heavy modules).
+    '''
+    code = PROBE.format(module=module, heavy=HEAVY_MODULES)
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=get_root_dir())
+    elapsed = time.perf_counter() - start
+
+    return elapsed, json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def run(repeat=3):
+    results = {}
+    for module in ENTRY_POINTS:
+        timings = []
+        for _ in range(repeat):
+            elapsed, heavy = run_entry_point(module)
+            timings.append(elapsed)
+        results[module] = {'seconds': min(timings), 'heavy_modules': heavy}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='entry point startup benchmark')
+    parser.add_argument('-r', '--repeat', help='number of runs per entry point', type=int, default=3)
+    parser.add_argument('-b', '--budget', help='startup budget in seconds', type=float, default=STARTUP_BUDGET)
+    args = parser.parse_args()
+
+    over_budget = False
+    for module, result in run(args.repeat).items():
+        over_budget = over_budget or result['seconds'] > args.budget
+        print('{:<28} {:>6.3f}s  heavy modules: {}'.format(
+            module, result['seconds'], ', '.join(result['heavy_modules']) or '-'))
+
+    if over_budget:
+        print('startup budget of {}s exceeded'.format(args.budget))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+'''
+Benchmark suite: throughput of every stage of the pipeline on the synthetic corpus, without the
+real document service.
+
+- loader: documents/s loaded from the local stand-in of benchmarks.server
+- extraction: documents, paragraphs and MB/s through DocumentRawLoader._extract_text_from_xml
+- text_prepare: tokens/s through text_prepare_batch with a cold lemma cache
+- train: TopicModel.train seconds for every corpus size, with the time of each training stage
+- profile: get_topic_profile latency of the models trained by the train benchmark
+
+Results are written as JSON with -o, and compared with an earlier run with -c:
+
+    python -m benchmarks.suite -o before.json
+    python -m benchmarks.suite -o after.json -c before.json
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+
+from benchmarks.corpus import SIZES, get_size, make_corpus_xml, make_documents, make_guid
+from benchmarks.server import DocumentServer
+
+DEFAULT_OPTIONS = {
+    'documents': 200,
+    'paragraphs': SIZES['medium'],
+    'concurrency': 8,
+    'latency': 0.02,
+    'error_rate': 0.01,
+    'corpus_sizes': (50, 100, 200),
+    'topics': 10,
+    'processes': 1,
+    'repeat': 3,
+}
+
+def get_root_dir():
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def get_meta():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=get_root_dir(),
+                                         stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+def get_texts(num_documents, num_paragraphs):
+    '''
+    Returns {guid: paragraphs} of the corpus, extracted the way the loader does it.
+    '''
+    from extractor.loader import DocumentRawLoader
+
+    loader = DocumentRawLoader(doc_guids=[], store=object(), journal=object())
+    return OrderedDict(
+        (guid, loader._extract_text_from_xml(make_corpus_xml(guid, num_paragraphs).encode('utf-8')))
+        for guid in (make_guid(idx) for idx in range(num_documents))
+    )
+
+@contextlib.contextmanager
+def cold_lemma_cache(temp_dir):
+    '''
+    Replaces the process lemma cache with an empty one, so that earlier runs do not speed up this one.
+    '''
+    from knowledge_extractor import utils
+
+    saved = (utils.lemma_cache, utils._lemma_cache_loaded)
+    utils.lemma_cache = utils.LemmaCache(file_name=os.path.join(temp_dir, 'lemmas.tsv.gz'))
+    utils._lemma_cache_loaded = True
+    try:
+        yield utils.lemma_cache
+    finally:
+        utils.lemma_cache, utils._lemma_cache_loaded = saved
+
+def bench_loader(options, temp_dir):
+    from extractor.journal import LoadJournal
+    from extractor.loader import DocumentRawLoader
+    from extractor.store import PackStore
+
+    doc_guids = [make_guid(idx) for idx in range(options['documents'])]
+    server = DocumentServer(num_paragraphs=options['paragraphs'], latency=options['latency'],
+                            error_rate=options['error_rate'])
+    with server:
+        for guid in doc_guids:
+            # generated up front, so that the server does not slow down the first requests
+            server.get_document(guid)
+
+        loader = DocumentRawLoader(
+            doc_guids=doc_guids,
+            concurrency=options['concurrency'],
+            store=PackStore(os.path.join(temp_dir, 'loader')),
+            journal=LoadJournal(os.path.join(temp_dir, 'loader_journal.log')),
+            retry_backoff=0.01,
+            url=server.url
+        )
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            loader.load()
+        seconds = time.perf_counter() - start
+
+    return {
+        'documents': len(doc_guids),
+        'loaded': len(doc_guids) - len(loader.store.missing(doc_guids)),
+        'requests': server.requests,
+        'errors': server.errors,
+        'seconds': seconds,
+        'documents_per_second': len(doc_guids) / seconds
+    }
+
+def bench_extraction(options, temp_dir):
+    from extractor.loader import DocumentRawLoader
+
+    loader = DocumentRawLoader(doc_guids=[], store=object(), journal=object())
+    documents = [make_corpus_xml(make_guid(idx), options['paragraphs']).encode('utf-8')
+                 for idx in range(min(options['documents'], 50))]
+
+    timings = []
+    for _ in range(options['repeat']):
+        start = time.perf_counter()
+        paragraphs = sum(len(loader._extract_text_from_xml(xml)) for xml in documents)
+        timings.append(time.perf_counter() - start)
+    seconds = min(timings)
+
+    return {
+        'documents': len(documents),
+        'paragraphs': paragraphs,
+        'seconds': seconds,
+        'documents_per_second': len(documents) / seconds,
+        'paragraphs_per_second': paragraphs / seconds,
+        'megabytes_per_second': sum(len(xml) for xml in documents) / 1024 / 1024 / seconds
+    }
+
+def bench_text_prepare(options, temp_dir):
+    from knowledge_extractor.utils import ensure_preprocessing_resources, text_prepare_batch
+
+    ensure_preprocessing_resources()
+    texts = list(get_texts(min(options['documents'], 50), options['paragraphs']).values())
+    tokens = sum(len(line.split()) for lines in texts for line in lines)
+
+    with cold_lemma_cache(temp_dir) as cache:
+        start = time.perf_counter()
+        text_prepare_batch(texts, processes=options['processes'])
+        seconds = time.perf_counter() - start
+        lemma_cache = cache.stats()
+
+    return {
+        'documents': len(texts),
+        'tokens': tokens,
+        'seconds': seconds,
+        'tokens_per_second': tokens / seconds,
+        'lemma_cache': lemma_cache
+    }
+
+def bench_train(options, temp_dir):
+    '''
+    Trains a model per corpus size and keeps them for the profile benchmark.
+    '''
+    from extractor.metrics import STAGE_SECONDS, get_metrics
+    from extractor.store import PackStore
+    from knowledge_extractor.cache import PreparedTextCache
+    from knowledge_extractor.models import TopicModel
+
+    store = PackStore(os.path.join(temp_dir, 'train'))
+    texts = get_texts(max(options['corpus_sizes']), options['paragraphs'])
+    for guid, lines in texts.items():
+        store.write(guid, lines)
+
+    results = OrderedDict()
+    options['_models'] = OrderedDict()
+    with cold_lemma_cache(temp_dir):
+        for size in sorted(options['corpus_sizes']):
+            prepared_cache = PreparedTextCache(os.path.join(temp_dir, 'prepared_{}.sqlite'.format(size)))
+            model = TopicModel('benchmark_{}'.format(size), make_documents(size), num_of_topics=options['topics'],
+                               store=store, prepared_cache=prepared_cache, processes=options['processes'])
+
+            get_metrics().drain()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                model.train()
+            seconds = time.perf_counter() - start
+
+            stages = OrderedDict(
+                (labels['stage'], value['sum']) for kind, name, labels, value in get_metrics().drain()
+                if name == STAGE_SECONDS and labels.get('stage') in ('prepare', 'vectorise', 'fit')
+            )
+            results[str(size)] = {'seconds': seconds, 'stages': stages,
+                                  'passes': sum(phase['passes'] for phase in model.get_status()['phases'])}
+            options['_models'][size] = model
+
+    return results
+
+def bench_profile(options, temp_dir):
+    models = options.get('_models')
+    if not models:
+        raise RuntimeError('the profile benchmark needs the models of the train benchmark')
+
+    results = OrderedDict()
+    for size, model in models.items():
+        timings = []
+        for _ in range(options['repeat']):
+            # the profile is computed again on every call
+            start = time.perf_counter()
+            model.get_topic_profile()
+            timings.append(time.perf_counter() - start)
+        results[str(size)] = {'min_seconds': min(timings), 'median_seconds': statistics.median(timings)}
+
+    return results
+
+BENCHMARKS = OrderedDict((
+    ('loader', bench_loader),
+    ('extraction', bench_extraction),
+    ('text_prepare', bench_text_prepare),
+    ('train', bench_train),
+    ('profile', bench_profile),
+))
+
+def run(names=None, **options):
+    '''
+    Runs the benchmarks and returns their results; a benchmark that fails records its error and
+    the others still run.
+    '''
+    options = dict(DEFAULT_OPTIONS, **options)
+    results = {
+        'meta': get_meta(),
+        'options': dict(options),
+        'benchmarks': OrderedDict()
+    }
+
+    temp_dir = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        for name in names or BENCHMARKS:
+            try:
+                results['benchmarks'][name] = BENCHMARKS[name](options, temp_dir)
+            except:
+                error = sys.exc_info()[1]
+                results['benchmarks'][name] = {'error': '{}: {}'.format(error.__class__.__name__, error)}
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return results
+
+def flatten(value, prefix=''):
+    '''
+    Returns {"benchmark.key.subkey": number} for the numbers of a result.
+    '''
+    if isinstance(value, dict):
+        flat = OrderedDict()
+        for key, item in value.items():
+            flat.update(flatten(item, '{}.{}'.format(prefix, key) if prefix else str(key)))
+        return flat
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    return {}
+
+def compare(baseline, results):
+    '''
+    Returns [(metric, baseline value, value, ratio)] for the metrics found in both runs.
+    '''
+    before = flatten(baseline['benchmarks'])
+    return [(key, before[key], value, value / before[key] if before[key] else None)
+            for key, value in flatten(results['benchmarks']).items() if key in before]
+
+def main():
+    parser = argparse.ArgumentParser(description='pipeline benchmark suite on a synthetic corpus')
+    parser.add_argument('-b', '--benchmarks', help='benchmarks to run', nargs='+', choices=list(BENCHMARKS))
+    parser.add_argument('-n', '--documents', help='documents for the loader benchmark', type=int,
+                        default=DEFAULT_OPTIONS['documents'])
+    parser.add_argument('-s', '--size', help='paragraphs per document: {} or a number'.format(', '.join(SIZES)),
+                        default='medium')
+    parser.add_argument('--concurrency', help='loader concurrency', type=int, default=DEFAULT_OPTIONS['concurrency'])
+    parser.add_argument('--latency', help='seconds the stand-in waits before every response', type=float,
+                        default=DEFAULT_OPTIONS['latency'])
+    parser.add_argument('--error-rate', help='share of stand-in responses that fail', type=float,
+                        default=DEFAULT_OPTIONS['error_rate'])
+    parser.add_argument('--corpus-sizes', help='documents per trained model', type=int, nargs='+',
+                        default=list(DEFAULT_OPTIONS['corpus_sizes']))
+    parser.add_argument('--processes', help='text preparation processes', type=int,
+                        default=DEFAULT_OPTIONS['processes'])
+    parser.add_argument('-r', '--repeat', help='runs of the extraction and profile benchmarks', type=int,
+                        default=DEFAULT_OPTIONS['repeat'])
+    parser.add_argument('-o', '--output', help='write the results to this JSON file', type=str)
+    parser.add_argument('-c', '--compare', help='compare with the results of an earlier run', type=str)
+    args = parser.parse_args()
+
+    names = args.benchmarks
+    if names and 'profile' in names and 'train' not in names:
+        names = ['train'] + names
+
+    results = run(names, documents=args.documents, paragraphs=get_size(args.size), concurrency=args.concurrency,
+                  latency=args.latency, error_rate=args.error_rate, corpus_sizes=tuple(args.corpus_sizes),
+                  processes=args.processes, repeat=args.repeat)
+
+    for key, value in flatten(results['benchmarks']).items():
+        print('{:<48} {:>14.4f}'.format(key, value))
+    for name, result in results['benchmarks'].items():
+        if 'error' in result:
+            print('{:<48} {}'.format(name, result['error']))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(results, output, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        print('\ncompared with {} ({})'.format(args.compare, baseline['meta'].get('commit')))
+        for key, before, after, ratio in compare(baseline, results):
+            print('{:<48} {:>14.4f} {:>14.4f} {:>8}'.format(
+                key, before, after, '{:.2f}x'.format(ratio) if ratio is not None else '-'))
+
+if __name__ == '__main__':
+    main()
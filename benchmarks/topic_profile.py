@@ -0,0 +1,88 @@
+'''
+Topic profile micro-benchmark: seconds to compute p(t|d) and look up the document metadata for a
+synthetic phi/theta, for the legacy cell by cell loop and for the vectorised computation.
+'''
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from knowledge_extractor.models import TopicModel, get_topic_profile_matrix
+
+def make_model_output(num_documents, num_topics, num_items=None, seed=0):
+    '''
+    Returns (phi of the doc_guid modality, theta, documents) shaped like the BigARTM output.
+    '''
+    random = np.random.RandomState(seed)
+    topics = ['sbj{}'.format(i) for i in range(num_topics - 1)] + ['bcg']
+    guids = ['I{:032x}'.format(i) for i in range(num_documents)]
+
+    phi = pd.DataFrame(random.dirichlet(np.ones(num_documents), num_topics).T, index=guids, columns=topics)
+    theta = pd.DataFrame(random.dirichlet(np.ones(num_topics), num_items or num_documents).T, index=topics)
+    documents = [{'docGuid': guid, 'rank': rank, 'title': guid} for rank, guid in enumerate(guids)]
+
+    return phi, theta, documents
+
+def legacy_topic_profile(phi_a, theta, documents):
+    p_t = theta.sum(axis=1)
+    df_p_t = pd.DataFrame(p_t / p_t.sum(axis=0))
+    df_p_t.columns = ['probability']
+
+    topic_profile = pd.DataFrame(index=phi_a.index.copy(), columns=df_p_t.index.copy())
+    for a_idx, _ in enumerate(topic_profile.index):
+        total = np.sum([phi_a.iloc[a_idx][col] * df_p_t.loc[col]['probability'] for col in topic_profile.columns])
+
+        for t_idx, topic in enumerate(topic_profile.columns):
+            prob = (phi_a.iloc[a_idx][topic] * df_p_t.loc[topic]['probability']) / total
+            # the original chained assignment no longer writes through with copy-on-write pandas
+            topic_profile.iat[a_idx, t_idx] = prob
+
+    found = []
+    for doc_guid in topic_profile.index:
+        docs = [d for d in documents if d['docGuid'] == doc_guid]
+        found.append(docs[0] if len(docs) else None)
+
+    return topic_profile.values.astype(np.float64), found
+
+def vectorised_topic_profile(phi_a, theta, documents):
+    model = TopicModel('benchmark', documents, store=object(), prepared_cache=object())
+    topic_profile = get_topic_profile_matrix(phi_a.values, theta.loc[list(phi_a.columns)].values)
+    found = [model._get_document(doc_guid) for doc_guid in phi_a.index]
+
+    return topic_profile, found
+
+def measure(func, args, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), output
+
+def run(num_documents=1000, num_topics=10, repeat=3):
+    args = make_model_output(num_documents, num_topics)
+
+    legacy_seconds, (legacy_profile, legacy_found) = measure(legacy_topic_profile, args, 1)
+    seconds, (profile, found) = measure(vectorised_topic_profile, args, repeat)
+
+    if not np.allclose(profile, legacy_profile) or found != legacy_found:
+        raise AssertionError('vectorised topic profile differs from the legacy computation')
+
+    return {'legacy (cell by cell)': legacy_seconds, 'vectorised': seconds}
+
+def main():
+    parser = argparse.ArgumentParser(description='topic profile micro-benchmark')
+    parser.add_argument('-n', '--documents', help='number of documents', type=int, default=1000)
+    parser.add_argument('-t', '--topics', help='number of topics', type=int, default=10)
+    parser.add_argument('-r', '--repeat', help='number of runs of the vectorised computation', type=int, default=3)
+    args = parser.parse_args()
+
+    results = run(args.documents, args.topics, args.repeat)
+    for name, seconds in results.items():
+        print('{:<28} {:>10.4f}s'.format(name, seconds))
+    print('speedup {:.0f}x'.format(results['legacy (cell by cell)'] / results['vectorised']))
+
+if __name__ == '__main__':
+    main()
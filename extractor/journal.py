@@ -0,0 +1,176 @@
+'''
+Load journal module.
+
+Records the outcome of every document load so that failed documents can be retried later and
+an interrupted run can resume without checking every document again. The journal lives in the
+folder of its store, and every load records the kind of the store, so that documents loaded into
+a store of another kind are checked against the store instead.
+'''
+
+import heapq
+import json
+import os
+import threading
+import time
+
+from datetime import datetime
+
+from .store import DOCUMENTS_DIR
+
+JOURNAL_FILE_NAME = 'load_journal.log'
+
+LOADED = 'loaded'
+FAILED = 'failed'
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+class LoadJournal(object):
+    '''
+    Append-only journal with one JSON record per load attempt:
+    {"guid": ..., "status": "loaded" | "failed", "attempt": ..., "elapsed": ..., "error": ..., "store": ...,
+     "time": ...}
+    The latest record of a guid decides its state.
+    '''
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._lock = threading.Lock()
+        self._states = None
+
+    def record_success(self, guid, elapsed, attempt=1, store=None):
+        record = {
+            'guid': guid,
+            'status': LOADED,
+            'attempt': attempt,
+            'elapsed': round(elapsed, 3)
+        }
+        if store is not None:
+            record['store'] = store
+        self._append(record)
+
+    def record_failure(self, guid, elapsed, error, attempt=1):
+        self._append({
+            'guid': guid,
+            'status': FAILED,
+            'attempt': attempt,
+            'elapsed': round(elapsed, 3),
+            'error': str(error)
+        })
+
+    def loaded(self, store=None):
+        '''
+        Returns the guids loaded, into a store of the given kind only when one is given. Records
+        written before the kind was recorded do not count for any kind.
+        '''
+        return set(guid for guid, record in self._get_states().items()
+                   if record['status'] == LOADED and (store is None or record.get('store') == store))
+
+    def failed(self):
+        '''
+        Returns guid -> latest failure record for every guid that has not been loaded since.
+        '''
+        return dict((guid, record) for guid, record in self._get_states().items() if record['status'] == FAILED)
+
+    def merge(self, other, store=None):
+        '''
+        Appends the latest record of every guid of the other journal, except for guids this journal
+        has loaded already. With store, the loaded records are marked as loaded into a store of
+        that kind, the one the documents were copied to. Returns the number of records appended.
+        '''
+        states = self._get_states()
+        records = []
+        for guid, record in other._get_states().items():
+            if store is not None and record['status'] == LOADED:
+                record = dict(record, store=store)
+            if states.get(guid, {}).get('status') != LOADED and states.get(guid) != record:
+                records.append(record)
+        self._write(records)
+        return len(records)
+
+    def _append(self, record):
+        record['time'] = datetime.now().isoformat()
+        self._write([record])
+
+    def _write(self, records):
+        if not records:
+            return
+
+        with self._lock:
+            directory = os.path.dirname(self.file_name)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            with open(self.file_name, 'a', encoding='utf-8') as journal:
+                journal.write(''.join(json.dumps(record) + '\n' for record in records))
+
+            if self._states is not None:
+                for record in records:
+                    self._states[record['guid']] = record
+
+    def _get_states(self):
+        with self._lock:
+            if self._states is None:
+                self._states = {}
+                if os.path.isfile(self.file_name):
+                    with open(self.file_name, encoding='utf-8') as journal:
+                        for line in journal:
+                            try:
+                                record = json.loads(line)
+                            except ValueError:
+                                # a record cut short by a crash
+                                continue
+                            self._states[record['guid']] = record
+
+            return dict(self._states)
+
+class RetryQueue(object):
+    '''
+    Deferred retries with exponential backoff: the n-th retry of a guid becomes due
+    backoff * 2 ** (n - 1) seconds after the failure, but never later than max_delay.
+    '''
+    def __init__(self, backoff=2.0, max_delay=300.0):
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, guid, attempt):
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_delay)
+        with self._lock:
+            heapq.heappush(self._heap, (time.monotonic() + delay, guid, attempt + 1))
+
+    def pop_due(self):
+        '''
+        Waits until the earliest retry is due and returns every (guid, attempt) that is due by then.
+        '''
+        with self._lock:
+            if not self._heap:
+                return []
+            delay = self._heap[0][0] - time.monotonic()
+
+        if delay > 0:
+            time.sleep(delay)
+
+        due = []
+        with self._lock:
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                _, guid, attempt = heapq.heappop(self._heap)
+                due.append((guid, attempt))
+
+        return due
+
+def get_journal(path=None):
+    '''
+    Returns the journal shared by all loaders of the process that use the same documents folder,
+    the path of their store.
+    '''
+    file_name = os.path.abspath(os.path.join(path or DOCUMENTS_DIR, JOURNAL_FILE_NAME))
+
+    with _journals_lock:
+        if file_name not in _journals:
+            _journals[file_name] = LoadJournal(file_name)
+        return _journals[file_name]
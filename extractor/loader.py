@@ -3,19 +3,23 @@ Loader module.
 """
 
 import argparse
-import inspect
 import os
 import random
-import re
 import requests
 import sys
-
-import xml.etree.ElementTree as ET
+import threading
+import time
+import zlib
 
 from . import __version__
+from .journal import RetryQueue, get_journal
+from .metrics import STAGE_SECONDS, get_metrics
+from .profiling import enable_profiling, profiled
+from .paragraphs import get_backend, get_paragraph_text
+from .store import get_store
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-
-re_clean = re.compile('<.*?>')
+from urllib.parse import urlparse
 
 USER_AGENTS = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10.7; rv:11.0) Gecko/20100101 Firefox/11.0',
                'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:22.0) Gecko/20100 101 Firefox/22.0',
@@ -25,7 +29,22 @@ USER_AGENTS = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10.7; rv:11.0) Gecko/2010
                ('Mozilla/5.0 (Windows; Windows NT 6.1) AppleWebKit/536.5 (KHTML, like Gecko) Chrome/19.0.1084.46'
                 'Safari/536.5'), )
 
-URL = 'http://document.int.next.qed.westlaw.com/document/v1/rawxml/{}?websitehost=next.qed.westlaw.com'
+CHUNK_SIZE = 64 * 1024
+
+# connection level retries done inline by the HTTP adapter, anything else goes to the retry queue
+MAX_RETRIES = 3
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 2.0
+
+# guids are read, checked against the journal and the store and loaded this many at a time
+LOAD_CHUNK_SIZE = 10000
+
+# {} is replaced by the document guid; DOCUMENT_URL points the loader at another service, e.g. the
+# stand-in of benchmarks.server
+URL = os.environ.get(
+    'DOCUMENT_URL',
+    'http://document.int.next.qed.westlaw.com/document/v1/rawxml/{}?websitehost=next.qed.westlaw.com'
+)
 
 def print_now(message, timestamp = True):
     if timestamp:
@@ -33,101 +52,301 @@ def print_now(message, timestamp = True):
     print(message)
     sys.stdout.flush()
 
+def parse_shard(value):
+    '''
+    Parses "INDEX/COUNT" into (index, count).
+    '''
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError('Shard must be INDEX/COUNT, e.g. 0/4: {}'.format(value))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError('Shard index must be between 0 and COUNT - 1: {}'.format(value))
+    return index, count
+
+def in_shard(guid, shard):
+    '''
+    Whether the guid belongs to the (index, count) shard. The guid hash is the same on every
+    machine, so nodes loading the same list never load the same document.
+    '''
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(guid.encode('utf-8')) % count == index
+
+def chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class RateLimiter(object):
+    '''
+    Spaces out requests so that no more than `rate` requests per second go to the same host.
+    '''
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    def wait(self, host):
+        if not self.rate:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + 1.0 / self.rate
+
+        if slot > now:
+            time.sleep(slot - now)
+
 class DocumentRawLoader(object):
-    def __init__(self, doc_guids_file=None, doc_guids=None):
+    def __init__(self, doc_guids_file=None, doc_guids=None, concurrency=1, rate_limit=None, xml_backend=None,
+                 store=None, journal=None, max_attempts=MAX_ATTEMPTS, retry_backoff=RETRY_BACKOFF, progress=None,
+                 url=None, shard=None, dedup=True):
+        # "-" reads the guids from stdin
         self.doc_guids_file = doc_guids_file
         self.doc_guids = doc_guids
+        # (index, count): only the guids of this shard are loaded
+        self.shard = shard
+        # every guid once per run; without dedup only once per chunk, which keeps memory bounded
+        self.dedup = dedup
+        self.xml_backend = get_backend(xml_backend)
+        self.store = store if store is not None else get_store()
+        # the journal of the folder of the store, so that it never describes another store
+        self.journal = journal if journal is not None else get_journal(self.store.path)
+        self.concurrency = max(1, concurrency or 1)
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.url = url or URL
+        self.max_attempts = max_attempts
+        self.retry_queue = RetryQueue(retry_backoff)
+        # called with ('fetched', documents available, documents requested) as documents arrive
+        self.progress = progress
+        self._fetched = 0
+        self._total = 0
+        self._progress_lock = threading.Lock()
+        self._session = None
+        self._session_lock = threading.Lock()
 
     def load(self):
-        doc_guids = self.doc_guids if self.doc_guids is not None else self._get_doc_guids()
-        counter = 0
         start_all = datetime.now()
-        for guid in doc_guids:
-            try:
-                if os.path.isfile(self._get_file_name(guid)):
-                    print_now('{} is already loaded'.format(guid))
-                    continue
 
-                start = datetime.now()
-                doc_xml = self._load_doc_by_guid(guid)
-                lines = self._extract_text_from_xml(doc_xml)
-                self._save_text(guid, lines)
-                print_now('{} loading took {}'.format(guid, (datetime.now() - start)))
-                counter += 1
-            except:
-                print_now('Failed to load doc with guid: {}, error: {}'.format(guid, sys.exc_info()))
-        
+        # the journal answers for documents loaded into this store by earlier runs, the store for
+        # anything else, e.g. documents loaded before DOCUMENT_STORE changed
+        loaded = self.journal.loaded(self.store.kind)
+        self._total = 0
+        self._fetched = 0
+        counter = 0
+        try:
+            for doc_guids in chunks(self._iter_doc_guids(), LOAD_CHUNK_SIZE):
+                missing = set(self.store.missing([guid for guid in doc_guids if guid not in loaded]))
+                for guid in doc_guids:
+                    if guid not in missing:
+                        print_now('{} is already loaded'.format(guid))
+                self._total += len(doc_guids)
+                self._report_fetched(len(doc_guids) - len(missing))
+
+                counter += self._load_guids([(guid, 1) for guid in doc_guids if guid in missing])
+            counter += self._process_retries()
+        finally:
+            self._close_session()
+
         print_now('{} documents loaded in {}'.format(counter, (datetime.now() - start_all)))
 
-    def _load_doc_by_guid(self, guid):
-        session = requests.session()
-        adapter = requests.adapters.HTTPAdapter(max_retries=20)
-        session.mount('https://', adapter)
-        session.mount('http://', adapter)
+    def retry_failed(self):
+        self.doc_guids = list(self.journal.failed().keys())
+        print_now('{} documents failed in previous runs'.format(len(self.doc_guids)))
+        self.load()
 
-        response = session.get(
-            URL.format(guid), 
-            headers={ 'User-Agent': random.choice(USER_AGENTS) }
-        ).text
+    def _load_guids(self, items):
+        if self.concurrency > 1:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                return sum(executor.map(lambda item: self._load_guid(*item), items))
 
-        session.close()
-        return response
+        return sum(self._load_guid(guid, attempt) for guid, attempt in items)
+
+    def _process_retries(self):
+        counter = 0
+        while len(self.retry_queue) > 0:
+            due = self.retry_queue.pop_due()
+            print_now('Retrying {} documents'.format(len(due)))
+            counter += self._load_guids(due)
+
+        return counter
+
+    def _load_guid(self, guid, attempt=1):
+        metrics = get_metrics()
+        start = datetime.now()
+        try:
+            with metrics.stage('fetch'):
+                lines = self._stream_text_by_guid(guid)
+                self._save_text(guid, lines)
+            self.journal.record_success(guid, (datetime.now() - start).total_seconds(), attempt, self.store.kind)
+            metrics.counter('documents_total', stage='fetch', outcome='loaded').inc()
+            print_now('{} loading took {}'.format(guid, (datetime.now() - start)))
+            self._report_fetched(1)
+            return 1
+        except:
+            error = sys.exc_info()[1]
+            metrics.counter('documents_total', stage='fetch', outcome='failed').inc()
+            self.journal.record_failure(guid, (datetime.now() - start).total_seconds(), repr(error), attempt)
+            if attempt < self.max_attempts:
+                self.retry_queue.push(guid, attempt)
+                print_now('Failed to load doc with guid: {} (attempt {}), will retry, error: {}'.format(
+                    guid, attempt, sys.exc_info()))
+            else:
+                print_now('Failed to load doc with guid: {}, error: {}'.format(guid, sys.exc_info()))
+            return 0
+
+    def _report_fetched(self, count):
+        if self.progress is None:
+            return
+        with self._progress_lock:
+            self._fetched += count
+            fetched = self._fetched
+        self.progress('fetched', fetched, self._total)
+
+    def _get_session(self):
+        # one keep-alive connection pool shared by all workers
+        with self._session_lock:
+            if self._session is None:
+                session = requests.session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_maxsize=self.concurrency,
+                    pool_block=True,
+                    max_retries=MAX_RETRIES
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+
+            return self._session
+
+    def _close_session(self):
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def _request_doc(self, guid):
+        url = self.url.format(guid)
+        self.rate_limiter.wait(urlparse(url).netloc)
+
+        return self._get_session().get(
+            url, 
+            headers={ 'User-Agent': random.choice(USER_AGENTS) },
+            stream=True
+        )
+
+    def _stream_text_by_guid(self, guid):
+        response = self._request_doc(guid)
+        try:
+            response.raise_for_status()
+            for text in self._extract_text_from_stream(response.iter_content(chunk_size=CHUNK_SIZE)):
+                yield text
+        finally:
+            response.close()
 
     def _extract_text_from_xml(self, xml):
-        tree = ET.fromstring(xml)
+        tree = self.xml_backend.fromstring(xml)
         nodes = tree.findall('.//paratext')
         result = []
         for n in nodes:
-            paragraph = []
-            for child in n.getchildren():
-                res = ET.tostring(child, encoding='unicode')
-                res = re.sub(re_clean, ' ', res)
-                res = res.replace('“', '').replace('”', '') \
-                        .replace('', '')
-
-                for line in res.split('\n'):
-                    line = line.strip()
-                    if len(line) > 0 and line.isdigit() == False:
-                        paragraph.append(line)
-            
-            text = ' '.join(paragraph).strip()
+            text = self._get_paragraph_text(n)
             
             if len(text) > 0:
                 result.append(text)
 
         return result
 
-    def _save_text(self, guid, lines):
-        file_name = self._get_file_name(guid)
+    def _extract_text_from_stream(self, chunks):
+        '''
+        Incrementally parses XML chunks and yields paragraph texts as soon as their paratext element
+        is closed. Everything outside of a paratext is detached from the tree once it has been parsed,
+        so memory use does not depend on the document size.
+        '''
+        parser = self.xml_backend.pull_parser()
+        parents = []
+        paratext_depth = 0
+        # parsing time without the time spent downloading or writing the paragraphs
+        parse_seconds = 0.0
+
+        def read_events():
+            nonlocal paratext_depth, parse_seconds
+            start = time.perf_counter()
+            for event, elem in parser.read_events():
+                if event == 'start':
+                    parents.append(elem)
+                    if elem.tag == 'paratext':
+                        paratext_depth += 1
+                    continue
 
-        with open(file_name, 'w', encoding='utf-8') as file:
-            for line in lines:
-                file.write(line + '\n')
+                parents.pop()
+                if elem.tag == 'paratext':
+                    paratext_depth -= 1
+                    text = self._get_paragraph_text(elem)
+                    if len(text) > 0:
+                        parse_seconds += time.perf_counter() - start
+                        yield text
+                        start = time.perf_counter()
 
-    def _get_file_name(self, guid):
-        parent_path = os.path.dirname(os.path.dirname(inspect.getfile(self.__class__)))
-        dir_path = os.path.join(
-            parent_path,
-            'documents')
+                if paratext_depth == 0 and len(parents) > 0:
+                    parents[-1].remove(elem)
+            parse_seconds += time.perf_counter() - start
 
-        if not os.path.isdir(dir_path):
-             os.makedirs(dir_path)
+        for chunk in chunks:
+            start = time.perf_counter()
+            parser.feed(chunk)
+            parse_seconds += time.perf_counter() - start
+            yield from read_events()
 
-        file_name = os.path.join(
-            dir_path,
-            '{}.txt'.format(guid)
-        )
+        start = time.perf_counter()
+        parser.close()
+        parse_seconds += time.perf_counter() - start
+        yield from read_events()
 
-        return file_name
+        get_metrics().histogram(STAGE_SECONDS, stage='parse').observe(parse_seconds)
+
+    def _get_paragraph_text(self, node):
+        return get_paragraph_text(node)
+
+    def _save_text(self, guid, lines):
+        self.store.write(guid, lines)
+
+    def _iter_doc_guids(self):
+        '''
+        Yields the guids of the shard once each, in the order of the list or the file. The guids
+        seen are kept for the whole run, about 100 bytes each, i.e. gigabytes for tens of millions
+        of guids. Without dedup they are kept for one chunk only: a guid repeated in a later chunk
+        is then skipped by the journal or the store check, unless it failed to load.
+        '''
+        seen = set()
+        guids = self.doc_guids if self.doc_guids is not None else self._read_doc_guids()
+        for guid in guids:
+            if not guid or guid in seen or not in_shard(guid, self.shard):
+                continue
+            if not self.dedup and len(seen) == LOAD_CHUNK_SIZE:
+                seen.clear()
+            seen.add(guid)
+            yield guid
+
+    def _read_doc_guids(self):
+        if self.doc_guids_file == '-':
+            for line in sys.stdin:
+                yield from self._get_doc_guids_from_line(line)
+            return
 
-    def _get_doc_guids(self):
-        doc_guids = []
         with open(self.doc_guids_file, 'r') as file:
             for line in file:
-                for guid in self._get_doc_guids_from_line(line):
-                    doc_guids.append(guid)
+                yield from self._get_doc_guids_from_line(line)
 
-        return doc_guids
+    def _get_doc_guids(self):
+        return list(self._read_doc_guids())
 
     def _get_doc_guids_from_line(self, line):
         guids = [guid.strip().replace('"', '') for guid in line.split(',') if len(line.strip()) > 0]
@@ -139,7 +358,24 @@ class DocumentRawLoader(object):
 def get_parser():
     parser = argparse.ArgumentParser(description='load documents and extract text')
 
-    parser.add_argument('-f', '--file', help='file with document guids', type=str)
+    parser.add_argument('-f', '--file', help='file with document guids, - for stdin', type=str)
+
+    parser.add_argument('-s', '--shard', help='load only the guids of shard INDEX of COUNT, e.g. 0/4', type=str)
+
+    parser.add_argument('--no-dedup', help='skip repeated guids within a chunk only, so that memory does not grow '
+                        'with the number of guids', action='store_true')
+
+    parser.add_argument('-c', '--concurrency', help='number of documents to load in parallel',
+                        type=int, default=1)
+
+    parser.add_argument('-r', '--rate-limit', help='max number of requests per second to the document service',
+                        type=float, default=None)
+
+    parser.add_argument('--retry-failed', help='load again documents that failed in previous runs',
+                        action='store_true')
+
+    parser.add_argument('--profile', help='write cProfile and tracemalloc dumps of the run to PROFILE_DIR',
+                        action='store_true')
 
     parser.add_argument('-v', '--version', help='displays the current version of errorguimonitor',
                         action='store_true')
@@ -154,19 +390,42 @@ def command_line_runner():
         print(__version__)
         return
 
+    if args['profile']:
+        enable_profiling()
+
+    shard = None
+    if args['shard']:
+        try:
+            shard = parse_shard(args['shard'])
+        except ValueError:
+            print(sys.exc_info()[1])
+            parser.print_help()
+            return
+
+    if args['retry_failed']:
+        loader = DocumentRawLoader(concurrency=args['concurrency'], rate_limit=args['rate_limit'], shard=shard)
+        with profiled('loader_retry_failed'):
+            loader.retry_failed()
+        print_now('Metrics:\n{}'.format(get_metrics().summary()))
+        return
+
     if not args['file']:
         parser.print_help()
         return
 
     file = args['file']
 
-    if not os.path.isfile(file):
+    if file != '-' and not os.path.isfile(file):
         print('{} does not exist'.format(file))
         parser.print_help()
         return
 
-    loader = DocumentRawLoader(file)
-    loader.load()
+    loader = DocumentRawLoader(file, concurrency=args['concurrency'], rate_limit=args['rate_limit'], shard=shard,
+                               dedup=not args['no_dedup'])
+    with profiled('loader'):
+        loader.load()
+
+    print_now('Metrics:\n{}'.format(get_metrics().summary()))
 
 if __name__ == '__main__':
     command_line_runner()
\ No newline at end of file
@@ -0,0 +1,77 @@
+'''
+Merge module.
+
+Combines the documents folders of several loader nodes, e.g. the shards of one guid list loaded
+with --shard INDEX/COUNT, into one: the documents of every source store are copied into the
+target store and the records of every source journal are appended to the target journal.
+'''
+
+import argparse
+import os
+
+from datetime import datetime
+
+from .journal import JOURNAL_FILE_NAME, LoadJournal
+from .store import DOCUMENTS_DIR, create_store, migrate, open_store
+
+def merge(sources, target):
+    '''
+    Merges the source documents folders into the target store; returns (documents copied,
+    journal records appended).
+    '''
+    target_journal = LoadJournal(os.path.join(target.path, JOURNAL_FILE_NAME))
+
+    documents = records = 0
+    for path in sources:
+        source = open_store(path)
+        try:
+            documents += migrate(source, target)
+        finally:
+            source.close()
+
+        # after the documents, so that the journal never marks a document loaded that is not there
+        journal_file_name = os.path.join(path, JOURNAL_FILE_NAME)
+        if os.path.isfile(journal_file_name):
+            records += target_journal.merge(LoadJournal(journal_file_name), store=target.kind)
+
+    return documents, records
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='merge the documents folders of several loader nodes')
+
+    parser.add_argument('sources', help='documents folders to merge', nargs='+')
+
+    parser.add_argument('-t', '--target', help='documents folder to merge into', type=str, default=DOCUMENTS_DIR)
+
+    parser.add_argument('-k', '--kind', help='store kind of the target: directory or pack, DOCUMENT_STORE by default',
+                        type=str)
+
+    return parser
+
+def command_line_runner():
+    parser = get_parser()
+    args = vars(parser.parse_args())
+
+    target_path = os.path.abspath(args['target'])
+    for path in args['sources']:
+        if not os.path.isdir(path):
+            print('{} does not exist'.format(path))
+            parser.print_help()
+            return
+        if os.path.abspath(path) == target_path:
+            print('{} is the target folder'.format(path))
+            parser.print_help()
+            return
+
+    start = datetime.now()
+    compress = os.environ.get('DOCUMENT_STORE_COMPRESS', '1') != '0'
+    target = create_store(args['kind'], args['target'], compress=compress)
+    try:
+        documents, records = merge(args['sources'], target)
+    finally:
+        target.close()
+
+    print('{} documents and {} journal records merged in {}'.format(documents, records, datetime.now() - start))
+
+if __name__ == '__main__':
+    command_line_runner()
@@ -0,0 +1,227 @@
+'''
+Metrics module.
+
+Counters, latency histograms and gauges for the stages of the pipeline: fetch and parse in the
+loader, prepare, vectorise and fit in the training, profile in the API. Every process keeps its
+own registry (get_metrics()); worker processes hand theirs over with drain() and merge().
+'''
+
+import bisect
+import threading
+import time
+
+from contextlib import contextmanager
+
+# seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+STAGE_SECONDS = 'pipeline_stage_seconds'
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+    def merge(self, value):
+        self.inc(value)
+
+    def reset(self):
+        with self._lock:
+            self.value = 0
+
+class Histogram(object):
+    '''
+    Counts observations per bucket; bucket i counts the values up to buckets[i], the last one
+    everything above the largest bucket.
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        '''
+        Returns the upper bound of the bucket that holds the q-quantile.
+        '''
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = q * self.count
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+                total += count
+                if total >= rank:
+                    return bound
+            return float('inf')
+
+    def snapshot(self):
+        with self._lock:
+            return {'buckets': list(self.buckets), 'counts': list(self.counts), 'count': self.count, 'sum': self.sum}
+
+    def merge(self, snapshot):
+        if tuple(snapshot['buckets']) != self.buckets:
+            raise ValueError('Histogram buckets differ')
+        with self._lock:
+            self.counts = [a + b for a, b in zip(self.counts, snapshot['counts'])]
+            self.count += snapshot['count']
+            self.sum += snapshot['sum']
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.sum = 0.0
+
+class Gauge(object):
+    '''
+    Current value, either set explicitly or read from function when the metrics are collected.
+    '''
+    def __init__(self, function=None):
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.function() if self.function is not None else self.value
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def histogram(self, name, buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, labels, buckets)
+
+    def gauge(self, name, function=None, **labels):
+        gauge = self._get(Gauge, name, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    @contextmanager
+    def stage(self, stage):
+        '''
+        Times the block into the latency histogram of the stage.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(STAGE_SECONDS, stage=stage).observe(time.perf_counter() - start)
+
+    def snapshot(self):
+        '''
+        Returns [(kind, name, labels, value)] for every metric.
+        '''
+        with self._lock:
+            items = list(self._metrics.items())
+        return [(metric.__class__.__name__.lower(), name, dict(labels), metric.snapshot())
+                for (name, labels), metric in sorted(items, key=lambda item: item[0])]
+
+    def drain(self):
+        '''
+        Returns the counters and histograms and resets them, for a worker process to hand its
+        metrics over to the parent process.
+        '''
+        snapshot = [item for item in self.snapshot() if item[0] != 'gauge']
+        with self._lock:
+            for metric in self._metrics.values():
+                if not isinstance(metric, Gauge):
+                    metric.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        for kind, name, labels, value in snapshot:
+            if kind == 'counter':
+                self.counter(name, **labels).merge(value)
+            elif kind == 'histogram':
+                self.histogram(name, value['buckets'], **labels).merge(value)
+
+    def render(self):
+        '''
+        Returns the metrics in the Prometheus text format.
+        '''
+        lines = []
+        typed = set()
+        for kind, name, labels, value in self.snapshot():
+            if name not in typed:
+                lines.append('# TYPE {} {}'.format(name, kind))
+                typed.add(name)
+
+            if kind != 'histogram':
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+                continue
+
+            total = 0
+            for bound, count in zip(value['buckets'] + ['+Inf'], value['counts']):
+                total += count
+                bucket_labels = dict(labels, le=bound)
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(bucket_labels), total))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), value['count']))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), value['sum']))
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        '''
+        Returns one line per metric: the value of counters and gauges, and count, mean and the
+        bucket bounds of the median and the 95th percentile of histograms.
+        '''
+        lines = []
+        for kind, name, labels, value in self.snapshot():
+            label = '{}{}'.format(name, _format_labels(labels))
+            if kind != 'histogram':
+                lines.append('{:<60} {}'.format(label, value))
+                continue
+
+            histogram = self.histogram(name, value['buckets'], **labels)
+            mean = value['sum'] / value['count'] if value['count'] else 0.0
+            lines.append('{:<60} count {} mean {:.3f}s p50 <= {}s p95 <= {}s'.format(
+                label, value['count'], mean, histogram.quantile(0.5), histogram.quantile(0.95)))
+
+        return '\n'.join(lines)
+
+    def _get(self, kind, name, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._metrics:
+                self._metrics[key] = kind(*args)
+            return self._metrics[key]
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(key, value) for key, value in sorted(labels.items())))
+
+def get_metrics():
+    '''
+    Returns the metrics registry of the process.
+    '''
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = MetricsRegistry()
+        return _metrics
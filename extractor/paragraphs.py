@@ -0,0 +1,110 @@
+'''
+Paragraph text extraction module.
+
+Builds the text of a paratext element by walking text and tail nodes of the tree directly
+instead of serialising every child and stripping the tags with a regex. Works with both
+xml.etree.ElementTree and lxml trees.
+'''
+
+import os
+
+import xml.etree.ElementTree as ET
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+BACKENDS = ('etree', 'lxml')
+
+REMOVE_CHARS = str.maketrans('', '', '“”\ue484')
+
+class EtreeBackend(object):
+    name = 'etree'
+
+    def fromstring(self, xml):
+        return ET.fromstring(xml)
+
+    def pull_parser(self):
+        return ET.XMLPullParser(events=('start', 'end'))
+
+class LxmlBackend(object):
+    name = 'lxml'
+
+    def fromstring(self, xml):
+        if isinstance(xml, str):
+            # lxml refuses unicode strings that carry an encoding declaration, parse them as UTF-8 bytes
+            xml = xml.encode('utf-8')
+            return lxml_etree.fromstring(xml, self._get_parser(encoding='utf-8'))
+
+        return lxml_etree.fromstring(xml, self._get_parser())
+
+    def pull_parser(self):
+        return lxml_etree.XMLPullParser(events=('start', 'end'), remove_comments=True, remove_pis=True)
+
+    def _get_parser(self, encoding=None):
+        # comments and processing instructions are dropped to match what ElementTree produces
+        return lxml_etree.XMLParser(encoding=encoding, remove_comments=True, remove_pis=True)
+
+def get_backend(name=None):
+    if name is None:
+        name = os.environ.get('XML_BACKEND', 'etree')
+
+    if name == 'etree':
+        return EtreeBackend()
+
+    if name == 'lxml':
+        if lxml_etree is None:
+            raise ValueError('lxml backend is requested but lxml is not installed')
+        return LxmlBackend()
+
+    raise ValueError('Unknown XML backend: {}'.format(name))
+
+def get_paragraph_text(node):
+    '''
+    Returns the text of a paratext node: within each child every tag boundary becomes a space,
+    the text is split into lines, and blank or purely numeric lines (star page numbers) are dropped.
+
+    The output is identical to serialising each child with ET.tostring and removing the tags,
+    including the XML escaping of &, < and > that the serialised form carries.
+    '''
+    paragraph = []
+    for child in node:
+        parts = []
+        _collect_element(child, parts)
+
+        for line in ''.join(parts).translate(REMOVE_CHARS).split('\n'):
+            line = line.strip()
+            if len(line) > 0 and line.isdigit() == False:
+                paragraph.append(line)
+
+    return ' '.join(paragraph).strip()
+
+def _collect_element(elem, parts):
+    # the opening tag (or the whole tag of an empty element)
+    parts.append(' ')
+
+    if isinstance(elem.tag, str):
+        text = elem.text
+        if text:
+            parts.append(_escape(text))
+
+        for child in elem:
+            _collect_element(child, parts)
+
+        # the closing tag
+        if text or len(elem):
+            parts.append(' ')
+
+    tail = elem.tail
+    if tail:
+        parts.append(_escape(tail))
+
+def _escape(text):
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
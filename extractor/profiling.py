@@ -0,0 +1,159 @@
+'''
+Profiling module.
+
+Opt-in cProfile and tracemalloc dumps of a training job, a loader run or a single API request.
+Profiling is enabled for everything with PROFILE=1 (or the --profile flag of the command line
+tools) and for a single request with the X-Profile header. Every profiled block writes
+<time>_<name>.prof (load it with pstats or snakeviz) and <time>_<name>.alloc.txt (the largest
+allocations made while it ran) to PROFILE_DIR, and the oldest dumps are removed once the folder
+takes more than PROFILE_MAX_BYTES.
+'''
+
+import cProfile
+import os
+import re
+import tempfile
+import threading
+import tracemalloc
+
+from contextlib import contextmanager
+from datetime import datetime
+
+# only these values turn profiling on; anything else, e.g. a header sent by mistake, leaves it off
+ON_VALUES = ('1', 'true', 'yes', 'on')
+
+PROFILE = os.environ.get('PROFILE', '0').lower() in ON_VALUES
+# outside the source tree by default, so that dumps never end up next to the code
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'document_extractor_profiles'))
+PROFILE_MAX_BYTES = int(os.environ.get('PROFILE_MAX_BYTES', str(200 * 1024 * 1024)))
+PROFILE_TOP_ALLOCATIONS = int(os.environ.get('PROFILE_TOP_ALLOCATIONS', '50'))
+
+PROFILE_HEADER = 'X-Profile'
+
+# tracemalloc is process wide: it runs while at least one profiled block does, and is left alone
+# when something else started it
+_tracing = 0
+_own_tracing = False
+_tracing_lock = threading.Lock()
+
+def enable_profiling():
+    '''
+    Turns profiling on for the process and for the processes it starts later on.
+    '''
+    global PROFILE
+    PROFILE = True
+    os.environ['PROFILE'] = '1'
+
+def is_enabled(flag=None):
+    '''
+    A request or job flag wins over the PROFILE environment variable. True and the strings of
+    ON_VALUES turn profiling on, anything else turns it off.
+    '''
+    if flag is None:
+        return PROFILE
+    if isinstance(flag, bool):
+        return flag
+    return isinstance(flag, str) and flag.strip().lower() in ON_VALUES
+
+class Profiler(object):
+    '''
+    Profiles the calls of the current thread and the allocations of the whole process while the
+    block runs.
+    '''
+    def __init__(self, name, directory=None, max_bytes=PROFILE_MAX_BYTES):
+        self.name = re.sub(r'[^A-Za-z0-9_.-]', '_', name)[:100]
+        self.directory = directory or PROFILE_DIR
+        self.max_bytes = max_bytes
+        self.files = []
+        self._profile = None
+
+    def __enter__(self):
+        global _tracing, _own_tracing
+        with _tracing_lock:
+            if _tracing == 0:
+                _own_tracing = not tracemalloc.is_tracing()
+                if _own_tracing:
+                    tracemalloc.start()
+            _tracing += 1
+
+        self._profile = cProfile.Profile()
+        try:
+            self._profile.enable()
+        except ValueError:
+            # another profiler is active in this thread
+            self._profile = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _tracing
+        if self._profile is not None:
+            self._profile.disable()
+
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        with _tracing_lock:
+            _tracing -= 1
+            if _tracing == 0 and _own_tracing:
+                tracemalloc.stop()
+
+        self._write(snapshot, peak)
+        remove_old_dumps(self.directory, self.max_bytes)
+
+    def _write(self, snapshot, peak):
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = os.path.join(self.directory, '{}_{}'.format(datetime.now().strftime('%Y%m%d%H%M%S%f'), self.name))
+
+        if self._profile is not None:
+            self._profile.dump_stats('{}.prof'.format(prefix))
+            self.files.append('{}.prof'.format(prefix))
+
+        statistics = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        )).statistics('lineno')
+        with open('{}.alloc.txt'.format(prefix), 'w', encoding='utf-8') as allocations:
+            allocations.write('peak traced memory: {} bytes\n'.format(peak))
+            for statistic in statistics[:PROFILE_TOP_ALLOCATIONS]:
+                allocations.write('{}\n'.format(statistic))
+        self.files.append('{}.alloc.txt'.format(prefix))
+
+@contextmanager
+def profiled(name, enabled=None, directory=None):
+    '''
+    Profiles the block when enabled (see is_enabled), otherwise does nothing.
+    '''
+    if not is_enabled(enabled):
+        yield None
+        return
+
+    with Profiler(name, directory) as profiler:
+        yield profiler
+
+def remove_old_dumps(directory=None, max_bytes=PROFILE_MAX_BYTES):
+    '''
+    Removes the oldest dumps until the folder takes at most max_bytes.
+    '''
+    directory = directory or PROFILE_DIR
+    if not os.path.isdir(directory):
+        return 0
+
+    files = []
+    for name in os.listdir(directory):
+        file_name = os.path.join(directory, name)
+        if os.path.isfile(file_name) and (name.endswith('.prof') or name.endswith('.alloc.txt')):
+            stat = os.stat(file_name)
+            files.append((stat.st_mtime, name, file_name, stat.st_size))
+
+    total = sum(file[3] for file in files)
+    removed = 0
+    for _, _, file_name, size in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(file_name)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+
+    return removed
@@ -0,0 +1,323 @@
+'''
+Document store module.
+
+Extracted document text is kept either as one <guid>.txt file per document (directory store)
+or in an append-only pack file with a guid -> offset index (pack store).
+'''
+
+import argparse
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DIRECTORY = 'directory'
+PACK = 'pack'
+
+DOCUMENTS_DIR = os.environ.get(
+    'DOCUMENTS_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'documents')
+)
+
+PACK_FILE_NAME = 'documents.pack'
+INDEX_FILE_NAME = 'documents.idx'
+
+# documents up to this size are assembled in memory before they are appended to the pack
+SPOOL_SIZE = 8 * 1024 * 1024
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+class DirectoryStore(object):
+    '''
+    Keeps every document in its own <guid>.txt file.
+    '''
+    kind = DIRECTORY
+
+    def __init__(self, path=DOCUMENTS_DIR):
+        self.path = path
+        self._path_ready = False
+
+    def has(self, guid):
+        return os.path.isfile(self._get_file_name(guid))
+
+    def missing(self, guids):
+        return [guid for guid in guids if not self.has(guid)]
+
+    def guids(self):
+        if not os.path.isdir(self.path):
+            return []
+        return [name[:-4] for name in os.listdir(self.path) if name.endswith('.txt')]
+
+    def write(self, guid, lines):
+        # lines may be produced while the document is still downloading, so the text goes to a
+        # temporary file first: a failed download must not leave a file that looks loaded
+        if not self._path_ready:
+            os.makedirs(self.path, exist_ok=True)
+            self._path_ready = True
+
+        file_name = self._get_file_name(guid)
+        part_file_name = '{}.part'.format(file_name)
+
+        try:
+            with open(part_file_name, 'w', encoding='utf-8') as file:
+                for line in lines:
+                    file.write(line + '\n')
+
+            os.replace(part_file_name, file_name)
+        except:
+            if os.path.isfile(part_file_name):
+                os.remove(part_file_name)
+            raise
+
+    def read_lines(self, guid):
+        with open(self._get_file_name(guid), encoding='utf-8') as doc:
+            for line in doc:
+                yield line
+
+    def first_line(self, guid):
+        with open(self._get_file_name(guid), encoding='utf-8') as doc:
+            for line in doc:
+                return line
+        return None
+
+    def close(self):
+        pass
+
+    def _get_file_name(self, guid):
+        return os.path.join(self.path, '{}.txt'.format(guid))
+
+class PackStore(object):
+    '''
+    Appends documents to a single pack file and records their position in an index file with
+    one "<guid> <offset> <length> <flags>" line per document. The flag 'z' marks zlib compressed
+    records. The index is kept in memory and the pack file is read through mmap.
+    '''
+    kind = PACK
+
+    def __init__(self, path=DOCUMENTS_DIR, compress=True):
+        self.path = path
+        self.compress = compress
+        os.makedirs(self.path, exist_ok=True)
+
+        self.pack_file_name = os.path.join(self.path, PACK_FILE_NAME)
+        self.index_file_name = os.path.join(self.path, INDEX_FILE_NAME)
+
+        self._lock = threading.RLock()
+        self._index = {}
+        self._index_position = 0
+        self._pack = open(self.pack_file_name, 'ab+')
+        self._map = None
+        self._map_size = 0
+
+        self._refresh_index()
+
+    def has(self, guid):
+        with self._lock:
+            if guid not in self._index:
+                self._refresh_index()
+            return guid in self._index
+
+    def missing(self, guids):
+        with self._lock:
+            self._refresh_index()
+            return [guid for guid in guids if guid not in self._index]
+
+    def guids(self):
+        with self._lock:
+            self._refresh_index()
+            return list(self._index.keys())
+
+    def write(self, guid, lines):
+        compressor = zlib.compressobj() if self.compress else None
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as buffer:
+            for line in lines:
+                data = (line + '\n').encode('utf-8')
+                buffer.write(compressor.compress(data) if compressor else data)
+            if compressor:
+                buffer.write(compressor.flush())
+
+            length = buffer.tell()
+            buffer.seek(0)
+
+            with self._lock, self._locked_index() as index_file:
+                self._pack.seek(0, os.SEEK_END)
+                offset = self._pack.tell()
+                shutil.copyfileobj(buffer, self._pack)
+                self._pack.flush()
+
+                # the record becomes visible only once its index line is written
+                index_file.write('{} {} {} {}\n'.format(guid, offset, length, 'z' if compressor else '-'))
+                index_file.flush()
+
+        with self._lock:
+            self._refresh_index()
+
+    def read(self, guid):
+        with self._lock:
+            if guid not in self._index:
+                self._refresh_index()
+            offset, length, compressed = self._index[guid]
+            data = self._get_map(offset + length)[offset:offset + length] if length else b''
+
+        return (zlib.decompress(data) if compressed else data).decode('utf-8')
+
+    def read_lines(self, guid):
+        return iter(self.read(guid).splitlines(keepends=True))
+
+    def first_line(self, guid):
+        with self._lock:
+            if guid not in self._index:
+                self._refresh_index()
+            offset, length, compressed = self._index[guid]
+            data = self._get_map(offset + length)[offset:offset + length] if length else b''
+
+        if compressed:
+            decompressor = zlib.decompressobj()
+            head = b''
+            while data and b'\n' not in head:
+                head += decompressor.decompress(data, 64 * 1024)
+                data = decompressor.unconsumed_tail
+            data = head
+
+        end = data.find(b'\n')
+        line = data if end < 0 else data[:end + 1]
+        return line.decode('utf-8') if line else None
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._pack.close()
+
+    def _get_map(self, size):
+        if self._map is None or self._map_size < size:
+            if self._map is not None:
+                self._map.close()
+            self._pack.flush()
+            self._map_size = os.path.getsize(self.pack_file_name)
+            self._map = mmap.mmap(self._pack.fileno(), self._map_size, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _refresh_index(self):
+        # picks up records appended by other processes since the last refresh
+        if not os.path.isfile(self.index_file_name):
+            return
+
+        with open(self.index_file_name, 'rb') as index_file:
+            index_file.seek(self._index_position)
+            for line in index_file:
+                if not line.endswith(b'\n'):
+                    # an index line that is still being written
+                    break
+                guid, offset, length, flags = line.decode('utf-8').split()
+                self._index[guid] = (int(offset), int(length), flags == 'z')
+                self._index_position += len(line)
+
+    def _locked_index(self):
+        return _LockedFile(self.index_file_name)
+
+class _LockedFile(object):
+    '''
+    Opens a file for appending and holds an exclusive lock on it where the platform supports it,
+    so that several processes can write to the same pack store.
+    '''
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.file_name, 'a', encoding='utf-8')
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+
+def create_store(kind=None, path=None, compress=True):
+    kind = kind or os.environ.get('DOCUMENT_STORE', DIRECTORY)
+    path = path or DOCUMENTS_DIR
+
+    if kind == DIRECTORY:
+        return DirectoryStore(path)
+    if kind == PACK:
+        return PackStore(path, compress=compress)
+
+    raise ValueError('Unknown document store: {}'.format(kind))
+
+def open_store(path, compress=True):
+    '''
+    Opens the store in the path folder as a pack store if it has a pack file, as a directory store otherwise.
+    '''
+    kind = PACK if os.path.isfile(os.path.join(path, PACK_FILE_NAME)) else DIRECTORY
+    return create_store(kind, path, compress=compress)
+
+def get_store(kind=None, path=None):
+    '''
+    Returns a store shared by everything in the process that uses the same kind and path.
+    '''
+    kind = kind or os.environ.get('DOCUMENT_STORE', DIRECTORY)
+    path = path or DOCUMENTS_DIR
+    compress = os.environ.get('DOCUMENT_STORE_COMPRESS', '1') != '0'
+
+    with _stores_lock:
+        key = (kind, os.path.abspath(path))
+        if key not in _stores:
+            _stores[key] = create_store(kind, path, compress=compress)
+        return _stores[key]
+
+def migrate(source, target):
+    '''
+    Copies every document of the source store that the target store does not have yet.
+    '''
+    counter = 0
+    for guid in target.missing(source.guids()):
+        target.write(guid, (line.rstrip('\n') for line in source.read_lines(guid)))
+        counter += 1
+    return counter
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='migrate loaded documents between stores')
+
+    parser.add_argument('-s', '--source', help='folder with <guid>.txt documents', type=str, default=DOCUMENTS_DIR)
+
+    parser.add_argument('-t', '--target', help='folder for the pack store', type=str, default=DOCUMENTS_DIR)
+
+    parser.add_argument('--no-compress', help='store documents in the pack uncompressed', action='store_true')
+
+    return parser
+
+def command_line_runner():
+    parser = get_parser()
+    args = vars(parser.parse_args())
+
+    if not os.path.isdir(args['source']):
+        print('{} does not exist'.format(args['source']))
+        parser.print_help()
+        return
+
+    start = datetime.now()
+    source = DirectoryStore(args['source'])
+    target = PackStore(args['target'], compress=not args['no_compress'])
+    try:
+        counter = migrate(source, target)
+    finally:
+        target.close()
+
+    print('{} documents migrated in {}'.format(counter, datetime.now() - start))
+
+if __name__ == '__main__':
+    command_line_runner()
@@ -0,0 +1,133 @@
+'''
+Prepared text cache module.
+
+Keeps the output of text preparation per document guid, so that documents which appear in many
+searches are tokenised and tagged only once. An entry is valid only for the raw text and the
+preprocessing version it was computed from.
+'''
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from knowledge_extractor.utils import PREPROCESSING_VERSION
+
+PREPARED_CACHE_FILE = os.environ.get(
+    'PREPARED_CACHE_FILE',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'prepared.sqlite')
+)
+PREPARED_CACHE_SIZE = int(os.environ.get('PREPARED_CACHE_SIZE', str(1024 * 1024 * 1024)))
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_text_key(text, version=PREPROCESSING_VERSION):
+    return hashlib.sha1('{}\0{}'.format(version, text).encode('utf-8')).hexdigest()
+
+class PreparedTextCache(object):
+    '''
+    SQLite table of guid -> (text key, prepared text). Once the prepared texts take more than
+    max_size bytes, the least recently used entries are evicted.
+    '''
+    def __init__(self, file_name=PREPARED_CACHE_FILE, max_size=PREPARED_CACHE_SIZE):
+        self.file_name = file_name
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        self._size = None
+
+    def get_many(self, guids, keys):
+        '''
+        Returns guid -> prepared text for every guid whose cached entry matches its text key.
+        '''
+        found = {}
+        wanted = dict(zip(guids, keys))
+        with self._lock:
+            connection = self._connect()
+            for guid, key in wanted.items():
+                row = connection.execute('SELECT text FROM prepared WHERE guid = ? AND key = ?', (guid, key)).fetchone()
+                if row is not None:
+                    found[guid] = row[0]
+
+            now = time.time()
+            connection.executemany('UPDATE prepared SET used = ? WHERE guid = ?', [(now, guid) for guid in found])
+            connection.commit()
+
+            self.hits += len(found)
+            self.misses += len(wanted) - len(found)
+
+        return found
+
+    def put_many(self, entries):
+        '''
+        Stores (guid, key, prepared text) entries.
+        '''
+        now = time.time()
+        rows = [(guid, key, text, len(text.encode('utf-8')), now) for guid, key, text in entries]
+        with self._lock:
+            connection = self._connect()
+            connection.executemany('INSERT OR REPLACE INTO prepared (guid, key, text, size, used) VALUES (?, ?, ?, ?, ?)', rows)
+            connection.commit()
+
+            self._size += sum(row[3] for row in rows)
+            if self._size > self.max_size:
+                self._evict(connection)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0
+        }
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.file_name)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            self._connection = sqlite3.connect(self.file_name, timeout=30, check_same_thread=False)
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS prepared (
+                guid TEXT PRIMARY KEY, key TEXT NOT NULL, text TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)''')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS prepared_used ON prepared (used)')
+            self._connection.commit()
+            self._size = self._get_size(self._connection)
+
+        return self._connection
+
+    def _get_size(self, connection):
+        return connection.execute('SELECT COALESCE(SUM(size), 0) FROM prepared').fetchone()[0]
+
+    def _evict(self, connection):
+        # other processes may have written to the same file, so the size is recounted first
+        self._size = self._get_size(connection)
+        target = self.max_size * 0.9
+        while self._size > target:
+            rows = connection.execute('SELECT guid, size FROM prepared ORDER BY used LIMIT 100').fetchall()
+            if not rows:
+                break
+            for guid, size in rows:
+                connection.execute('DELETE FROM prepared WHERE guid = ?', (guid,))
+                self._size -= size
+                if self._size <= target:
+                    break
+        connection.commit()
+
+def get_prepared_cache(file_name=None):
+    file_name = os.path.abspath(file_name or PREPARED_CACHE_FILE)
+
+    with _caches_lock:
+        if file_name not in _caches:
+            _caches[file_name] = PreparedTextCache(file_name)
+        return _caches[file_name]
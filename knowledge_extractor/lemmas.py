@@ -0,0 +1,174 @@
+'''
+Lemma table module.
+
+The fast preprocessing mode looks every token up in a table of word form -> lemma instead of
+tagging it. The table is built once from WordNet, which needs the NLTK wordnet corpus, with
+
+    python -m knowledge_extractor.lemmas
+
+and afterwards only read. Every regular and irregular inflection of a WordNet lemma is mapped to
+the lemma of its most frequent part of speech, so that e.g. "damages" becomes "damage" and
+"ruled" becomes "rule"; forms that are their own lemma are not stored.
+'''
+
+import argparse
+import gzip
+import hashlib
+import os
+import sys
+import threading
+
+LEMMA_TABLE_FILE = os.environ.get(
+    'LEMMA_TABLE_FILE',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'lemma_table.tsv.gz')
+)
+
+# the parts of speech text_prepare lemmatises with
+POS = ('n', 'v', 'a')
+
+# WordNet's morphy detachment rules (lemma ending, form ending), applied the other way round
+INFLECTIONS = {
+    'n': (('', 's'), ('s', 'ses'), ('x', 'xes'), ('z', 'zes'), ('ch', 'ches'), ('sh', 'shes'),
+          ('man', 'men'), ('y', 'ies')),
+    'v': (('', 's'), ('y', 'ies'), ('e', 'es'), ('', 'es'), ('e', 'ed'), ('', 'ed'), ('e', 'ing'), ('', 'ing')),
+    'a': (('', 'er'), ('', 'est'), ('e', 'er'), ('e', 'est')),
+}
+
+_table = None
+_table_lock = threading.Lock()
+
+class LemmaTable(object):
+    '''
+    word form -> lemma mapping read from a gzipped "form<TAB>lemma" file. Forms that are not in
+    the table are their own lemma.
+    '''
+    def __init__(self, lemmas=None, file_name=LEMMA_TABLE_FILE):
+        self.file_name = file_name
+        self.lemmas = lemmas if lemmas is not None else {}
+        self._digest = None
+
+    def __len__(self):
+        return len(self.lemmas)
+
+    def lemmatize(self, word):
+        return self.lemmas.get(word, word)
+
+    def get_digest(self):
+        '''
+        Identifies the content of the table, so that texts prepared with another table are not reused.
+        '''
+        if self._digest is None:
+            digest = hashlib.sha1()
+            for form in sorted(self.lemmas):
+                digest.update('{}\t{}\n'.format(form, self.lemmas[form]).encode('utf-8'))
+            self._digest = digest.hexdigest()[:12]
+        return self._digest
+
+    def save(self, file_name=None):
+        file_name = file_name or self.file_name
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        temp_file_name = '{}.{}.tmp'.format(file_name, os.getpid())
+        with gzip.open(temp_file_name, 'wt', encoding='utf-8') as table_file:
+            for form in sorted(self.lemmas):
+                table_file.write('{}\t{}\n'.format(form, self.lemmas[form]))
+        os.replace(temp_file_name, file_name)
+
+    def load(self, file_name=None):
+        file_name = file_name or self.file_name
+        if not os.path.isfile(file_name):
+            raise LookupError('Lemma table {} is missing. Run python -m knowledge_extractor.lemmas to build '
+                              'it.'.format(file_name))
+
+        with gzip.open(file_name, 'rt', encoding='utf-8') as table_file:
+            for line in table_file:
+                form, lemma = line.rstrip('\n').split('\t')
+                self.lemmas[form] = lemma
+        self._digest = None
+        return self
+
+def get_lemma_table():
+    '''
+    Returns the lemma table of the process, read on first use.
+    '''
+    global _table
+    with _table_lock:
+        if _table is None:
+            _table = LemmaTable().load()
+        return _table
+
+def get_word_forms(wordnet):
+    '''
+    Returns the single word lemmas of WordNet with their regular and irregular inflections.
+    '''
+    forms = set()
+    for pos in POS:
+        for lemma in wordnet.all_lemma_names(pos=pos):
+            if not lemma.isalpha():
+                continue
+            forms.add(lemma)
+            for ending, inflection in INFLECTIONS[pos]:
+                if lemma.endswith(ending):
+                    forms.add(lemma[:len(lemma) - len(ending)] + inflection)
+
+        # irregular forms such as "children" or "went"
+        forms.update(form for form in getattr(wordnet, '_exception_map', {}).get(pos, {}) if form.isalpha())
+
+    return forms
+
+def choose_lemma(wordnet, lemmatizer, form):
+    '''
+    Returns the lemma of the form for the part of speech whose senses are the most frequent in
+    the WordNet sense counts; nouns win ties, as they do in text_prepare for untagged words.
+    '''
+    best, best_count = form, -1
+    for pos in POS:
+        if wordnet.morphy(form, pos) is None:
+            continue
+        lemma = lemmatizer.lemmatize(form, pos)
+        count = sum(synset_lemma.count() for synset_lemma in wordnet.lemmas(lemma, pos))
+        if count > best_count:
+            best, best_count = lemma, count
+
+    return best
+
+def build_lemma_table(words=()):
+    '''
+    Builds the table for the WordNet word forms plus words.
+    '''
+    from nltk.corpus import wordnet
+    from nltk.stem import WordNetLemmatizer
+
+    lemmatizer = WordNetLemmatizer()
+    lemmas = {}
+    for form in sorted(get_word_forms(wordnet) | set(words)):
+        lemma = choose_lemma(wordnet, lemmatizer, form)
+        if lemma != form:
+            lemmas[form] = lemma
+
+    return LemmaTable(lemmas)
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='build the lemma table of the fast preprocessing mode from WordNet')
+
+    parser.add_argument('-w', '--words', help='file with additional words, one per line', type=str)
+
+    parser.add_argument('-o', '--output', help='table file to write', type=str, default=LEMMA_TABLE_FILE)
+
+    return parser
+
+def command_line_runner():
+    parser = get_parser()
+    args = vars(parser.parse_args())
+
+    words = ()
+    if args['words']:
+        with open(args['words'], encoding='utf-8') as words_file:
+            words = [line.strip().lower() for line in words_file if line.strip()]
+
+    table = build_lemma_table(words)
+    table.save(args['output'])
+    print('{} lemmas written to {}'.format(len(table), args['output']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(command_line_runner())
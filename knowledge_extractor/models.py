@@ -2,25 +2,100 @@
 Knowledge extractor module.
 '''
 
-import artm
-import inspect
 import operator
 import os
-import numpy as np
-import pandas as pd
+import shutil
 import sys
-
-from sklearn.manifold import MDS
-from sklearn.metrics import pairwise_distances
-
-from knowledge_extractor.utils import text_prepare
+import time
+import uuid
+
+from collections import Counter
+
+from extractor.metrics import STAGE_SECONDS, get_metrics
+from extractor.store import get_store
+from knowledge_extractor.cache import get_prepared_cache, get_text_key
+from knowledge_extractor.projection import PROJECTION, PROJECTION_SEED, get_method, project
+from knowledge_extractor.utils import (PREPROCESSING, ensure_preprocessing_resources, get_preprocessing_version,
+                                       text_prepare, text_prepare_batch)
+from knowledge_extractor.workspace import Workspace
+
+# artm, numpy, pandas and sklearn are imported where they are used: they take seconds to import
+# and are not needed to start the API or the loader
+
+BATCH_SIZE = 100
+
+OFFLINE = 'offline'
+ONLINE = 'online'
+AUTO = 'auto'
+
+# the two fitting phases: without and with the sparsing regularizer on the subject topics
+MAX_PASSES = (30, 15)
+MIN_PASSES = 3
+TOLERANCE = float(os.environ.get('FIT_TOLERANCE', '0.001'))
+ONLINE_THRESHOLD = int(os.environ.get('FIT_ONLINE_THRESHOLD', '5000'))
+# documents in every online update of phi: fit_online updates after each batch
+ONLINE_UPDATE_SIZE = BATCH_SIZE
+# fit_online weighs the update k with (ONLINE_TAU0 + k) ** -kappa. BigARTM's default of 1024 keeps the
+# counts far below the scale of one update for hundreds of updates; 0 would replace the initial counts
+# altogether and lock every token the first batch does not have to zero
+ONLINE_TAU0 = 1.0
+
+# taus of the background smoothing and the subject sparsing regularizers, tuned for offline fitting
+SMOOTH_TAU = 1e5
+SPARSE_TAU = -1e5
+
+def get_tau_scale(mode, num_documents, update_size=ONLINE_UPDATE_SIZE):
+    '''
+    Returns the factor the regularizer taus are multiplied with. Offline fitting regularizes the
+    counts of the whole collection, online fitting the counts of the last update only, so the taus
+    are scaled down to the share of the collection in one update.
+    '''
+    if mode != ONLINE or num_documents <= update_size:
+        return 1.0
+    return update_size / float(num_documents)
+
+def get_topic_profile_matrix(phi, theta):
+    '''
+    Returns p(t|d) for every document token d of the doc_guid modality: phi[d, t] * p(t),
+    normalised per document, where p(t) is the share of topic t in theta (topics x items).
+    Documents with all zero phi get an all zero profile.
+    '''
+    import numpy as np
+
+    phi = np.asarray(phi, dtype=np.float64)
+    p_t = np.asarray(theta, dtype=np.float64).sum(axis=1)
+    p_t = p_t / p_t.sum()
+
+    joint = phi * p_t
+    total = joint.sum(axis=1, keepdims=True)
+    return np.divide(joint, total, out=np.zeros_like(joint), where=total > 0)
 
 class TopicModel(object):
-    def __init__(self, search_guid, documents, analyze_full_doc=True, num_of_topics=10):
+    def __init__(self, search_guid, documents, analyze_full_doc=True, num_of_topics=10, store=None,
+                 processes=None, prepared_cache=None, in_memory=True, fit_mode=AUTO, tolerance=TOLERANCE,
+                 online_threshold=ONLINE_THRESHOLD, projection=PROJECTION, random_state=PROJECTION_SEED,
+                 scratch_dir=None, progress=None, preprocessing=PREPROCESSING):
         self.search_guid = search_guid
         self.documents = documents
         self.analyze_full_doc = analyze_full_doc
         self.num_of_topics = num_of_topics
+        self.store = store if store is not None else get_store()
+        self.processes = processes
+        # 'nltk' or the faster, tagger free 'fast' text preparation of knowledge_extractor.utils
+        self.preprocessing = preprocessing
+        self.prepared_cache = prepared_cache if prepared_cache is not None else get_prepared_cache()
+        self.in_memory = in_memory
+        self.fit_mode = fit_mode
+        self.tolerance = tolerance
+        self.online_threshold = online_threshold
+        self.projection = projection
+        self.random_state = random_state
+        self.scratch_dir = scratch_dir
+        self.workspace = None
+        # called with ('prepared', documents, total) and ('fit', pass, max passes) during training
+        self.progress = progress
+        self.status = {}
+        self._documents_by_guid = None
         self.training_done = False
 
     def is_ready(self):
@@ -29,25 +104,46 @@ class TopicModel(object):
     def get_doccuments(self):
         return self.documents
 
-    def train(self):
-        vocabulary_file = self._prepare_texts_full() if self.analyze_full_doc == True else self._prepare_texts_from_summary()
-        target_folder = self._get_bigARTM_dir()
+    def get_status(self):
+        return self.status
 
-        batch_vectorizer = artm.BatchVectorizer(
-            data_path=vocabulary_file, data_format='vowpal_wabbit',
-            target_folder=target_folder, batch_size=100
-        )
+    def dump(self, path):
+        '''
+        Saves the trained BigARTM model to the path folder, replacing an earlier dump. The dump is
+        for analysis only: it has no theta, so it cannot give a topic profile again.
+        '''
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        self.model_artm.dump_artm_model(path)
 
-        dict_path = self._get_dictionary_path()
-        dict_file = '{}.dict'.format(dict_path)
-
-        if os.path.isfile(dict_file):
-            os.remove(dict_file)
-
-        my_dictionary = artm.Dictionary()
-        my_dictionary.gather(data_path=target_folder, vocab_file_path=vocabulary_file)
-        my_dictionary.save(dictionary_path=dict_path)
-        my_dictionary.load(dictionary_path=dict_file)
+    def train(self):
+        with Workspace(self.scratch_dir) as workspace:
+            self.workspace = workspace
+            try:
+                self._train()
+            finally:
+                self.workspace = None
+
+    def _train(self):
+        import artm
+
+        ensure_preprocessing_resources(self.preprocessing)
+        start = time.time()
+        metrics = get_metrics()
+        with metrics.stage('prepare'):
+            prepared_documents = self._get_prepared_documents()
+        mode = self.fit_mode
+        if mode == AUTO:
+            mode = ONLINE if len(prepared_documents) > self.online_threshold else OFFLINE
+        tau_scale = get_tau_scale(mode, len(prepared_documents))
+        self.status = {'documents': len(prepared_documents), 'preprocessing': self.preprocessing, 'fit_mode': mode,
+                       'tau_scale': tau_scale, 'phases': []}
+
+        with metrics.stage('vectorise'):
+            if self.in_memory:
+                batches, my_dictionary = self._build_batches(prepared_documents)
+            else:
+                batch_vectorizer, my_dictionary = self._build_batches_on_disk(prepared_documents)
 
         T = self.num_of_topics
         topic_names=["sbj"+str(i) for i in range(T-1)]+["bcg"]
@@ -60,28 +156,84 @@ class TopicModel(object):
             cache_theta=True
         )
 
+        if self.in_memory:
+            # the batches are handed over to the model directly, nothing is written to disk
+            batch_vectorizer = artm.BatchVectorizer(
+                batches=batches, data_format='batches', process_in_memory_model=self.model_artm
+            )
+
         self.model_artm.initialize(dictionary=my_dictionary)
         self.model_artm.scores.add(artm.TopTokensScore(name="text_words", num_tokens=15, class_id="text"))
         self.model_artm.scores.add(artm.TopTokensScore(name="doc_guid_words", num_tokens=15, class_id="doc_guid"))
+        self.model_artm.scores.add(artm.PerplexityScore(name="perplexity", dictionary=my_dictionary, class_ids=["text"]))
+        self.model_artm.scores.add(artm.SparsityPhiScore(name="sparsity_phi", class_id="text"))
 
-        self.model_artm.regularizers.add(artm.SmoothSparsePhiRegularizer(name='SparsePhi', tau=1e5, dictionary=my_dictionary, class_ids="text", topic_names="bcg"))
+        self.model_artm.regularizers.add(artm.SmoothSparsePhiRegularizer(name='SparsePhi', tau=SMOOTH_TAU * tau_scale, dictionary=my_dictionary, class_ids="text", topic_names="bcg"))
 
-        self.model_artm.fit_offline(batch_vectorizer=batch_vectorizer, num_collection_passes=30)
+        self._fit(batch_vectorizer, mode, MAX_PASSES[0], 'smooth')
 
         self.model_artm.regularizers.add(
             artm.SmoothSparsePhiRegularizer(
                 name='SparsePhi-1e5',
-                tau=-1e5,
+                tau=SPARSE_TAU * tau_scale,
                 dictionary=my_dictionary,
                 class_ids="text",
                 topic_names=["sbj"+str(i) for i in range(T-1)]
             )
         )
 
-        self.model_artm.fit_offline(batch_vectorizer=batch_vectorizer, num_collection_passes=15)
+        self._fit(batch_vectorizer, mode, MAX_PASSES[1], 'sparse')
 
+        self.status['seconds'] = round(time.time() - start, 3)
         self.training_done = True
 
+    def _fit(self, batch_vectorizer, mode, max_passes, phase):
+        '''
+        Runs up to max_passes collection passes and stops earlier once neither the perplexity nor
+        the sparsity of phi changes by more than the tolerance (relative change for perplexity).
+        '''
+        start = time.time()
+        tracker = self.model_artm.score_tracker
+        previous = None
+        passes = 0
+        while passes < max_passes:
+            if mode == ONLINE:
+                self.model_artm.fit_online(batch_vectorizer=batch_vectorizer, tau0=ONLINE_TAU0)
+            else:
+                self.model_artm.fit_offline(batch_vectorizer=batch_vectorizer, num_collection_passes=1)
+            passes += 1
+            self._report_progress('fit', self._get_passes_done() + passes, sum(MAX_PASSES))
+
+            current = (tracker['perplexity'].last_value, tracker['sparsity_phi'].last_value)
+            if previous is not None and passes >= MIN_PASSES and self._converged(previous, current):
+                break
+            previous = current
+
+        metrics = get_metrics()
+        metrics.histogram(STAGE_SECONDS, stage='fit').observe(time.time() - start)
+        metrics.counter('fit_passes_total', mode=mode).inc(passes)
+
+        self.status['phases'].append({
+            'phase': phase,
+            'passes': passes,
+            'max_passes': max_passes,
+            'seconds': round(time.time() - start, 3),
+            'perplexity': float(current[0]),
+            'sparsity_phi': float(current[1])
+        })
+
+    def _get_passes_done(self):
+        return sum(phase['passes'] for phase in self.status['phases'])
+
+    def _report_progress(self, stage, done, total):
+        if self.progress is not None:
+            self.progress(stage, done, total)
+
+    def _converged(self, previous, current):
+        perplexity_change = abs(previous[0] - current[0]) / max(abs(previous[0]), 1e-12)
+        sparsity_change = abs(previous[1] - current[1])
+        return perplexity_change < self.tolerance and sparsity_change < self.tolerance
+
     def get_top_words(self, score_name='text_words', count=None):
         top_words = {}
         for topic_name in self.model_artm.topic_names:
@@ -90,38 +242,34 @@ class TopicModel(object):
         return top_words
 
     def get_topic_profile(self):
+        with get_metrics().stage('profile'):
+            return self._get_topic_profile()
+
+    def _get_topic_profile(self):
         phi_a = self.model_artm.get_phi(class_ids='doc_guid')
         theta = self.model_artm.get_theta()
+        topics = list(phi_a.columns)
 
-        p_t = theta.sum(axis=1)
-        df_p_t = pd.DataFrame(p_t / p_t.sum(axis=0))
-        df_p_t.columns = ['probability']
+        topic_profile = get_topic_profile_matrix(phi_a.values, theta.loc[topics].values)
 
-        topic_profile = pd.DataFrame(index=phi_a.index.copy(), columns=df_p_t.index.copy())
-        for a_idx, _ in enumerate(topic_profile.index):
-            total = np.sum([phi_a.iloc[a_idx][col] * df_p_t.loc[col]['probability'] for col in topic_profile.columns])
-            
-            for _, topic in enumerate(topic_profile.columns):     
-                prob = (phi_a.iloc[a_idx][topic] * df_p_t.loc[topic]['probability']) / total
-                topic_profile.iloc[a_idx][topic] = prob
+        self.status['projection'] = get_method(len(topic_profile), self.projection)
+        MDS_transformed_cos = project(topic_profile, self.projection, self.random_state)
 
-        mds_cos_clstr = MDS(n_components=2)
-        MDS_transformed_cos = mds_cos_clstr.fit_transform(pairwise_distances(topic_profile, metric='cosine'))
+        subjects = topic_profile.argmax(axis=1)
 
         result = []
-        for a_idx, doc_guid in enumerate(topic_profile.index):
-            sbj = topic_profile.columns[topic_profile.iloc[a_idx].values.argmax()]
+        for a_idx, doc_guid in enumerate(phi_a.index):
             coord = MDS_transformed_cos[a_idx]
-            docs = [d for d in self.documents if d['docGuid'] == doc_guid]
+            doc = self._get_document(doc_guid)
             rank = -1
             title = 'N/A'
             summary = 'N/A'
             description = 'N/A'
-            if len(docs):
-                summary = docs[0]['summary'] if 'summary' in docs[0] else description
-                description = self._get_doc_description_from_file(docs[0]['docGuid'])
-                rank = docs[0]['rank'] if 'rank' in docs[0] else rank
-                title = docs[0]['title'] if 'title' in docs[0] else title
+            if doc is not None:
+                summary = doc['summary'] if 'summary' in doc else description
+                description = self._get_doc_description_from_file(doc['docGuid'])
+                rank = doc['rank'] if 'rank' in doc else rank
+                title = doc['title'] if 'title' in doc else title
             else:
                 print('Not able to find the following doc: {}'.format(doc_guid))
 
@@ -129,23 +277,30 @@ class TopicModel(object):
                 'doc_guid': doc_guid, 
                 'rank': rank,
                 'title': title,
-                'sbj': sbj, 
+                'sbj': topics[subjects[a_idx]], 
                 'description': description, 
                 'summary': summary,
-                'x': coord[0], 
-                'y': coord[0]
+                'x': float(coord[0]), 
+                'y': float(coord[1])
             })
 
         return result
 
+    def _get_document(self, doc_guid):
+        if self._documents_by_guid is None:
+            self._documents_by_guid = {}
+            for doc in self.documents:
+                # the first document wins, as with the linear search this index replaces
+                self._documents_by_guid.setdefault(doc['docGuid'], doc)
+
+        return self._documents_by_guid.get(doc_guid)
+
     def _get_doc_description_from_file(self, doc_guid):
-        docs_folder = self._get_documents_folder()
-        description = 'N/A'
-        with open('{}/{}.txt'.format(docs_folder, doc_guid), encoding='utf-8') as doc:
-            for line in doc:
-                description = line
-                break
-        return description
+        if not self.store.has(doc_guid):
+            # summary models are trained before the documents are loaded
+            return 'N/A'
+        description = self.store.first_line(doc_guid)
+        return description if description is not None else 'N/A'
 
     def top_tokens_by_topic(self, score_name, topic_name, count=None):
         top_tokens = self.model_artm.score_tracker[score_name]
@@ -165,73 +320,153 @@ class TopicModel(object):
         
         return [x[0] for x in top_words]
 
+    def _get_prepared_documents(self):
+        if self.analyze_full_doc == True:
+            return self._prepare_texts_full()
+        return self._prepare_texts_from_summary()
+
     def _prepare_texts_from_summary(self):
-        vocabulary_file = self._get_vocabulary_file_name()
-        vocabulary = open(vocabulary_file, 'w')
+        prepared_documents = []
         for doc in self.documents:
             try:
-                vocabulary.write('document_{} |text '.format(doc['docGuid']))
-                prepared = text_prepare(doc['summary'] if 'summary' in doc else 'N/A')
-                vocabulary.write(prepared)
-                vocabulary.write(' |doc_guid {}\n'.format(doc['docGuid']))
+                prepared = text_prepare(doc['summary'] if 'summary' in doc else 'N/A', self.preprocessing)
+                prepared_documents.append((doc['docGuid'], prepared))
             except:
                 print('Exception occured for doc_guid: {}, error: {}'.format(doc['docGuid'], sys.exc_info()))
 
-            vocabulary.flush()
-
-        vocabulary.close()
-
-        return vocabulary_file
+        return prepared_documents
     
     def _prepare_texts_full(self):
+        guids = [doc['docGuid'] for doc in self.documents]
+        return list(zip(guids, self._get_prepared_texts(guids)))
+
+    def _build_batches(self, prepared_documents, batch_size=BATCH_SIZE):
+        '''
+        Builds BigARTM batches and the dictionary straight from the prepared texts, one item per
+        document with the counts of its "text" tokens and its guid as the only "doc_guid" token.
+        '''
+        import artm
+
+        from artm import messages
+
+        token_tf = {}
+        token_df = {}
+        batches = []
+        batch = None
+        batch_tokens = None
+
+        for item_id, (guid, prepared) in enumerate(prepared_documents):
+            if item_id % batch_size == 0:
+                batch = messages.Batch()
+                batch.id = str(uuid.uuid4())
+                batch_tokens = {}
+                batches.append(batch)
+
+            item = batch.item.add()
+            item.id = item_id
+            item.title = 'document_{}'.format(guid)
+
+            counts = Counter(('text', token) for token in prepared.split())
+            counts[('doc_guid', guid)] += 1
+
+            for token, count in counts.items():
+                if token not in batch_tokens:
+                    batch_tokens[token] = len(batch.token)
+                    batch.class_id.append(token[0])
+                    batch.token.append(token[1])
+
+                item.token_id.append(batch_tokens[token])
+                item.token_weight.append(float(count))
+
+                token_tf[token] = token_tf.get(token, 0) + count
+                token_df[token] = token_df.get(token, 0) + 1
+
+        total = float(sum(token_tf.values())) or 1.0
+        dictionary_data = messages.DictionaryData()
+        dictionary_data.name = 'dictionary_{}'.format(uuid.uuid4())
+        for token, tf in token_tf.items():
+            dictionary_data.class_id.append(token[0])
+            dictionary_data.token.append(token[1])
+            dictionary_data.token_tf.append(tf)
+            dictionary_data.token_df.append(token_df[token])
+            dictionary_data.token_value.append(tf / total)
+
+        dictionary = artm.Dictionary()
+        dictionary.create(dictionary_data)
+
+        return batches, dictionary
+
+    def _build_batches_on_disk(self, prepared_documents):
+        import artm
+
+        # fail before writing a vocabulary file that would not fit, see _write_vocabulary_file
+        vocabulary_size = sum(len(prepared) + 2 * len(guid) + 30 for guid, prepared in prepared_documents)
+        self.workspace.check(projected=vocabulary_size)
+        vocabulary_file = self._write_vocabulary_file(prepared_documents)
+        self.workspace.check()
+        target_folder = self._get_bigARTM_dir()
+
+        batch_vectorizer = artm.BatchVectorizer(
+            data_path=vocabulary_file, data_format='vowpal_wabbit',
+            target_folder=target_folder, batch_size=BATCH_SIZE
+        )
+        self.workspace.check()
+
+        dict_path = self._get_dictionary_path()
+        dict_file = '{}.dict'.format(dict_path)
+
+        my_dictionary = artm.Dictionary()
+        my_dictionary.gather(data_path=target_folder, vocab_file_path=vocabulary_file)
+        my_dictionary.save(dictionary_path=dict_path)
+        my_dictionary.load(dictionary_path=dict_file)
+
+        return batch_vectorizer, my_dictionary
+
+    def _write_vocabulary_file(self, prepared_documents):
         vocabulary_file = self._get_vocabulary_file_name()
-        vocabulary = open(vocabulary_file, 'w')
-        docs_folder = self._get_documents_folder()
-        for guid in [doc['docGuid'] for doc in self.documents]:
-            with open('{}/{}.txt'.format(docs_folder, guid), encoding='utf-8') as doc:
+        with open(vocabulary_file, 'w') as vocabulary:
+            for guid, prepared in prepared_documents:
                 vocabulary.write('document_{} |text '.format(guid))
-                for line in doc:
-                    prepared = text_prepare(line)
-                    vocabulary.write(prepared)
+                vocabulary.write(prepared)
                 vocabulary.write(' |doc_guid {}\n'.format(guid))
-                vocabulary.flush()
-        vocabulary.close()
 
         return vocabulary_file
-    
+
+    def _get_prepared_texts(self, guids):
+        # only documents that are not in the prepared text cache yet are tokenised and tagged
+        texts = [''.join(self.store.read_lines(guid)) for guid in guids]
+        version = get_preprocessing_version(self.preprocessing)
+        keys = [get_text_key(text, version) for text in texts]
+        prepared = self.prepared_cache.get_many(guids, keys)
+
+        missing = [idx for idx, guid in enumerate(guids) if guid not in prepared]
+        cached = len(guids) - len(missing)
+        metrics = get_metrics()
+        metrics.counter('documents_total', stage='prepare', outcome='cached').inc(cached)
+        metrics.counter('documents_total', stage='prepare', outcome='prepared').inc(len(missing))
+        self._report_progress('prepared', cached, len(guids))
+        if missing:
+            prepared_texts = text_prepare_batch(
+                [texts[idx] for idx in missing], processes=self.processes, mode=self.preprocessing,
+                progress=lambda count: self._report_progress('prepared', cached + count, len(guids))
+            )
+            entries = [(guids[idx], keys[idx], text) for idx, text in zip(missing, prepared_texts)]
+            self.prepared_cache.put_many(entries)
+            prepared.update((guid, text) for guid, _, text in entries)
+
+        return [prepared[guid] for guid in guids]
+
     def _get_bigARTM_dir(self):
-        parent_path = os.path.dirname(os.path.dirname(inspect.getfile(self.__class__)))
-        dir_path = os.path.join(
-            parent_path,
-            'bigARTM')
+        # the workspace of the training, so that batches of other trainings are never gathered
+        dir_path = self.workspace.get_path('batches')
 
         if not os.path.isdir(dir_path):
             os.makedirs(dir_path)
 
         return dir_path
 
-    def _get_documents_folder(self):
-        parent_path = os.path.dirname(os.path.dirname(inspect.getfile(self.__class__)))
-        dir_path = os.path.join(
-            parent_path,
-            'documents')
-
-        return dir_path
-
     def _get_dictionary_path(self):
-        parent_path = self._get_bigARTM_dir()
-        dir_path = os.path.join(
-            parent_path,
-            'dictionary_{}'.format(self.search_guid))
-
-        return dir_path
+        return self.workspace.get_path('dictionary')
 
     def _get_vocabulary_file_name(self):
-        dir_path = self._get_bigARTM_dir()
-
-        file_name = os.path.join(
-            dir_path,
-            'ALL_TEXT_{}.txt'.format(self.search_guid)
-        )
-
-        return file_name
+        return self.workspace.get_path('ALL_TEXT.txt')
@@ -0,0 +1,111 @@
+'''
+Topic map projection module.
+
+Places documents on a plane so that documents with similar topic profiles are close. Exact
+metric MDS needs the full n x n distance matrix, so larger searches are projected with landmark
+MDS or PCA, which only keep n x k and n x topics arrays in memory.
+'''
+
+import inspect
+import os
+
+# numpy and sklearn are imported where they are used, like in the models module
+
+MDS = 'mds'
+LANDMARK = 'landmark'
+PCA = 'pca'
+AUTO = 'auto'
+
+METHODS = (MDS, LANDMARK, PCA, AUTO)
+
+PROJECTION = os.environ.get('PROJECTION', AUTO)
+# searches with more documents than this are not projected with exact MDS in the auto mode
+PROJECTION_THRESHOLD = int(os.environ.get('PROJECTION_THRESHOLD', '1000'))
+PROJECTION_LANDMARKS = int(os.environ.get('PROJECTION_LANDMARKS', '300'))
+PROJECTION_SEED = int(os.environ.get('PROJECTION_SEED', '0'))
+
+# rows of the distance matrix to the landmarks computed at a time
+CHUNK_SIZE = 10000
+
+def get_method(num_documents, method=AUTO, threshold=PROJECTION_THRESHOLD):
+    if method not in METHODS:
+        raise ValueError('Unknown projection: {}'.format(method))
+    if method == AUTO:
+        return MDS if num_documents <= threshold else LANDMARK
+    return method
+
+def project(profile, method=AUTO, random_state=PROJECTION_SEED, threshold=PROJECTION_THRESHOLD,
+            num_landmarks=PROJECTION_LANDMARKS):
+    '''
+    Returns n x 2 coordinates for the n rows of the profile, using cosine distances between rows.
+    The same random_state gives the same coordinates for the same profile.
+    '''
+    import numpy as np
+
+    profile = np.asarray(profile, dtype=np.float64)
+    if len(profile) < 3:
+        return np.zeros((len(profile), 2))
+
+    method = get_method(len(profile), method, threshold)
+    if method == MDS:
+        return _project_mds(profile, random_state)
+    if method == LANDMARK:
+        return _project_landmark(profile, random_state, num_landmarks)
+    return _project_pca(profile, random_state)
+
+def _project_mds(profile, random_state):
+    from sklearn.manifold import MDS as SklearnMDS
+    from sklearn.metrics import pairwise_distances
+
+    distances = pairwise_distances(profile, metric='cosine')
+    if 'metric_mds' in inspect.signature(SklearnMDS).parameters:
+        mds = SklearnMDS(n_components=2, metric='precomputed', init='random', random_state=random_state)
+    else:
+        mds = SklearnMDS(n_components=2, dissimilarity='precomputed', random_state=random_state)
+
+    return mds.fit_transform(distances)
+
+def _project_landmark(profile, random_state, num_landmarks):
+    '''
+    Landmark MDS: classical MDS on a random sample of landmarks, then every document is placed
+    by its distances to the landmarks only.
+    '''
+    import numpy as np
+    from sklearn.metrics import pairwise_distances
+
+    random = np.random.RandomState(random_state)
+    num_landmarks = min(num_landmarks, len(profile))
+    landmarks = profile[np.sort(random.choice(len(profile), num_landmarks, replace=False))]
+
+    squared = pairwise_distances(landmarks, metric='cosine') ** 2
+    centering = np.eye(num_landmarks) - 1.0 / num_landmarks
+    eigenvalues, eigenvectors = np.linalg.eigh(-0.5 * centering.dot(squared).dot(centering))
+
+    order = np.argsort(eigenvalues)[::-1][:2]
+    eigenvalues, eigenvectors = eigenvalues[order], eigenvectors[:, order]
+    positive = eigenvalues > 1e-12
+    pseudo_inverse = np.zeros_like(eigenvectors)
+    pseudo_inverse[:, positive] = eigenvectors[:, positive] / np.sqrt(eigenvalues[positive])
+
+    mean = squared.mean(axis=0)
+    coords = np.zeros((len(profile), 2))
+    for start in range(0, len(profile), CHUNK_SIZE):
+        chunk = pairwise_distances(profile[start:start + CHUNK_SIZE], landmarks, metric='cosine') ** 2
+        coords[start:start + CHUNK_SIZE] = -0.5 * (chunk - mean).dot(pseudo_inverse)
+
+    return coords
+
+def _project_pca(profile, random_state):
+    import numpy as np
+    from sklearn.decomposition import PCA as SklearnPCA
+
+    # on unit length rows euclidean distances grow with the cosine distance
+    norms = np.linalg.norm(profile, axis=1, keepdims=True)
+    normalised = np.divide(profile, norms, out=np.zeros_like(profile), where=norms > 0)
+
+    components = min(2, normalised.shape[1])
+    coords = SklearnPCA(n_components=components, random_state=random_state).fit_transform(normalised)
+    if components < 2:
+        coords = np.hstack([coords, np.zeros((len(coords), 2 - components))])
+
+    return coords
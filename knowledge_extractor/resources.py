@@ -0,0 +1,109 @@
+'''
+NLTK resources module.
+
+Nothing is downloaded implicitly: the resources are fetched once with
+
+    python -m knowledge_extractor.resources
+
+and afterwards only verified, without network access.
+'''
+
+import argparse
+import sys
+
+# (resource path, package name)
+NLTK_RESOURCES = (
+    ('corpora/stopwords', 'stopwords'),
+    ('tokenizers/punkt', 'punkt'),
+    ('taggers/averaged_perceptron_tagger', 'averaged_perceptron_tagger'),
+    ('corpora/wordnet', 'wordnet'),
+)
+
+# newer NLTK releases load the tokenizer and the tagger from differently named packages
+NLTK_3_9_RESOURCES = (
+    ('tokenizers/punkt_tab', 'punkt_tab'),
+    ('taggers/averaged_perceptron_tagger_eng', 'averaged_perceptron_tagger_eng'),
+)
+
+# packages verified so far, None standing for all of them
+_verified = set()
+
+def get_required_resources():
+    import nltk
+
+    version = tuple(int(part) for part in nltk.__version__.split('.')[:2] if part.isdigit())
+    if version >= (3, 9):
+        return NLTK_RESOURCES + NLTK_3_9_RESOURCES
+    return NLTK_RESOURCES
+
+def find_missing_resources(packages=None):
+    '''
+    Returns the missing packages among the required ones, or among packages when given.
+    '''
+    import nltk
+
+    missing = []
+    for path, package in get_required_resources():
+        if packages is not None and package not in packages:
+            continue
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            try:
+                # corpora may be installed as zip archives only
+                nltk.data.find('{}.zip'.format(path))
+            except LookupError:
+                missing.append(package)
+
+    return missing
+
+def ensure_nltk_resources(packages=None):
+    '''
+    Raises LookupError if any NLTK resource, or any of packages when given, is missing. Checks the
+    local data only once per process.
+    '''
+    key = tuple(sorted(packages)) if packages is not None else None
+    if key in _verified or None in _verified:
+        return
+
+    missing = find_missing_resources(packages)
+    if missing:
+        raise LookupError('NLTK resources are missing: {}. Run python -m knowledge_extractor.resources '
+                          'to download them.'.format(', '.join(missing)))
+
+    _verified.add(key)
+
+def download_resources(download_dir=None):
+    import nltk
+
+    for package in find_missing_resources():
+        if not nltk.download(package, download_dir=download_dir):
+            raise IOError('Failed to download NLTK resource {}'.format(package))
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='download NLTK resources used for text preparation')
+
+    parser.add_argument('-c', '--check', help='only check that the resources are installed',
+                        action='store_true')
+
+    parser.add_argument('-d', '--download-dir', help='folder to download the resources to', type=str)
+
+    return parser
+
+def command_line_runner():
+    parser = get_parser()
+    args = vars(parser.parse_args())
+
+    if not args['check']:
+        download_resources(args['download_dir'])
+
+    missing = find_missing_resources()
+    if missing:
+        print('Missing NLTK resources: {}'.format(', '.join(missing)))
+        return 1
+
+    print('All NLTK resources are installed')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(command_line_runner())
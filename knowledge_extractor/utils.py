@@ -1,30 +1,336 @@
 '''
 Utilities module.
 '''
+import functools
+import gzip
+import os
 import re
+import threading
+import time
 
-import nltk
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
-from nltk import word_tokenize, pos_tag
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
+from knowledge_extractor.lemmas import get_lemma_table
+from knowledge_extractor.resources import ensure_nltk_resources
 
-nltk.download('stopwords')
-nltk.download('punkt')
-nltk.download('averaged_perceptron_tagger')
-nltk.download('wordnet')
+# part of the prepared text cache key, change it whenever text_prepare produces different output
+PREPROCESSING_VERSION = '1'
+
+# nltk: NLTK tokeniser, part of speech tagger and WordNet lemmatiser
+# fast: regex tokeniser and the lemma table of knowledge_extractor.lemmas, no tagger
+NLTK = 'nltk'
+FAST = 'fast'
+PREPROCESSING = os.environ.get('PREPROCESSING', NLTK)
 
 RE_HTML_CLEAN = re.compile('<.*?>')
 REPLACE_BY_SPACE_RE = re.compile(r'[/(){}\[\]\|@,;]')
 GOOD_SYMBOLS_RE = re.compile(r'[^0-9a-z #+_]')
-STOPWORDS = set(stopwords.words('english'))
-wnl = WordNetLemmatizer()
+WORD_RE = re.compile(r'[0-9a-z#+_]+')
+
+_stopwords = None
+
+# NLTK takes a noticeable time to import, so it is imported on first use only
+def word_tokenize(text):
+    from nltk import word_tokenize as nltk_word_tokenize
+    return nltk_word_tokenize(text)
+
+def pos_tag(tokens):
+    from nltk import pos_tag as nltk_pos_tag
+    return nltk_pos_tag(tokens)
+
+def pos_tag_sents(sentences):
+    from nltk import pos_tag_sents as nltk_pos_tag_sents
+    return nltk_pos_tag_sents(sentences)
+
+def get_stopwords():
+    global _stopwords
+    if _stopwords is None:
+        from nltk.corpus import stopwords
+        _stopwords = set(stopwords.words('english'))
+    return _stopwords
+
+class LazyLemmatizer(object):
+    def __init__(self):
+        self._lemmatizer = None
+
+    def lemmatize(self, word, pos='n'):
+        if self._lemmatizer is None:
+            from nltk.stem import WordNetLemmatizer
+            self._lemmatizer = WordNetLemmatizer()
+        return self._lemmatizer.lemmatize(word, pos)
+
+wnl = LazyLemmatizer()
+
+# 0 shares the processors among the processes that prepare text at the same time, see set_text_prepare_share
+TEXT_PREPARE_PROCESSES = int(os.environ.get('TEXT_PREPARE_PROCESSES', '0'))
+
+LEMMA_CACHE_SIZE = int(os.environ.get('LEMMA_CACHE_SIZE', '500000'))
+LEMMA_CACHE_FILE = os.environ.get(
+    'LEMMA_CACHE_FILE',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'lemmas.tsv.gz')
+)
+# every save rewrites the whole file, so it is saved after this many new lemmas or seconds only
+LEMMA_CACHE_SAVE_ENTRIES = int(os.environ.get('LEMMA_CACHE_SAVE_ENTRIES', '10000'))
+LEMMA_CACHE_SAVE_INTERVAL = float(os.environ.get('LEMMA_CACHE_SAVE_INTERVAL', '600'))
+
+class LemmaCache(object):
+    '''
+    Bounded LRU memo of WordNet lemmatisation results keyed by (word, pos), with hit and miss
+    counters. The cache can be saved to and loaded from a gzipped "word<TAB>pos<TAB>lemma" file.
+    '''
+    def __init__(self, max_size=LEMMA_CACHE_SIZE, file_name=LEMMA_CACHE_FILE):
+        self.max_size = max_size
+        self.file_name = file_name
+        self.track_new_entries = False
+        self.hits = 0
+        self.misses = 0
+        self._lemmas = OrderedDict()
+        self._new_entries = []
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._unsaved = 0
+        self._saved_at = time.time()
+
+    def __len__(self):
+        return len(self._lemmas)
+
+    def lemmatize(self, word, pos=None):
+        key = (word, pos)
+        with self._lock:
+            lemma = self._lemmas.get(key)
+            if lemma is not None:
+                self.hits += 1
+                self._lemmas.move_to_end(key)
+                return lemma
+
+        lemma = wnl.lemmatize(word, pos) if pos else wnl.lemmatize(word)
+
+        with self._lock:
+            self.misses += 1
+            self._put(key, lemma)
+            if self.track_new_entries:
+                self._new_entries.append((word, pos, lemma))
+
+        return lemma
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            'size': len(self._lemmas),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hit_rate(), 4)
+        }
+
+    def drain(self):
+        '''
+        Returns the entries and counters collected since the previous call and resets them,
+        so that a worker process can hand them over to the parent.
+        '''
+        with self._lock:
+            delta = (self._new_entries, self.hits, self.misses)
+            self._new_entries = []
+            self.hits = 0
+            self.misses = 0
+        return delta
+
+    def merge(self, entries, hits=0, misses=0):
+        with self._lock:
+            for word, pos, lemma in entries:
+                self._put((word, pos), lemma)
+            self.hits += hits
+            self.misses += misses
+
+    def save(self, file_name=None):
+        file_name = file_name or self.file_name
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = list(self._lemmas.items())
+            self._dirty = False
+            self._unsaved = 0
+            self._saved_at = time.time()
+
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        temp_file_name = '{}.{}.tmp'.format(file_name, os.getpid())
+        with gzip.open(temp_file_name, 'wt', encoding='utf-8') as cache_file:
+            for (word, pos), lemma in entries:
+                cache_file.write('{}\t{}\t{}\n'.format(word, pos or '', lemma))
+        os.replace(temp_file_name, file_name)
+
+    def save_if_due(self, entries=LEMMA_CACHE_SAVE_ENTRIES, interval=LEMMA_CACHE_SAVE_INTERVAL):
+        '''
+        Saves the cache once entries lemmas were added since the last save, or interval seconds
+        after it if any were.
+        '''
+        with self._lock:
+            due = self._dirty and (self._unsaved >= entries or time.time() - self._saved_at >= interval)
+        if due:
+            self.save()
 
-def text_prepare(text):
+    def load(self, file_name=None):
+        file_name = file_name or self.file_name
+        if not os.path.isfile(file_name):
+            return
+
+        with gzip.open(file_name, 'rt', encoding='utf-8') as cache_file, self._lock:
+            for line in cache_file:
+                word, pos, lemma = line.rstrip('\n').split('\t')
+                key = (word, pos or None)
+                if key not in self._lemmas:
+                    self._lemmas[key] = lemma
+                    if len(self._lemmas) > self.max_size:
+                        self._lemmas.popitem(last=False)
+
+    def _put(self, key, lemma):
+        self._lemmas[key] = lemma
+        self._lemmas.move_to_end(key)
+        self._dirty = True
+        self._unsaved += 1
+        if len(self._lemmas) > self.max_size:
+            self._lemmas.popitem(last=False)
+
+lemma_cache = LemmaCache()
+_lemma_cache_loaded = False
+
+def get_lemma_cache():
+    global _lemma_cache_loaded
+    if not _lemma_cache_loaded:
+        _lemma_cache_loaded = True
+        lemma_cache.load()
+        # unlike atexit, also run when the worker processes of the training scheduler exit
+        from multiprocessing.util import Finalize
+        Finalize(None, _save_lemma_cache, exitpriority=0)
+    return lemma_cache
+
+def _save_lemma_cache():
+    # text preparation workers hand their lemmas over to the process that started them instead
+    if not lemma_cache.track_new_entries:
+        lemma_cache.save()
+
+def get_preprocessing_version(mode=None):
+    '''
+    Returns the version of the output of the preprocessing mode, for the prepared text cache keys.
+    '''
+    if (mode or PREPROCESSING) == FAST:
+        return '{}-{}-{}'.format(PREPROCESSING_VERSION, FAST, get_lemma_table().get_digest())
+    return PREPROCESSING_VERSION
+
+def ensure_preprocessing_resources(mode=None):
+    '''
+    Raises LookupError if the data the preprocessing mode needs is missing.
+    '''
+    mode = mode or PREPROCESSING
+    if mode == FAST:
+        ensure_nltk_resources(['stopwords'])
+        get_lemma_table()
+    elif mode == NLTK:
+        ensure_nltk_resources()
+    else:
+        raise ValueError('Unknown preprocessing mode {}'.format(mode))
+
+def text_prepare(text, mode=None):
+    if (mode or PREPROCESSING) == FAST:
+        return _prepare_line_fast(text, get_lemma_table())
+
+    text = _clean_text(text)
+    text = _lemmatize_tagged(pos_tag(word_tokenize(text)))
+    return text.strip()
+
+_text_prepare_share = 1
+_executor = None
+_executor_processes = 0
+_executor_lock = threading.Lock()
+
+def set_text_prepare_share(share):
+    '''
+    Sets the number of processes of the machine that prepare text at the same time, e.g. the
+    training workers, so that the pool of each one takes its share of the processors only.
+    '''
+    global _text_prepare_share
+    _text_prepare_share = max(1, share)
+
+def get_text_prepare_processes():
+    return TEXT_PREPARE_PROCESSES or max(1, (os.cpu_count() or 1) // _text_prepare_share)
+
+def text_prepare_batch(documents, processes=None, progress=None, mode=None):
+    '''
+    Prepares a batch of documents, each one either a string or an iterable of lines, and returns
+    the prepared texts in input order. Documents are spread over the pool of processes of this
+    process and all lines of a document are tagged in one pos_tag_sents call. progress is called
+    with the number of documents prepared so far.
+    '''
+    mode = mode or PREPROCESSING
+    documents = [doc if isinstance(doc, str) else list(doc) for doc in documents]
+    processes = processes or get_text_prepare_processes()
+
+    cache = get_lemma_cache()
+
+    prepared = []
+    if min(processes, len(documents)) <= 1:
+        for doc in documents:
+            prepared.append(_prepare_document(doc, mode))
+            if progress is not None:
+                progress(len(prepared))
+    else:
+        worker = functools.partial(_prepare_document_in_worker, mode=mode)
+        for text, delta in _get_executor(processes).map(worker, documents):
+            cache.merge(*delta)
+            prepared.append(text)
+            if progress is not None:
+                progress(len(prepared))
+
+    cache.save_if_due()
+    return prepared
+
+def _get_executor(processes):
+    '''
+    Returns the pool of text preparation processes, started on first use and kept for the next
+    batches; another number of processes replaces it.
+    '''
+    global _executor, _executor_processes
+    with _executor_lock:
+        if _executor is None or _executor_processes != processes:
+            if _executor is not None:
+                _executor.shutdown()
+            _executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_worker)
+            _executor_processes = processes
+        return _executor
+
+def _init_worker():
+    # forked workers inherit the parent's counters, only what they add themselves is reported back
+    get_lemma_cache().drain()
+    lemma_cache.track_new_entries = True
+
+def _prepare_document_in_worker(document, mode=NLTK):
+    text = _prepare_document(document, mode)
+    return text, lemma_cache.drain()
+
+def _prepare_document(document, mode=NLTK):
+    lines = document.splitlines() if isinstance(document, str) else document
+    if mode == FAST:
+        table = get_lemma_table()
+        return ' '.join([text for text in (_prepare_line_fast(line, table) for line in lines) if text])
+
+    tagged = pos_tag_sents([word_tokenize(_clean_text(line)) for line in lines])
+    return ' '.join([text for text in (_lemmatize_tagged(tags) for tags in tagged) if text])
+
+def _prepare_line_fast(line, table):
+    lemmas = table.lemmas
+    return ' '.join([lemmas.get(word, word) for word in WORD_RE.findall(_clean_text(line))])
+
+def _clean_text(text):
     text = text.lower()
     text = RE_HTML_CLEAN.sub(' ', text)
     text = REPLACE_BY_SPACE_RE.sub(' ', text)
     text = GOOD_SYMBOLS_RE.sub('', text)
-    text = ' '.join([x for x in text.split() if x and x not in STOPWORDS])
-    text = ' '.join([wnl.lemmatize(i,j[0].lower()) if j[0].lower() in ['a','n','v'] else wnl.lemmatize(i) for i,j in pos_tag(word_tokenize(text))])
-    return text.strip()
\ No newline at end of file
+    stopwords = get_stopwords()
+    return ' '.join([x for x in text.split() if x and x not in stopwords])
+
+def _lemmatize_tagged(tagged):
+    cache = get_lemma_cache()
+    return ' '.join([cache.lemmatize(i,j[0].lower()) if j[0].lower() in ['a','n','v'] else cache.lemmatize(i) for i,j in tagged])
\ No newline at end of file
@@ -0,0 +1,120 @@
+'''
+Scratch workspace module.
+
+Every training gets its own folder for the vocabulary file, the batches and the dictionary, so
+that trainings running at the same time never see each other's files. The folder is removed when
+the training ends.
+'''
+
+import os
+import shutil
+import tempfile
+
+SHM_DIR = '/dev/shm'
+
+# SCRATCH_TMPFS=1 keeps the workspaces in memory backed /dev/shm where it exists
+SCRATCH_TMPFS = os.environ.get('SCRATCH_TMPFS', '0') != '0'
+SCRATCH_DIR = os.environ.get('SCRATCH_DIR') or (SHM_DIR if SCRATCH_TMPFS and os.path.isdir(SHM_DIR) else None)
+SCRATCH_MAX_BYTES = int(os.environ.get('SCRATCH_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+
+PREFIX = 'topic_model_'
+
+class WorkspaceFullError(IOError):
+    pass
+
+class Workspace(object):
+    '''
+    Temporary folder named topic_model_<pid>_<random> under root (the system temporary folder by
+    default), limited to max_bytes.
+    '''
+    def __init__(self, root=None, max_bytes=SCRATCH_MAX_BYTES):
+        self.root = root or SCRATCH_DIR
+        self.max_bytes = max_bytes
+        self.path = None
+
+    def __enter__(self):
+        if self.root:
+            os.makedirs(self.root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix='{}{}_'.format(PREFIX, os.getpid()), dir=self.root)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    def get_path(self, name):
+        return os.path.join(self.path, name)
+
+    def usage(self):
+        total = 0
+        for dir_path, _, file_names in os.walk(self.path):
+            for file_name in file_names:
+                try:
+                    total += os.path.getsize(os.path.join(dir_path, file_name))
+                except OSError:
+                    pass
+        return total
+
+    def check(self, projected=0):
+        '''
+        Raises WorkspaceFullError once the files in the workspace, plus projected bytes about to be
+        written, take more than max_bytes. The files are removed then, so that a failed training
+        frees the space at once.
+        '''
+        usage = self.usage()
+        if usage + projected > self.max_bytes:
+            self.clear()
+            raise WorkspaceFullError('Workspace {} uses {} bytes and needs {} more, the limit is {}'.format(
+                self.path, usage, projected, self.max_bytes))
+        return usage
+
+    def clear(self):
+        '''
+        Removes the files in the workspace and keeps the folder.
+        '''
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def cleanup(self):
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+def remove_stale_workspaces(root=None):
+    '''
+    Removes the workspaces left behind by processes that no longer run, e.g. after a crash.
+    '''
+    root = root or SCRATCH_DIR or tempfile.gettempdir()
+    if not os.path.isdir(root):
+        return 0
+
+    removed = 0
+    for name in os.listdir(root):
+        if not name.startswith(PREFIX):
+            continue
+        pid = name[len(PREFIX):].split('_')[0]
+        if not pid.isdigit() or _is_running(int(pid)):
+            continue
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+        removed += 1
+
+    return removed
+
+def _is_running(pid):
+    if os.name == 'nt':
+        # os.kill terminates the process on Windows, so workspaces there are never reclaimed by pid
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists but belongs to another user
+        return True
+    return True
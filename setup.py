@@ -46,7 +46,7 @@ setup(
         "Environment :: Console",
         "Intended Audience :: Developers",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.7",
         "Topic :: Documentation",
     ],
     keywords='document extract XML',
@@ -56,7 +56,9 @@ setup(
     maintainer_email='imalkevich@gmail.com',
     url='https://github.com/imalkevich/document_extractor',
     license='MIT',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
+    # ProcessPoolExecutor(initializer=..., mp_context=...) and http.server.ThreadingHTTPServer
+    python_requires='>=3.7',
     entry_points={
         'console_scripts': [
             'document_extractor = document_extractor.extractor:command_line_runner',
@@ -75,5 +77,8 @@ setup(
         'tqdm',
         'waitress'
     ] + extra_dependencies(),
+    extras_require={
+        'lxml': ['lxml']
+    },
     test_require = ['coverage', 'codecov']
 )
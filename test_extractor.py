@@ -2,12 +2,88 @@
 Tests for extractor module.
 '''
 
+import importlib.util
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
 import unittest
 import unittest.mock as mock
 
-from extractor.loader import DocumentRawLoader
-from knowledge_extractor.models import TopicModel
-from api.topic_modelling import command_line_runner
+from collections import Counter
+from concurrent.futures import Future
+
+from extractor.journal import LoadJournal, RetryQueue
+from extractor.metrics import MetricsRegistry
+from extractor.profiling import Profiler, is_enabled, profiled
+from extractor.loader import DocumentRawLoader, RateLimiter, parse_shard
+from extractor.merge import merge
+from extractor.paragraphs import get_backend, lxml_etree
+from extractor.store import DirectoryStore, PackStore, migrate
+from benchmarks.server import DocumentServer
+from benchmarks.startup import ENTRY_POINTS, STARTUP_BUDGET, run_entry_point
+from knowledge_extractor.cache import PreparedTextCache, get_text_key
+from knowledge_extractor.lemmas import LemmaTable
+from knowledge_extractor.models import TopicModel, get_tau_scale, get_topic_profile_matrix
+from knowledge_extractor.projection import get_method, project
+from knowledge_extractor.resources import ensure_nltk_resources
+from knowledge_extractor.utils import (FAST, LemmaCache, _save_lemma_cache, get_preprocessing_version,
+                                       get_text_prepare_processes, set_text_prepare_share, text_prepare_batch)
+from knowledge_extractor.workspace import Workspace, WorkspaceFullError, remove_stale_workspaces
+from api.registry import ModelRegistry, get_model_key
+from api.scheduler import QueueFullError, TrainingJob, TrainingScheduler, get_priority
+from api.topic_modelling import (TopicModelApi, TopicModelStatusApi, command_line_runner, get_status, get_status_events,
+                                 get_wait, serialise_model)
+
+DOCUMENT_XML = '''
+    <Document>
+        <n-docbody>
+            <opinion.block>
+                <opinion.block.body>
+                    <opinion.lead>
+                        <opinion.body>
+                            <section id="1">
+                                <head>
+                                This is head 1.
+                                </head>
+                                <section.body>
+                                    <para>
+                                        <bop/>
+                                        <bos/>
+                                        <paratext>
+                                            <starpage.anchor>1</starpage.anchor>
+                                            The first section test text one goes here.
+                                            <eos/>
+                                            <bos/>
+                                            The first section test text two goes here.
+                                        </paratext>
+                                    </para>
+                                </section.body>
+                            </section>
+                            <section id="2">
+                                <head>
+                                This is head 2.
+                                </head>
+                                <section.body>
+                                    <para>
+                                        <bop/>
+                                        <bos/>
+                                        <paratext>
+                                            <starpage.anchor>2</starpage.anchor>
+                                            The second test text goes here.
+                                        </paratext>
+                                    </para>
+                                </section.body>
+                            </section>
+                        </opinion.body>
+                    </opinion.lead>
+                </opinion.block.body>
+            </opinion.block>
+        </n-docbody>
+    </Document>
+'''
 
 class DocumentRawLoaderTestCase(unittest.TestCase):
     def setUp(self):
@@ -17,71 +93,32 @@ class DocumentRawLoaderTestCase(unittest.TestCase):
         pass
 
     @mock.patch('extractor.loader.requests')
-    def test_load_doc_by_guid(self, mock_requests):
+    def test_stream_text_by_guid(self, mock_requests):
         # arrange
+        xml = DOCUMENT_XML.encode('utf-8')
         mock_response = mock.Mock()
-        mock_response.text = 'some_xml'
+        mock_response.iter_content = mock.MagicMock(side_effect=lambda chunk_size: [xml[:100], xml[100:]])
         mock_session = mock.MagicMock()
         mock_session.get = mock.MagicMock(return_value=mock_response)
         mock_requests.session = mock.MagicMock(return_value=mock_session)
 
-        loader = DocumentRawLoader('doc_guids.txt')
+        loader = DocumentRawLoader('doc_guids.txt', store=mock.MagicMock(), journal=mock.MagicMock(),
+                                   url='http://host/{}')
 
         # act
-        xml = loader._load_doc_by_guid('some_guid')
+        first = list(loader._stream_text_by_guid('some_guid'))
+        second = list(loader._stream_text_by_guid('other_guid'))
 
         # assert
-        self.assertEqual(xml, 'some_xml')
+        self.assertEqual(first, loader._extract_text_from_xml(xml))
+        self.assertEqual(second, first)
+        mock_requests.session.assert_called_once_with()
+        mock_session.get.assert_called_with('http://host/other_guid', headers=mock.ANY, stream=True)
+        self.assertEqual(mock_response.close.call_count, 2)
 
     def test_extract_text_from_xml(self):
         # arrange
-        xml = '''
-            <Document>
-                <n-docbody>
-                    <opinion.block>
-                        <opinion.block.body>
-                            <opinion.lead>
-                                <opinion.body>
-                                    <section id="1">
-                                        <head>
-                                        This is head 1.
-                                        </head>
-                                        <section.body>
-                                            <para>
-                                                <bop/>
-                                                <bos/>
-                                                <paratext>
-                                                    <starpage.anchor>1</starpage.anchor>
-                                                    The first section test text one goes here.
-                                                    <eos/>
-                                                    <bos/>
-                                                    The first section test text two goes here.
-                                                </paratext>
-                                            </para>
-                                        </section.body>
-                                    </section>
-                                    <section id="2">
-                                        <head>
-                                        This is head 2.
-                                        </head>
-                                        <section.body>
-                                            <para>
-                                                <bop/>
-                                                <bos/>
-                                                <paratext>
-                                                    <starpage.anchor>2</starpage.anchor>
-                                                    The second test text goes here.
-                                                </paratext>
-                                            </para>
-                                        </section.body>
-                                    </section>
-                                </opinion.body>
-                            </opinion.lead>
-                        </opinion.block.body>
-                    </opinion.block>
-                </n-docbody>
-            </Document>
-        '''
+        xml = DOCUMENT_XML
 
         # act
         texts = DocumentRawLoader('doc_guids.txt')._extract_text_from_xml(xml)
@@ -92,24 +129,55 @@ class DocumentRawLoaderTestCase(unittest.TestCase):
             'The second test text goes here.'
         ])
 
-    @mock.patch('extractor.loader.open')
-    def test_save_text(self, mock_open):
+    @unittest.skipIf(lxml_etree is None, 'lxml is not installed')
+    def test_extract_text_with_lxml_backend(self):
+        # arrange
+        loader = DocumentRawLoader('doc_guids.txt', xml_backend='lxml')
+        data = DOCUMENT_XML.strip().encode('utf-8')
+
+        # act
+        texts = loader._extract_text_from_xml(DOCUMENT_XML)
+        streamed = list(loader._extract_text_from_stream([data[:100], data[100:]]))
+
+        # assert
+        expected = DocumentRawLoader('doc_guids.txt', xml_backend='etree')._extract_text_from_xml(DOCUMENT_XML)
+        self.assertEqual(texts, expected)
+        self.assertEqual(streamed, expected)
+
+    def test_get_paragraph_text_keeps_serialised_form(self):
+        # arrange
+        node = get_backend('etree').fromstring(
+            '<paratext><starpage.anchor>12</starpage.anchor>A &amp; B <emphasis>“quoted”</emphasis><eos/>end\n42\n</paratext>'
+        )
+
+        # act
+        text = DocumentRawLoader('doc_guids.txt')._get_paragraph_text(node)
+
+        # assert
+        self.assertEqual(text, '12 A &amp; B quoted end')
+
+    def test_extract_text_from_stream(self):
+        # arrange
+        data = DOCUMENT_XML.strip().encode('utf-8')
+        chunks = [data[i:i + 16] for i in range(0, len(data), 16)]
+
+        # act
+        texts = list(DocumentRawLoader('doc_guids.txt')._extract_text_from_stream(chunks))
+
+        # assert
+        self.assertEqual(texts, DocumentRawLoader('doc_guids.txt')._extract_text_from_xml(DOCUMENT_XML))
+
+    def test_save_text(self):
         # arrange
         lines = ['one', 'two']
 
-        loader = DocumentRawLoader('doc_guids.txt')
-        loader._get_file_name = mock.MagicMock(return_value='file.txt')
+        loader = DocumentRawLoader('doc_guids.txt', store=mock.MagicMock())
 
         # act
         loader._save_text('guid', lines)
 
         # assert
-        mock_open.assert_called_with('file.txt', 'w', encoding='utf-8')
-        handle = mock_open()
-        handle.assert_has_calls([
-            mock.call.__enter__().write('one\n'), 
-            mock.call.__enter__().write('two\n')
-        ])
+        loader.store.write.assert_called_with('guid', lines)
 
     @mock.patch('extractor.loader.open')
     def test_get_doc_guids(self, mock_open):
@@ -135,6 +203,140 @@ class DocumentRawLoaderTestCase(unittest.TestCase):
         self.assertEqual(guids, [ 'one', 'two', 'three' ])
 
 
+    @mock.patch('extractor.loader.requests')
+    def test_load_concurrently_shares_session(self, mock_requests):
+        # arrange
+        mock_response = mock.Mock()
+        mock_response.iter_content = mock.MagicMock(side_effect=lambda chunk_size: [DOCUMENT_XML.encode('utf-8')])
+        mock_session = mock.MagicMock()
+        mock_session.get = mock.MagicMock(return_value=mock_response)
+        mock_requests.session = mock.MagicMock(return_value=mock_session)
+
+        store = mock.MagicMock()
+        store.missing = mock.MagicMock(side_effect=lambda guids: list(guids))
+        store.write = mock.MagicMock(side_effect=lambda guid, lines: list(lines))
+        journal = mock.MagicMock()
+        journal.loaded = mock.MagicMock(return_value=set())
+        loader = DocumentRawLoader(doc_guids=['one', 'two', 'three'], concurrency=3, store=store, journal=journal)
+
+        # act
+        loader.load()
+
+        # assert
+        mock_requests.session.assert_called_once_with()
+        self.assertEqual(mock_session.get.call_count, 3)
+        self.assertEqual(store.write.call_count, 3)
+        mock_session.close.assert_called_once_with()
+
+    def test_load_resumes_from_journal_and_retries_failures(self):
+        # arrange
+        store = mock.MagicMock()
+        store.kind = 'pack'
+        store.missing = mock.MagicMock(side_effect=lambda guids: [guid for guid in guids if guid != 'stored'])
+        temp_dir = tempfile.mkdtemp()
+        journal = LoadJournal(os.path.join(temp_dir, 'load_journal.log'))
+        journal.record_success('stored', 0.1, store='pack')
+        # loaded into a store of another kind
+        journal.record_success('elsewhere', 0.1, store='directory')
+
+        loader = DocumentRawLoader(doc_guids=['stored', 'elsewhere', 'flaky'], store=store, journal=journal,
+                                   retry_backoff=0)
+        loader._stream_text_by_guid = mock.MagicMock(side_effect=[['text'], IOError('timeout'), ['text']])
+
+        # act
+        loader.load()
+
+        # assert
+        loader._stream_text_by_guid.assert_has_calls([mock.call('elsewhere'), mock.call('flaky'), mock.call('flaky')])
+        store.missing.assert_called_once_with(['elsewhere', 'flaky'])
+        store.write.assert_has_calls([mock.call('elsewhere', ['text']), mock.call('flaky', ['text'])])
+        self.assertEqual(journal.failed(), {})
+        self.assertEqual(LoadJournal(journal.file_name).loaded('pack'), set(['stored', 'elsewhere', 'flaky']))
+        other = DocumentRawLoader(doc_guids=[], store=DirectoryStore(os.path.join(temp_dir, 'other')))
+        self.assertEqual(other.journal.file_name, os.path.join(temp_dir, 'other', 'load_journal.log'))
+        shutil.rmtree(temp_dir)
+
+    def test_retry_queue_backoff(self):
+        # arrange
+        queue = RetryQueue(backoff=2.0, max_delay=5.0)
+
+        # act
+        with mock.patch('extractor.journal.time') as mock_time:
+            mock_time.monotonic = mock.MagicMock(return_value=100.0)
+            queue.push('one', 1)
+            queue.push('two', 3)
+            mock_time.monotonic = mock.MagicMock(return_value=102.0)
+            first = queue.pop_due()
+            mock_time.monotonic = mock.MagicMock(return_value=105.0)
+            second = queue.pop_due()
+
+        # assert
+        self.assertEqual(first, [('one', 2)])
+        self.assertEqual(second, [('two', 4)])
+
+    @mock.patch('extractor.loader.time')
+    def test_rate_limiter_spaces_requests_per_host(self, mock_time):
+        # arrange
+        mock_time.monotonic = mock.MagicMock(return_value=100.0)
+        limiter = RateLimiter(rate=4)
+
+        # act
+        limiter.wait('host_a')
+        limiter.wait('host_a')
+        limiter.wait('host_b')
+
+        # assert
+        mock_time.sleep.assert_called_once_with(0.25)
+
+    def test_shards_partition_deduplicated_guids(self):
+        # arrange
+        guids = ['I{:032x}'.format(idx) for idx in range(200)]
+        doc_guids = guids + guids[:50] + ['']
+
+        # act
+        shards = [list(DocumentRawLoader(doc_guids=doc_guids, store=object(), journal=object(),
+                                         shard=parse_shard('{}/3'.format(index)))._iter_doc_guids())
+                  for index in range(3)]
+
+        # assert
+        self.assertEqual(sorted(sum(shards, [])), guids)
+        self.assertTrue(all(len(shard) > 40 for shard in shards))
+        self.assertEqual(shards[1], [guid for guid in guids if guid in shards[1]])
+        with self.assertRaises(ValueError):
+            parse_shard('3/3')
+
+    def test_dedup_can_be_limited_to_chunks(self):
+        # arrange
+        doc_guids = ['one', 'one', 'two', 'three', 'one', 'three']
+
+        # act
+        with mock.patch('extractor.loader.LOAD_CHUNK_SIZE', 2):
+            dedup = list(DocumentRawLoader(doc_guids=doc_guids, store=object(), journal=object())._iter_doc_guids())
+            chunked = list(DocumentRawLoader(doc_guids=doc_guids, store=object(), journal=object(),
+                                             dedup=False)._iter_doc_guids())
+
+        # assert
+        self.assertEqual(dedup, ['one', 'two', 'three'])
+        self.assertEqual(chunked, ['one', 'two', 'three', 'one'])
+
+    def test_load_from_document_server(self):
+        # arrange
+        temp_dir = tempfile.mkdtemp()
+        store = PackStore(temp_dir)
+        journal = LoadJournal(os.path.join(temp_dir, 'load_journal.log'))
+
+        # act
+        with DocumentServer(num_paragraphs=3) as server:
+            loader = DocumentRawLoader(doc_guids=['one', 'two'], store=store, journal=journal, url=server.url)
+            loader.load()
+            expected = loader._extract_text_from_xml(server.get_document('two'))
+
+        # assert
+        self.assertEqual(server.requests, 2)
+        self.assertEqual([line.rstrip('\n') for line in store.read_lines('two')], expected)
+        self.assertEqual(len(expected), 3)
+        shutil.rmtree(temp_dir)
+
     ''' DEBUG 
     def test_load(self):
         # arrange
@@ -147,12 +349,516 @@ class DocumentRawLoaderTestCase(unittest.TestCase):
         # assert
     '''
 
+class MetricsTestCase(unittest.TestCase):
+    def test_worker_metrics_are_merged(self):
+        # arrange
+        worker, api = MetricsRegistry(), MetricsRegistry()
+        worker.counter('documents_total', stage='prepare').inc(3)
+        worker.histogram('pipeline_stage_seconds', stage='fit').observe(0.2)
+        worker.histogram('pipeline_stage_seconds', stage='fit').observe(20)
+        api.histogram('pipeline_stage_seconds', stage='fit').observe(0.2)
+        api.gauge('training_jobs', lambda: 2, state='running')
+
+        # act
+        api.merge(worker.drain())
+        api.merge(worker.drain())
+        text = api.render()
+
+        # assert
+        histogram = api.histogram('pipeline_stage_seconds', stage='fit')
+        self.assertEqual(histogram.count, 3)
+        self.assertEqual(histogram.quantile(0.5), 0.25)
+        self.assertEqual(histogram.quantile(1.0), 30.0)
+        self.assertIn('documents_total{stage="prepare"} 3\n', text)
+        self.assertIn('pipeline_stage_seconds_bucket{le="+Inf",stage="fit"} 3\n', text)
+        self.assertIn('# TYPE pipeline_stage_seconds histogram\n', text)
+        self.assertIn('training_jobs{state="running"} 2\n', text)
+
+class ProfilingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_profiler_writes_dumps_within_budget(self):
+        # arrange
+        dumps = []
+
+        # act
+        for index in range(3):
+            with Profiler('train_{}'.format(index), self.temp_dir, max_bytes=10 ** 9) as profiler:
+                sorted(str(value) for value in range(1000))
+            dumps.append(profiler.files)
+        with open(dumps[0][1], encoding='utf-8') as allocations:
+            header = allocations.readline()
+        sizes = sum(os.path.getsize(file_name) for file_name in dumps[-1])
+        with Profiler('request', self.temp_dir, max_bytes=sizes * 2):
+            pass
+
+        # assert
+        self.assertTrue(dumps[0][0].endswith('_train_0.prof'))
+        self.assertTrue(header.startswith('peak traced memory'))
+        self.assertFalse(os.path.exists(dumps[0][0]))
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(self.temp_dir, name))
+                                 for name in os.listdir(self.temp_dir)), sizes * 2)
+
+    def test_profiled_disabled(self):
+        # act
+        with profiled('request', '0', self.temp_dir) as profiler:
+            pass
+
+        # assert
+        self.assertIsNone(profiler)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+        self.assertEqual([is_enabled(flag) for flag in ('1', 'Yes', True, 'no', 'high', mock.MagicMock(), False)],
+                         [True, True, True, False, False, False, False])
+
+class DocumentStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    @mock.patch('extractor.store.os')
+    @mock.patch('extractor.store.open')
+    def test_directory_store_write(self, mock_open, mock_os):
+        # arrange
+        store = DirectoryStore('documents')
+        store._get_file_name = mock.MagicMock(return_value='file.txt')
+
+        # act
+        store.write('guid', ['one', 'two'])
+
+        # assert
+        mock_open.assert_called_with('file.txt.part', 'w', encoding='utf-8')
+        handle = mock_open()
+        handle.assert_has_calls([
+            mock.call.__enter__().write('one\n'), 
+            mock.call.__enter__().write('two\n')
+        ])
+        mock_os.replace.assert_called_with('file.txt.part', 'file.txt')
+
+    @mock.patch('extractor.store.os')
+    @mock.patch('extractor.store.open')
+    def test_directory_store_discards_partial_file(self, mock_open, mock_os):
+        # arrange
+        def lines():
+            yield 'one'
+            raise IOError('connection reset')
+
+        store = DirectoryStore('documents')
+        store._get_file_name = mock.MagicMock(return_value='file.txt')
+        mock_os.path.isfile = mock.MagicMock(return_value=True)
+
+        # act
+        with self.assertRaises(IOError):
+            store.write('guid', lines())
+
+        # assert
+        mock_os.replace.assert_not_called()
+        mock_os.remove.assert_called_with('file.txt.part')
+
+    def test_pack_store(self):
+        for compress in (True, False):
+            # arrange
+            path = os.path.join(self.temp_dir, str(compress))
+            store = PackStore(path, compress=compress)
+
+            # act
+            store.write('one', ['first line', 'second line'])
+            store.write('two', [])
+            reopened = PackStore(path)
+
+            # assert
+            self.assertEqual(list(store.read_lines('one')), ['first line\n', 'second line\n'])
+            self.assertEqual(reopened.first_line('one'), 'first line\n')
+            self.assertEqual(reopened.first_line('two'), None)
+            self.assertEqual(reopened.missing(['one', 'two', 'three']), ['three'])
+            store.close()
+            reopened.close()
+
+    def test_migrate(self):
+        # arrange
+        source = DirectoryStore(self.temp_dir)
+        source.write('one', ['text of one'])
+        source.write('two', ['text of two'])
+        target = PackStore(os.path.join(self.temp_dir, 'pack'))
+        target.write('two', ['text of two'])
+
+        # act
+        counter = migrate(source, target)
+
+        # assert
+        self.assertEqual(counter, 1)
+        self.assertEqual(target.first_line('one'), 'text of one\n')
+        target.close()
+
+    def test_merge_node_stores_and_journals(self):
+        # arrange
+        nodes = [os.path.join(self.temp_dir, 'node_0'), os.path.join(self.temp_dir, 'node_1')]
+        DirectoryStore(nodes[0]).write('one', ['text of one'])
+        LoadJournal(os.path.join(nodes[0], 'load_journal.log')).record_success('one', 0.1)
+        node = PackStore(nodes[1])
+        node.write('two', ['text of two'])
+        node.close()
+        journal = LoadJournal(os.path.join(nodes[1], 'load_journal.log'))
+        journal.record_success('two', 0.1)
+        journal.record_failure('three', 0.1, 'timeout')
+        target = PackStore(os.path.join(self.temp_dir, 'documents'))
+
+        # act
+        first = merge(nodes, target)
+        second = merge(nodes, target)
+
+        # assert
+        self.assertEqual(first, (2, 3))
+        self.assertEqual(second, (0, 0))
+        self.assertEqual(target.first_line('two'), 'text of two\n')
+        merged = LoadJournal(os.path.join(target.path, 'load_journal.log'))
+        self.assertEqual(merged.loaded('pack'), set(['one', 'two']))
+        self.assertEqual(list(merged.failed()), ['three'])
+        target.close()
+
+def fake_lemmatize(word, pos='n'):
+    return word[:-1] if word.endswith('s') else word
+
+class TextPrepareTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.lemma_cache = LemmaCache(file_name=os.path.join(self.temp_dir, 'lemmas.tsv.gz'))
+        self.patches = [
+            mock.patch('knowledge_extractor.utils.lemma_cache', self.lemma_cache),
+            mock.patch('knowledge_extractor.utils._stopwords', set(['the', 'of', 'a']))
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.temp_dir)
+
+    @mock.patch('knowledge_extractor.utils.wnl')
+    @mock.patch('knowledge_extractor.utils.word_tokenize', side_effect=str.split)
+    @mock.patch('knowledge_extractor.utils.pos_tag_sents',
+                side_effect=lambda sentences: [[(w, 'NN') for w in s] for s in sentences])
+    def test_text_prepare_batch(self, mock_pos_tag_sents, mock_word_tokenize, mock_wnl):
+        # arrange
+        mock_wnl.lemmatize = mock.MagicMock(side_effect=fake_lemmatize)
+        documents = [
+            iter(['The courts of appeal\n', '\n', 'Motions denied.\n']),
+            'Judgments <b>reversed</b>'
+        ]
+
+        # act
+        prepared = text_prepare_batch(documents, processes=1)
+        saved_by_batch = os.path.isfile(self.lemma_cache.file_name)
+        _save_lemma_cache()
+
+        # assert
+        self.assertEqual(prepared, ['court appeal motion denied', 'judgment reversed'])
+        self.assertEqual(mock_pos_tag_sents.call_count, 2)
+        self.assertFalse(saved_by_batch)
+        self.assertTrue(os.path.isfile(self.lemma_cache.file_name))
+
+    @mock.patch('knowledge_extractor.utils._executor', None)
+    @mock.patch('knowledge_extractor.utils.ProcessPoolExecutor')
+    def test_text_prepare_batch_keeps_its_pool(self, mock_executor):
+        # arrange
+        mock_executor.return_value.map.side_effect = lambda worker, documents: [
+            (document.lower(), ([], 0, 0)) for document in documents]
+
+        # act
+        first = text_prepare_batch(['One', 'Two'], processes=2)
+        second = text_prepare_batch(['Three', 'Four'], processes=2)
+        with mock.patch('knowledge_extractor.utils.TEXT_PREPARE_PROCESSES', 0), \
+                mock.patch('os.cpu_count', return_value=8):
+            set_text_prepare_share(2)
+            processes = get_text_prepare_processes()
+            set_text_prepare_share(1)
+
+        # assert
+        self.assertEqual((first, second), (['one', 'two'], ['three', 'four']))
+        mock_executor.assert_called_once_with(max_workers=2, initializer=mock.ANY)
+        self.assertEqual(processes, 4)
+
+    @mock.patch('knowledge_extractor.utils.pos_tag_sents')
+    @mock.patch('knowledge_extractor.utils.word_tokenize')
+    def test_text_prepare_batch_fast(self, mock_word_tokenize, mock_pos_tag_sents):
+        # arrange
+        table = LemmaTable({'courts': 'court', 'motions': 'motion', 'ruled': 'rule'},
+                           os.path.join(self.temp_dir, 'lemma_table.tsv.gz'))
+        table.save()
+        documents = [
+            iter(['The courts of appeal\n', '\n', 'Motions, ruled.\n']),
+            'Judgments <b>reversed</b>'
+        ]
+
+        # act
+        with mock.patch('knowledge_extractor.utils.get_lemma_table', return_value=LemmaTable(
+                file_name=table.file_name).load()):
+            prepared = text_prepare_batch(documents, processes=1, mode=FAST)
+            version = get_preprocessing_version(FAST)
+
+        # assert
+        self.assertEqual(prepared, ['court appeal motion rule', 'judgments reversed'])
+        mock_word_tokenize.assert_not_called()
+        mock_pos_tag_sents.assert_not_called()
+        self.assertEqual(version, '1-fast-{}'.format(table.get_digest()))
+        self.assertNotEqual(get_preprocessing_version(), version)
+
+    @mock.patch('knowledge_extractor.utils.wnl')
+    def test_lemma_cache(self, mock_wnl):
+        # arrange
+        mock_wnl.lemmatize = mock.MagicMock(side_effect=fake_lemmatize)
+        cache = LemmaCache(max_size=2, file_name=self.lemma_cache.file_name)
+
+        # act
+        lemmas = [cache.lemmatize(word, pos) for word, pos in
+                  [('courts', 'n'), ('courts', 'n'), ('rules', 'v'), ('motions', None), ('courts', 'n')]]
+        cache.save_if_due(entries=5)
+        not_due = os.path.isfile(cache.file_name)
+        cache.save_if_due(entries=4)
+        reloaded = LemmaCache(file_name=cache.file_name)
+        reloaded.load()
+
+        # assert
+        self.assertEqual(lemmas, ['court', 'court', 'rule', 'motion', 'court'])
+        self.assertFalse(not_due)
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 1, 'misses': 4, 'hit_rate': 0.2})
+        self.assertEqual(reloaded.lemmatize('motions'), 'motion')
+        self.assertEqual(reloaded.hits, 1)
+        self.assertEqual(mock_wnl.lemmatize.call_count, 4)
+
+class StartupTestCase(unittest.TestCase):
+    def test_entry_points_do_not_import_heavy_modules(self):
+        for module in ENTRY_POINTS:
+            # act
+            elapsed, heavy = run_entry_point(module)
+
+            # assert
+            self.assertEqual(heavy, [], module)
+            # leave room for slow CI machines, python -m benchmarks.startup checks the exact budget
+            self.assertLess(elapsed, STARTUP_BUDGET * 3, module)
+
+    @mock.patch('knowledge_extractor.resources.find_missing_resources', return_value=['wordnet'])
+    def test_missing_nltk_resources_are_not_downloaded(self, mock_find_missing_resources):
+        # arrange
+        with mock.patch('nltk.download') as mock_download:
+            # act
+            with self.assertRaises(LookupError):
+                ensure_nltk_resources()
+
+            # assert
+            mock_download.assert_not_called()
+
+class PreparedTextCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = PreparedTextCache(os.path.join(self.temp_dir, 'prepared.sqlite'), max_size=20)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_get_many_checks_text_key(self):
+        # arrange
+        self.cache.put_many([('one', get_text_key('text one'), 'prepared one')])
+
+        # act
+        found = self.cache.get_many(['one', 'two'], [get_text_key('text one'), get_text_key('text two')])
+        changed = self.cache.get_many(['one'], [get_text_key('text one changed')])
+
+        # assert
+        self.assertEqual(found, {'one': 'prepared one'})
+        self.assertEqual(changed, {})
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2, 'hit_rate': 0.3333})
+
+    def test_evicts_least_recently_used(self):
+        # arrange
+        self.cache.put_many([('one', 'k1', 'x' * 8), ('two', 'k2', 'y' * 8)])
+        self.cache.get_many(['one'], ['k1'])
+
+        # act
+        self.cache.put_many([('three', 'k3', 'z' * 8)])
+
+        # assert
+        self.assertEqual(self.cache.get_many(['one', 'two', 'three'], ['k1', 'k2', 'k3']),
+                         {'one': 'x' * 8, 'three': 'z' * 8})
+
 class TopicModelTestCase(unittest.TestCase):
     def setUp(self):
-        pass
+        self.temp_dir = tempfile.mkdtemp()
 
     def tearDown(self):
-        pass
+        shutil.rmtree(self.temp_dir)
+
+    @unittest.skipIf(importlib.util.find_spec('artm') is None, 'bigartm is not installed')
+    def test_build_batches(self):
+        # arrange
+        model = TopicModel('search_guid', [], store=mock.MagicMock(), prepared_cache=mock.MagicMock())
+        prepared_documents = [('one', 'court appeal court'), ('two', 'appeal'), ('three', 'jury')]
+
+        # act
+        batches, dictionary = model._build_batches(prepared_documents, batch_size=2)
+
+        # assert
+        self.assertEqual([len(batch.item) for batch in batches], [2, 1])
+        first = batches[0]
+        tokens = [(first.class_id[i], first.token[i]) for i in first.item[0].token_id]
+        self.assertEqual(dict(zip(tokens, first.item[0].token_weight)),
+                         {('text', 'court'): 2.0, ('text', 'appeal'): 1.0, ('doc_guid', 'one'): 1.0})
+        self.assertEqual(first.item[1].title, 'document_two')
+        self.assertIsNotNone(dictionary.name)
+
+    @mock.patch('knowledge_extractor.models.text_prepare_batch',
+                side_effect=lambda texts, processes=None, progress=None, mode=None: [text.upper() for text in texts])
+    def test_prepared_texts_are_reused(self, mock_text_prepare_batch):
+        # arrange
+        store = mock.MagicMock()
+        store.read_lines = mock.MagicMock(side_effect=lambda guid: iter(['text of {}\n'.format(guid)]))
+        cache = PreparedTextCache(os.path.join(self.temp_dir, 'prepared.sqlite'))
+        documents = [{'docGuid': 'one'}, {'docGuid': 'two'}]
+
+        # act
+        first = TopicModel('search_one', documents[:1], store=store, prepared_cache=cache)._get_prepared_texts(['one'])
+        second = TopicModel('search_two', documents, store=store, prepared_cache=cache)._get_prepared_texts(['one', 'two'])
+
+        # assert
+        self.assertEqual(first, ['TEXT OF ONE\n'])
+        self.assertEqual(second, ['TEXT OF ONE\n', 'TEXT OF TWO\n'])
+        mock_text_prepare_batch.assert_called_with(['text of two\n'], processes=None, mode='nltk', progress=mock.ANY)
+        cache.close()
+
+    def test_workspace_is_private_limited_and_removed(self):
+        # arrange
+        stale = os.path.join(self.temp_dir, 'topic_model_999999999_stale')
+        os.makedirs(stale)
+
+        # act
+        with Workspace(self.temp_dir, max_bytes=10) as first, Workspace(self.temp_dir, max_bytes=10) as second:
+            paths = (first.path, second.path)
+            with open(first.get_path('batch'), 'w') as batch:
+                batch.write('0123456789')
+            first.check()
+            self.assertRaises(WorkspaceFullError, first.check, projected=1)
+            cleared_before_writing = os.listdir(first.path)
+            with open(first.get_path('batch'), 'w') as batch:
+                batch.write('0123456789')
+            os.makedirs(first.get_path('batches'))
+            with open(os.path.join(first.get_path('batches'), 'batch'), 'w') as batch:
+                batch.write('0')
+            self.assertRaises(WorkspaceFullError, first.check)
+            cleared_after_writing = os.listdir(first.path)
+            self.assertEqual(second.check(), 0)
+        removed = remove_stale_workspaces(self.temp_dir)
+
+        # assert
+        self.assertNotEqual(paths[0], paths[1])
+        self.assertEqual((cleared_before_writing, cleared_after_writing), ([], []))
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+        self.assertEqual(removed, 1)
+        self.assertFalse(os.path.exists(stale))
+
+    def test_fit_stops_once_scores_converge(self):
+        # arrange
+        model = TopicModel('search_guid', [], store=mock.MagicMock(), prepared_cache=mock.MagicMock(), tolerance=0.01)
+        model.status = {'phases': []}
+        perplexity = iter([100.0, 50.0, 40.0, 39.9, 39.8, 39.7])
+        sparsity = mock.MagicMock(last_value=0.5)
+        model.model_artm = mock.MagicMock()
+        model.model_artm.score_tracker = {
+            'perplexity': mock.MagicMock(),
+            'sparsity_phi': sparsity
+        }
+        model.model_artm.fit_offline.side_effect = lambda **kwargs: setattr(
+            model.model_artm.score_tracker['perplexity'], 'last_value', next(perplexity))
+
+        # act
+        model._fit('batch_vectorizer', 'offline', 30, 'smooth')
+
+        # assert
+        self.assertEqual(model.model_artm.fit_offline.call_count, 4)
+        model.model_artm.fit_offline.assert_called_with(batch_vectorizer='batch_vectorizer', num_collection_passes=1)
+        self.assertEqual(model.status['phases'][0]['passes'], 4)
+        self.assertEqual(model.status['phases'][0]['perplexity'], 39.9)
+
+    @unittest.skipIf(importlib.util.find_spec('artm') is None, 'bigartm is not installed')
+    def test_online_fit_separates_topics(self):
+        # arrange
+        rnd = random.Random(0)
+        clusters = [['{}{}'.format(name, idx) for idx in range(20)] for name in ('court', 'patent', 'tax')]
+        common = ['common{}'.format(idx) for idx in range(10)]
+        prepared_documents = [
+            ('guid{}'.format(idx), ' '.join([rnd.choice(clusters[idx % 3]) for _ in range(200)] +
+                                            [rnd.choice(common) for _ in range(100)]))
+            for idx in range(600)
+        ]
+        model = TopicModel('search_guid', [{'docGuid': guid} for guid, _ in prepared_documents], num_of_topics=4,
+                           store=mock.MagicMock(), prepared_cache=mock.MagicMock(), fit_mode='online',
+                           scratch_dir=self.temp_dir)
+
+        # act
+        with mock.patch('knowledge_extractor.models.ensure_preprocessing_resources'), \
+                mock.patch.object(model, '_get_prepared_documents', return_value=prepared_documents):
+            model.train()
+        subjects = [Counter(doc['sbj'] for doc in model.get_topic_profile() if int(doc['doc_guid'][4:]) % 3 == idx)
+                    for idx in range(3)]
+        top_words = model.get_top_words(count=5)
+
+        # assert
+        self.assertEqual(model.get_status()['fit_mode'], 'online')
+        main_subjects = [counts.most_common(1)[0] for counts in subjects]
+        self.assertEqual(len(set(subject for subject, _ in main_subjects)), 3)
+        self.assertNotIn('bcg', [subject for subject, _ in main_subjects])
+        self.assertTrue(all(count > 150 for _, count in main_subjects))
+        for idx, (subject, _) in enumerate(main_subjects):
+            self.assertTrue(top_words[subject])
+            self.assertTrue(all(word in clusters[idx] for word in top_words[subject]))
+        self.assertEqual(get_tau_scale('online', 600), 1 / 6)
+        self.assertEqual(get_tau_scale('offline', 600), 1.0)
+
+    def test_topic_profile_matrix(self):
+        # arrange
+        phi = [[0.5, 0.3], [0.0, 0.0], [0.5, 0.5]]
+        theta = [[1.0, 2.0], [3.0, 2.0]]
+
+        # act
+        topic_profile = get_topic_profile_matrix(phi, theta)
+
+        # assert
+        self.assertEqual(topic_profile.tolist(), [[0.5, 0.5], [0.0, 0.0], [0.375, 0.625]])
+
+    def test_get_document_uses_first_match(self):
+        # arrange
+        documents = [{'docGuid': 'one', 'rank': 1}, {'docGuid': 'two', 'rank': 2}, {'docGuid': 'one', 'rank': 3}]
+        model = TopicModel('search_guid', documents, store=mock.MagicMock(), prepared_cache=mock.MagicMock())
+
+        # act
+        found = [model._get_document(guid) for guid in ('one', 'two', 'three')]
+
+        # assert
+        self.assertEqual(found, [documents[0], documents[1], None])
+
+    def test_projection_is_stable(self):
+        # arrange
+        topic_profile = [[0.9, 0.1, 0.0], [0.8, 0.2, 0.0], [0.0, 0.1, 0.9], [0.1, 0.0, 0.9], [0.4, 0.6, 0.0]]
+
+        # act
+        coords = dict((method, project(topic_profile, method, random_state=7, num_landmarks=3))
+                      for method in ('mds', 'landmark', 'pca'))
+        repeated = dict((method, project(topic_profile, method, random_state=7, num_landmarks=3))
+                        for method in ('mds', 'landmark', 'pca'))
+
+        # assert
+        for method in coords:
+            self.assertEqual(coords[method].shape, (5, 2))
+            self.assertEqual(coords[method].tolist(), repeated[method].tolist())
+        self.assertEqual(get_method(1000, 'auto', threshold=1000), 'mds')
+        self.assertEqual(get_method(1001, 'auto', threshold=1000), 'landmark')
+        self.assertRaises(ValueError, get_method, 10, 'tsne')
 
     ''' DEBUG 
     def test_topic_modelling(self):
@@ -171,10 +877,309 @@ class TopicModelTestCase(unittest.TestCase):
 
 class TopicModelApiTestCase(unittest.TestCase):
     def setUp(self):
-        pass
+        self.temp_dir = tempfile.mkdtemp()
 
     def tearDown(self):
-        pass
+        shutil.rmtree(self.temp_dir)
+
+    def test_registry_evicts_and_reloads_trained_models(self):
+        # arrange
+        registry = ModelRegistry(self.temp_dir, memory_budget=200)
+        jobs = [TrainingJob(guid, [{'docGuid': guid}], key='key_{}'.format(guid)) for guid in ('one', 'two', 'queued')]
+        for job in jobs:
+            registry.attach(job.search_guid, job.key, lambda job=job: job)
+        for job in jobs[:2]:
+            job.result = {'documents': [{'doc_guid': job.search_guid}], 'topics': {}, 'status': {}}
+            job.state = 'done'
+            registry.on_done(job)
+
+        # act
+        reloaded = registry['one']
+        restarted = ModelRegistry(self.temp_dir)
+        restarted.load()
+
+        # assert
+        self.assertEqual(registry.evictions, 2)
+        self.assertIsNot(reloaded, jobs[0])
+        self.assertEqual(reloaded.get_topic_profile(), [{'doc_guid': 'one'}])
+        self.assertIs(registry['queued'], jobs[2])
+        self.assertIsNone(jobs[0].documents)
+        self.assertTrue('two' in restarted and 'queued' not in restarted)
+        self.assertTrue(restarted['two'].is_ready())
+
+    def test_registry_returns_model_larger_than_budget(self):
+        # arrange
+        registry = ModelRegistry(self.temp_dir, memory_budget=10)
+        job = TrainingJob('search_guid', [{'docGuid': 'one'}], key='key')
+        registry.attach('search_guid', 'key', lambda: job)
+        job.result = {'documents': [{'doc_guid': 'one'}], 'topics': {}, 'status': {}}
+        job.state = 'done'
+        registry.on_done(job)
+
+        # act
+        first = registry['search_guid']
+        second = registry['search_guid']
+
+        # assert
+        self.assertEqual(first.get_topic_profile(), [{'doc_guid': 'one'}])
+        self.assertIs(second, first)
+        self.assertEqual((registry.evictions, registry.reloads), (1, 1))
+
+    def test_registry_keeps_response_of_trained_models(self):
+        # arrange
+        registry = ModelRegistry(self.temp_dir, serialise=serialise_model)
+        job = TrainingJob('search_guid', [{'docGuid': 'one'}], key='key')
+        registry.attach('search_guid', 'key', lambda: job)
+        job.result = {'documents': [{'doc_guid': 'one'}], 'topics': {'sbj0': ['court']}, 'status': {'passes': 3}}
+        job.state = 'done'
+
+        # act
+        registry.on_done(job)
+        restarted = ModelRegistry(self.temp_dir, serialise=serialise_model)
+        restarted.load()
+        reloaded = restarted['search_guid']
+
+        # assert
+        for model, registry in ((job, registry), (reloaded, restarted)):
+            self.assertEqual(model.result, {'status': {'passes': 3}})
+            self.assertEqual(json.loads(model.response[0].decode('utf-8'))['topics'], {'sbj0': ['court']})
+            self.assertEqual(registry.memory_size(), len(model.response[0]) + len(json.dumps(model.result)))
+            self.assertEqual(model.get_status(), {'passes': 3})
+
+    def test_registry_shares_models_of_identical_searches(self):
+        # arrange
+        registry = ModelRegistry(self.temp_dir)
+        documents = [{'docGuid': 'one'}, {'docGuid': 'two'}]
+        key = get_model_key(documents)
+        create = mock.MagicMock(side_effect=lambda: TrainingJob('first', documents, key=key))
+
+        # act
+        first, created = registry.attach('first', key, create)
+        second, second_created = registry.attach('second', get_model_key(list(reversed(documents))), create)
+        other, _ = registry.attach('other', get_model_key(documents, num_of_topics=20), create)
+
+        # assert
+        self.assertTrue(created)
+        self.assertFalse(second_created)
+        self.assertIs(second, first)
+        self.assertIs(registry['second'], first)
+        self.assertIsNot(other, first)
+        self.assertEqual(create.call_count, 2)
+        self.assertEqual(registry.stats()['dedup_hit_rate'], round(1 / 3, 4))
+
+    def test_searches_ranking_documents_differently_do_not_share_responses(self):
+        # arrange
+        executor = mock.MagicMock()
+        futures = []
+        executor.submit.side_effect = lambda *args, **kwargs: futures.append(Future()) or futures[-1]
+        scheduler = TrainingScheduler(workers=2, executor=executor)
+        registry = ModelRegistry(self.temp_dir)
+        first = [{'docGuid': 'one', 'rank': 1, 'title': 'One'}, {'docGuid': 'two', 'rank': 2, 'title': 'Two'}]
+        second = [{'docGuid': 'one', 'rank': 2, 'title': 'One'}, {'docGuid': 'two', 'rank': 1, 'title': 'Two'}]
+        def post(search_guid, documents):
+            request = mock.MagicMock()
+            request.media = {'search_guid': search_guid, 'documents': documents}
+            request.get_header.return_value = None
+            response = mock.MagicMock()
+            TopicModelApi().on_post(request, response)
+            return response
+
+        with mock.patch('api.topic_modelling.scheduler', scheduler), mock.patch('api.topic_modelling.models', registry):
+            # act
+            post('first', first)
+            post('second', second)
+            post('reordered', list(reversed(first)))
+            for future, documents in zip(futures, (first, second)):
+                future.set_result({'documents': [{'doc_guid': doc['docGuid'], 'rank': doc['rank']} for doc in documents],
+                                   'topics': {}, 'status': {}})
+            responses = [json.loads(post(search_guid, None).data.decode('utf-8'))
+                         for search_guid in ('first', 'second', 'reordered')]
+
+        # assert
+        self.assertEqual(len(futures), 2)
+        self.assertIs(registry['reordered'], registry['first'])
+        self.assertEqual([doc['rank'] for doc in responses[0]['documents']], [1, 2])
+        self.assertEqual([doc['rank'] for doc in responses[1]['documents']], [2, 1])
+        self.assertEqual(responses[2]['documents'], responses[0]['documents'])
+
+    def test_status_waits_for_progress_and_streams_events(self):
+        # arrange
+        futures = []
+        executor = mock.MagicMock()
+        executor.submit.side_effect = lambda *args, **kwargs: futures.append(Future()) or futures[-1]
+        scheduler = TrainingScheduler(workers=1, executor=executor)
+        registry = ModelRegistry(self.temp_dir)
+        request = mock.MagicMock()
+        request.media = {'search_guid': 'search_guid', 'documents': [{'docGuid': 'one'}]}
+        request.get_header.return_value = None
+
+        with mock.patch('api.topic_modelling.scheduler', scheduler), mock.patch('api.topic_modelling.models', registry):
+            TopicModelApi().on_post(request, mock.MagicMock())
+            key = registry['search_guid'].key
+            reporter = threading.Timer(0.1, scheduler.report_progress, (key, 'fetched', 1, 1))
+            reporter.start()
+
+            # act
+            waited = get_status('search_guid', wait=5)
+            events = get_status_events('search_guid')
+            first = next(events)
+            scheduler.report_progress(key, 'fit', 3, 45)
+            second = next(events)
+            futures[0].set_result({'documents': [], 'topics': {}, 'status': {'documents': 1}})
+            last = list(events)
+
+        # assert
+        self.assertEqual(waited['progress'], {'fetched': {'done': 1, 'total': 1}})
+        self.assertTrue(first.startswith(b'event: status\ndata: '))
+        self.assertEqual(json.loads(second.decode('utf-8').split('data: ')[1])['progress']['fit'], {'done': 3, 'total': 45})
+        self.assertEqual(len(last), 1)
+        self.assertEqual(json.loads(last[0].decode('utf-8').split('data: ')[1])['state'], 'MODEL_TRAINED')
+
+    def test_status_rejects_invalid_wait(self):
+        # arrange
+        import falcon
+        requests = [mock.MagicMock(media={'search_guid': 'search_guid', 'wait': wait})
+                    for wait in ('soon', -1, float('nan'), True)]
+
+        # act
+        with mock.patch('api.topic_modelling.models', ModelRegistry(self.temp_dir)):
+            for request in requests:
+                with self.assertRaises(falcon.HTTPBadRequest):
+                    TopicModelStatusApi().on_post(request, mock.MagicMock())
+
+        # assert
+        self.assertEqual(get_wait('12.5', maximum=30), 12.5)
+        self.assertEqual(get_wait(3600, maximum=30), 30)
+        self.assertEqual(get_wait(None), 0)
+
+    def test_progressive_training_serves_preliminary_model_first(self):
+        # arrange
+        futures = {'full': [], 'preliminary': []}
+        def get_executor(kind):
+            executor = mock.MagicMock()
+            executor.submit.side_effect = lambda *args, **kwargs: futures[kind].append(Future()) or futures[kind][-1]
+            return executor
+        registry = ModelRegistry(self.temp_dir)
+        scheduler = TrainingScheduler(workers=1, executor=get_executor('full'), on_done=registry.on_done)
+        preliminary_scheduler = TrainingScheduler(workers=1, executor=get_executor('preliminary'),
+                                                  options={'analyze_full_doc': False})
+        preliminary_scheduler.on_done = mock.MagicMock(side_effect=lambda job: scheduler.notify(job.parent))
+        request = mock.MagicMock()
+        request.media = {'search_guid': 'search_guid', 'documents': [{'docGuid': 'one'}], 'progressive': True}
+        request.get_header.return_value = None
+        responses = [mock.MagicMock() for _ in range(4)]
+
+        with mock.patch('api.topic_modelling.scheduler', scheduler), \
+                mock.patch('api.topic_modelling.preliminary_scheduler', preliminary_scheduler), \
+                mock.patch('api.topic_modelling.models', registry):
+            # act
+            TopicModelApi().on_post(request, responses[0])
+            job = registry['search_guid']
+            version = job.version
+            TopicModelApi().on_post(request, responses[1])
+            futures['preliminary'][0].set_result({'documents': [{'doc_guid': 'one', 'sbj': 'sbj0'}], 'topics': {},
+                                                  'status': {}})
+            status = get_status('search_guid')
+            TopicModelApi().on_post(request, responses[2])
+            futures['full'][0].set_result({'documents': [{'doc_guid': 'one', 'sbj': 'sbj1'}], 'topics': {},
+                                           'status': {}})
+            TopicModelApi().on_post(request, responses[3])
+
+        # assert
+        self.assertEqual(responses[0].media['state'], 'MODEL_NOT_TRAINED')
+        self.assertEqual(responses[1].media['state'], 'MODEL_TRAINING')
+        self.assertEqual(preliminary_scheduler._executor.submit.call_args[1]['analyze_full_doc'], False)
+        self.assertGreater(status['version'], version)
+        self.assertTrue(status['preliminary'])
+        preliminary = json.loads(responses[2].data.decode('utf-8'))
+        final = json.loads(responses[3].data.decode('utf-8'))
+        self.assertEqual((preliminary['state'], preliminary['preliminary']), ('MODEL_TRAINING', True))
+        self.assertEqual(preliminary['documents'][0]['sbj'], 'sbj0')
+        self.assertEqual((final['state'], final['preliminary']), ('MODEL_TRAINED', False))
+        self.assertEqual(final['documents'][0]['sbj'], 'sbj1')
+        self.assertNotEqual(responses[2].set_header.call_args[0][1], responses[3].set_header.call_args[0][1])
+        self.assertIsNone(job.preliminary)
+
+    def test_trained_model_response_is_cached(self):
+        # arrange
+        model = mock.MagicMock()
+        model.response = None
+        model.is_ready.return_value = True
+        model.is_failed.return_value = False
+        model.is_preliminary.return_value = False
+        model.get_topic_profile.return_value = [{'doc_guid': 'one', 'x': 0.5, 'y': -0.5}]
+        model.get_top_words.return_value = {'sbj0': ['court']}
+        request = mock.MagicMock()
+        request.media = {'search_guid': 'search_guid'}
+        request.get_header.return_value = None
+        first, second = mock.MagicMock(), mock.MagicMock()
+
+        # act
+        with mock.patch('api.topic_modelling.models', {'search_guid': model}):
+            TopicModelApi().on_post(request, first)
+            etag = first.set_header.call_args[0][1]
+            request.get_header.return_value = etag
+            TopicModelApi().on_post(request, second)
+
+        # assert
+        self.assertEqual(json.loads(first.data.decode('utf-8'))['documents'], model.get_topic_profile.return_value)
+        self.assertEqual(second.status, '304 Not Modified')
+        second.set_header.assert_called_with('ETag', etag)
+        self.assertEqual(model.get_topic_profile.call_count, 1)
+
+    def test_scheduler_queues_by_priority_and_rejects_when_full(self):
+        # arrange
+        futures = []
+        executor = mock.MagicMock()
+        executor.submit.side_effect = lambda *args, **kwargs: futures.append(Future()) or futures[-1]
+        scheduler = TrainingScheduler(workers=1, max_queue=2, estimate=60, executor=executor)
+        first, second, urgent = TrainingJob('first', []), TrainingJob('second', []), TrainingJob('urgent', [], priority=-1)
+
+        # act
+        for job in (first, second, urgent):
+            scheduler.submit(job)
+        positions = [scheduler.get_position(job) for job in (first, second, urgent)]
+        wait = scheduler.get_estimated_start(second) - first.started
+        self.assertRaises(QueueFullError, scheduler.submit, TrainingJob('rejected', []))
+        futures[0].set_result({'documents': [], 'topics': {}, 'status': {}})
+
+        # assert
+        self.assertEqual(positions, [None, 1, 0])
+        self.assertAlmostEqual(wait, 120, delta=1)
+        self.assertTrue(first.is_ready())
+        self.assertEqual(urgent.state, 'running')
+        self.assertEqual(executor.submit.call_args[0][1], 'urgent')
+
+    def test_malformed_priority_is_rejected_and_priorities_are_clamped(self):
+        # arrange
+        executor = mock.MagicMock()
+        executor.submit.side_effect = lambda *args, **kwargs: Future()
+        scheduler = TrainingScheduler(workers=1, executor=executor)
+        registry = ModelRegistry(self.temp_dir)
+        def post(search_guid, priority):
+            request = mock.MagicMock()
+            request.media = {'search_guid': search_guid, 'documents': [{'docGuid': search_guid}], 'priority': priority}
+            request.get_header.return_value = None
+            response = mock.MagicMock()
+            TopicModelApi().on_post(request, response)
+            return response
+
+        with mock.patch('api.topic_modelling.scheduler', scheduler), mock.patch('api.topic_modelling.models', registry):
+            # act
+            malformed = post('malformed', 'high')
+            post('running', 0)
+            post('urgent', -100)
+            post('later', '5')
+
+        # assert
+        self.assertEqual(malformed.status, '400 Bad Request')
+        self.assertNotIn('malformed', registry)
+        self.assertEqual((registry['urgent'].priority, registry['later'].priority), (0, 5))
+        self.assertEqual(scheduler.get_queue_length(), 2)
+        self.assertEqual(get_priority(-100, minimum=-10), -10)
+        self.assertEqual(get_priority(100), 9)
+        self.assertRaises(ValueError, get_priority, None)
+        self.assertRaises(ValueError, get_priority, 1.5)
 
     ''' DEBUG
     @mock.patch('api.topic_modelling.get_parser')